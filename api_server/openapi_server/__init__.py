@@ -6,9 +6,11 @@ import connexion
 from connexion import decorators
 from connexion.exceptions import BadRequestProblem
 from connexion.utils import is_null
+from flask import g, request
 from flask_cors import CORS
 from jsonschema import ValidationError
 from openapi_server import encoder
+from openapi_server.controllers.client_registry import client_registry
 
 
 class RequestBodyValidator(decorators.validation.RequestBodyValidator):
@@ -55,6 +57,7 @@ app.add_api(
 )
 if "GAE_INSTANCE" in os.environ:
     CORS(app.app, origins=config.ORIGINS)
+    client_registry.initialize()
 else:
     CORS(app.app)
 
@@ -79,3 +82,13 @@ def add_header(response):
         "fullscreen 'none'; payment 'none';"
     )
     return response
+
+
+@app.app.after_request
+def log_storage_metadata_calls(response):
+    if getattr(config, "DEBUG_LOGGING", False) and "storage_metadata_calls_saved" in g:
+        logging.info(
+            f"{request.path} saved {g.storage_metadata_calls_saved} "
+            "bucket metadata calls"
+        )
+    return response
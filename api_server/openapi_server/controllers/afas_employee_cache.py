@@ -0,0 +1,88 @@
+import copy
+import logging
+import threading
+import time
+
+import config
+from flask import g, has_app_context
+
+DEFAULT_AFAS_EMPLOYEE_CACHE_TTL = 60  # seconds, 0 disables the process cache
+
+
+class AfasEmployeeCache:
+    """
+    Cache of AFAS_HRM employee lookups, keyed by normalized UPN
+
+    Within a request every lookup is kept on flask.g, so a request never
+    queries the same employee twice, whether it was found or not. Employees
+    that were found are also kept for the process until the TTL expires, as
+    managers open the app repeatedly in a short time.
+    """
+
+    def __init__(self, ttl=DEFAULT_AFAS_EMPLOYEE_CACHE_TTL):
+        self.ttl = ttl
+        self.request_hits = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._employees = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, unique_name, load):
+        with self._lock:
+            employee, expires_at = self._employees.get(unique_name, (None, 0.0))
+            if employee is not None and time.monotonic() < expires_at:
+                self.hits += 1
+                return employee
+
+            self.misses += 1
+
+        employee = load()
+
+        if employee is not None and self.ttl:
+            with self._lock:
+                self._employees[unique_name] = (employee, time.monotonic() + self.ttl)
+
+        return employee
+
+    def get(self, unique_name, load):
+        """
+        Returns the AFAS data of an employee
+        :param unique_name: normalized UPN of the employee
+        :param load: callable that queries the employee, returns None when not found
+        :return: copy of the AFAS data, or None
+        """
+        request_cache = g.setdefault("afas_employees", {}) if has_app_context() else {}
+
+        if unique_name in request_cache:
+            with self._lock:
+                self.request_hits += 1
+            employee = request_cache[unique_name]
+        else:
+            employee = request_cache[unique_name] = self._lookup(unique_name, load)
+
+        return copy.deepcopy(employee)
+
+    def invalidate(self):
+        """
+        Drops the cached employees, the next lookup will query Datastore. Used
+        to isolate tests, as AFAS_HRM is written by the HR sync.
+        """
+        with self._lock:
+            self._employees = {}
+
+        logging.info(f"AFAS employee cache invalidated: {self.stats()}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "request_hits": self.request_hits,
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._employees),
+            }
+
+
+afas_employee_cache = AfasEmployeeCache(
+    ttl=getattr(config, "AFAS_EMPLOYEE_CACHE_TTL", DEFAULT_AFAS_EMPLOYEE_CACHE_TTL)
+)
@@ -0,0 +1,101 @@
+import logging
+
+from google.cloud import datastore
+
+INDEX_KIND = "AFAS_HRM_Index"
+INDEXED_FIELDS = ["upn", "email_address", "Personeelsnummer"]
+
+
+def normalize(value):
+    """Normalizes a UPN, e-mail address or personnel number for the index"""
+    return str(value).lower().strip()
+
+
+def index_key(ds_client, field, value):
+    return ds_client.key(INDEX_KIND, f"{field}:{normalize(value)}")
+
+
+def build_index_entries(ds_client, employee):
+    """
+    Creates the index entities that map the UPN, e-mail address and personnel
+    number of an employee to its AFAS_HRM key
+    :param ds_client: Datastore client
+    :param employee: AFAS_HRM entity
+    :return: list of AFAS_HRM_Index entities
+    """
+    entries = []
+    for field in INDEXED_FIELDS:
+        if employee.get(field) in (None, ""):
+            continue
+
+        entry = datastore.Entity(
+            key=index_key(ds_client, field, employee[field]),
+            exclude_from_indexes=("afas_key",),
+        )
+        entry["afas_key"] = employee.key
+        entries.append(entry)
+
+    return entries
+
+
+def get_afas_employee(ds_client, field, value):
+    """
+    Returns the AFAS_HRM employee of which the field has the value. The index
+    is read with strongly consistent key lookups. An employee that is not in
+    the index, or no longer matches its entry because the HR sync rewrote it,
+    is queried on the field and the index is repaired.
+    :param ds_client: Datastore client
+    :param field: "upn", "email_address" or "Personeelsnummer"
+    :param value: value of the field, compared after normalizing
+    :return: AFAS_HRM entity or None
+    """
+    entry = ds_client.get(index_key(ds_client, field, value))
+    if entry is not None:
+        employee = ds_client.get(entry["afas_key"])
+        if employee is not None and normalize(employee.get(field)) == normalize(value):
+            return employee
+
+    query = ds_client.query(kind="AFAS_HRM")
+    query.add_filter(field, "=", value)
+    employees = list(query.fetch(limit=1))
+    if not employees:
+        return None
+
+    try:
+        ds_client.put_multi(build_index_entries(ds_client, employees[0]))
+    except Exception:
+        logging.exception(f"Could not index AFAS_HRM employee on {field}")
+
+    return employees[0]
+
+
+def backfill_afas_index(ds_client, batch_size=100):
+    """
+    Writes the index entries of every AFAS_HRM employee, entries that are
+    missing later are added on their first lookup
+    :param ds_client: Datastore client
+    :param batch_size: number of employees per put_multi, at most 500 entities
+    :return: number of index entries written
+    """
+    entries = []
+    count = 0
+
+    for employee in ds_client.query(kind="AFAS_HRM").fetch():
+        entries.extend(build_index_entries(ds_client, employee))
+
+        if len(entries) >= batch_size * len(INDEXED_FIELDS):
+            ds_client.put_multi(entries)
+            count += len(entries)
+            entries = []
+
+    if entries:
+        ds_client.put_multi(entries)
+        count += len(entries)
+
+    logging.info(f"Backfilled {count} AFAS_HRM index entries")
+    return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    backfill_afas_index(datastore.Client())
@@ -0,0 +1,321 @@
+import atexit
+import concurrent.futures
+import datetime
+import io
+import logging
+import tempfile
+import threading
+import time
+
+import config
+from google.api_core import exceptions as gcp_exceptions
+from pikepdf import Pdf
+
+ATTACHMENTS_PREFIX = "exports/attachments"
+PENDING_ATTACHMENTS_PREFIX = "exports/pending_attachments"
+ATTACHMENT_STATUS_PENDING = "pending"
+ATTACHMENT_STATUS_PROCESSED = "processed"
+ATTACHMENT_STATUS_FAILED = "failed"
+DEFAULT_ATTACHMENT_PROCESSING_WORKERS = 2
+DEFAULT_ATTACHMENT_PROCESSING_ATTEMPTS = 3
+DEFAULT_ATTACHMENT_SWEEP_INTERVAL = 10 * 60  # seconds
+DEFAULT_ATTACHMENT_STALE_AFTER = 15 * 60  # seconds
+FLATTENED_PDF_SPOOL_SIZE = 4 * 1024 * 1024  # Bytes kept in memory before spooling
+ACTIVE_CONTENT_KEYS = ["/OpenAction", "/AA"]
+ACTIVE_NAME_TREES = ["/JavaScript", "/EmbeddedFiles"]
+
+
+def attachment_status(blob):
+    """
+    Returns the processing status of an attachment blob, attachments that were
+    stored before they were processed off the request have no status
+    """
+    return (blob.metadata or {}).get("status", ATTACHMENT_STATUS_PROCESSED)
+
+
+def flatten_pdf(content, output):
+    """
+    Flattens the annotations of a PDF (e.g. images, links, videos, etc.) and
+    removes the actions and scripts that run when it is opened
+    :param content: PDF bytes
+    :param output: binary file to write the processed PDF to
+    :return: number of pages
+    """
+    with Pdf.open(io.BytesIO(content)) as pdf:
+        pdf.flatten_annotations()
+
+        for dictionary in [pdf.Root, *pdf.pages]:
+            for key in ACTIVE_CONTENT_KEYS:
+                if key in dictionary:
+                    del dictionary[key]
+
+        if "/Names" in pdf.Root:
+            for key in ACTIVE_NAME_TREES:
+                if key in pdf.Root.Names:
+                    del pdf.Root.Names[key]
+
+        pdf.save(output)
+        return len(pdf.pages)
+
+
+class AttachmentProcessor:
+    """
+    Process-wide pool that flattens uploaded PDFs on background workers
+
+    The raw upload is stored under the pending prefix by the request, so the
+    worker only has to write the processed PDF to the attachments prefix and
+    remove the pending one. A PDF that can not be processed stays pending with
+    the failed status. PDFs that were queued on an instance that stopped stay
+    pending too, so the pending prefix is swept every sweep_interval: PDFs
+    that have been pending for stale_after seconds are resubmitted and failed
+    ones are retried until they failed max_attempts times. With zero workers
+    PDFs are processed inline, which is the local stand-in used by tests.
+    """
+
+    def __init__(
+        self,
+        max_workers=DEFAULT_ATTACHMENT_PROCESSING_WORKERS,
+        max_attempts=DEFAULT_ATTACHMENT_PROCESSING_ATTEMPTS,
+        sweep_interval=DEFAULT_ATTACHMENT_SWEEP_INTERVAL,
+        stale_after=DEFAULT_ATTACHMENT_STALE_AFTER,
+    ):
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.sweep_interval = sweep_interval
+        self.stale_after = stale_after
+
+        self.queued = 0
+        self.processed = 0
+        self.failed = 0
+        self.pages = 0
+        self.processing_time = 0.0
+
+        self._executor = None
+        self._pending = {}
+        self._last_sweep = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix="attachment",
+                )
+
+            return self._executor
+
+    def _process(self, bucket, name, content, content_type, attempt, on_status):
+        pending_blob = bucket.blob(f"{PENDING_ATTACHMENTS_PREFIX}/{name}")
+        started_at = time.monotonic()
+
+        try:
+            if content is None:
+                content = pending_blob.download_as_bytes()
+
+            with tempfile.SpooledTemporaryFile(
+                max_size=FLATTENED_PDF_SPOOL_SIZE
+            ) as output:
+                pages = flatten_pdf(content, output)
+
+                if not pending_blob.exists():
+                    logging.info(f"Attachment '{name}' was deleted while processing")
+                    return False
+
+                blob = bucket.blob(f"{ATTACHMENTS_PREFIX}/{name}")
+                blob.metadata = {"status": ATTACHMENT_STATUS_PROCESSED}
+                blob.upload_from_file(output, rewind=True, content_type=content_type)
+
+            pending_blob.delete()
+            self._report(on_status, name, ATTACHMENT_STATUS_PROCESSED)
+        except gcp_exceptions.NotFound:
+            # Deleted, or processed by another instance that resubmitted it
+            logging.info(f"Attachment '{name}' is no longer pending")
+            return False
+        except Exception:
+            logging.exception(f"Processing attachment '{name}' failed")
+            with self._lock:
+                self.failed += 1
+
+            if attempt >= self.max_attempts:
+                logging.error(
+                    f"Attachment '{name}' failed {attempt} times, it is left as failed"
+                )
+
+            try:
+                pending_blob.metadata = {
+                    "status": ATTACHMENT_STATUS_FAILED,
+                    "attempts": str(attempt),
+                }
+                pending_blob.patch()
+            except Exception:
+                logging.exception(f"Marking attachment '{name}' as failed failed")
+
+            self._report(on_status, name, ATTACHMENT_STATUS_FAILED)
+            return False
+
+        with self._lock:
+            self.processed += 1
+            self.pages += pages
+            self.processing_time += time.monotonic() - started_at
+
+        return True
+
+    @staticmethod
+    def _report(on_status, name, status):
+        if on_status is None:
+            return
+
+        try:
+            on_status(name, status)
+        except Exception:
+            logging.exception(f"Reporting attachment '{name}' as {status} failed")
+
+    def submit(self, bucket, name, content, content_type, on_status=None, attempt=1):
+        """
+        Queues a PDF that was stored under the pending prefix for processing,
+        the pending prefix is swept as well when it is due
+        :param bucket: attachments bucket
+        :param name: attachment name relative to the (pending) attachments prefix
+        :param content: raw PDF bytes, None to download them from the pending prefix
+        :param content_type: content type of the attachment
+        :param on_status: called with the name and the status once it is processed
+            or failed, also for the PDFs resubmitted by the sweep
+        :param attempt: number of the attempt to process the PDF
+        :return: concurrent.futures.Future that resolves to whether it was processed
+        """
+        future = self._submit(bucket, name, content, content_type, attempt, on_status)
+        self._sweep_if_due(bucket, on_status)
+        return future
+
+    def _submit(self, bucket, name, content, content_type, attempt, on_status):
+        with self._lock:
+            self.queued += 1
+
+        if not self.max_workers:
+            future = concurrent.futures.Future()
+            future.set_result(
+                self._process(bucket, name, content, content_type, attempt, on_status)
+            )
+            return future
+
+        future = self._get_executor().submit(
+            self._process, bucket, name, content, content_type, attempt, on_status
+        )
+        with self._lock:
+            self._pending[future] = name
+        future.add_done_callback(self._done)
+
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.pop(future, None)
+
+    def _sweep_if_due(self, bucket, on_status):
+        now = time.monotonic()
+        with self._lock:
+            if (
+                self._last_sweep is not None
+                and now - self._last_sweep < self.sweep_interval
+            ):
+                return
+            self._last_sweep = now
+
+        if not self.max_workers:
+            self._sweep(bucket, on_status)
+        else:
+            self._get_executor().submit(self._sweep, bucket, on_status)
+
+    def _sweep(self, bucket, on_status):
+        try:
+            self.sweep(bucket, on_status)
+        except Exception:
+            logging.exception("Sweeping the pending attachments failed")
+
+    def sweep(self, bucket, on_status=None):
+        """
+        Resubmits the PDFs under the pending prefix that were lost or failed
+        :param bucket: attachments bucket
+        :param on_status: called with the name and the status of resubmitted PDFs
+        :return: number of resubmitted PDFs
+        """
+        stale = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            seconds=self.stale_after
+        )
+        with self._lock:
+            queued = set(self._pending.values())
+
+        resubmitted = 0
+        for blob in bucket.list_blobs(prefix=f"{PENDING_ATTACHMENTS_PREFIX}/"):
+            name = blob.name[len(PENDING_ATTACHMENTS_PREFIX) + 1 :]
+            metadata = blob.metadata or {}
+            attempts = int(metadata.get("attempts", 0))
+
+            if name in queued or blob.updated > stale:
+                continue
+            if (
+                metadata.get("status") == ATTACHMENT_STATUS_FAILED
+                and attempts >= self.max_attempts
+            ):
+                continue
+
+            logging.warning(
+                f"Resubmitting {metadata.get('status', 'pending')} attachment '{name}'"
+            )
+            self._submit(bucket, name, None, blob.content_type, attempts + 1, on_status)
+            resubmitted += 1
+
+        return resubmitted
+
+    def flush(self, timeout=None):
+        """
+        Waits until the queued attachments are processed or have failed
+        :param timeout: maximum number of seconds to wait
+        :return: True when the queue is empty
+        """
+        with self._lock:
+            pending = list(self._pending)
+
+        done, not_done = concurrent.futures.wait(pending, timeout=timeout)
+        return not not_done
+
+    def shutdown(self):
+        """Processes the queued attachments and stops the workers"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+        logging.info(f"Attachment processor stopped: {self.stats()}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self.queued,
+                "pending": len(self._pending),
+                "processed": self.processed,
+                "failed": self.failed,
+                "pages": self.pages,
+                "average_processing_time": (
+                    self.processing_time / self.processed if self.processed else 0.0
+                ),
+            }
+
+
+attachment_processor = AttachmentProcessor(
+    max_workers=getattr(
+        config, "ATTACHMENT_PROCESSING_WORKERS", DEFAULT_ATTACHMENT_PROCESSING_WORKERS
+    ),
+    max_attempts=getattr(
+        config, "ATTACHMENT_PROCESSING_ATTEMPTS", DEFAULT_ATTACHMENT_PROCESSING_ATTEMPTS
+    ),
+    sweep_interval=getattr(
+        config, "ATTACHMENT_SWEEP_INTERVAL", DEFAULT_ATTACHMENT_SWEEP_INTERVAL
+    ),
+    stale_after=getattr(
+        config, "ATTACHMENT_STALE_AFTER", DEFAULT_ATTACHMENT_STALE_AFTER
+    ),
+)
+atexit.register(attachment_processor.shutdown)
@@ -0,0 +1,201 @@
+import datetime
+import logging
+import re
+import threading
+import time
+
+import config
+import requests
+from google.api_core import exceptions as gcp_exceptions
+from openapi_server.controllers.attachment_processing import (
+    ATTACHMENTS_PREFIX, PENDING_ATTACHMENTS_PREFIX)
+
+ATTACHMENT_UPLOAD_KIND = "AttachmentUploads"
+UPLOAD_CHUNK_ALIGNMENT = 256 * 1024  # Cloud Storage only accepts multiples of this
+DEFAULT_ATTACHMENT_UPLOAD_CHUNK_SIZE = 4 * UPLOAD_CHUNK_ALIGNMENT
+DEFAULT_ATTACHMENT_UPLOAD_MAX_SIZE = 32 * 1024 * 1024
+DEFAULT_ATTACHMENT_UPLOAD_EXPIRY = 24 * 60 * 60  # seconds
+DEFAULT_ATTACHMENT_UPLOAD_CLEANUP_INTERVAL = 60 * 60  # seconds
+UPLOAD_CLEANUP_BATCH_SIZE = 100
+UPLOAD_REQUEST_TIMEOUT = 60  # seconds
+RESUME_INCOMPLETE = 308
+CONTENT_RANGE_PATTERN = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+RANGE_PATTERN = re.compile(r"^bytes=0-(\d+)$")
+
+# Process-wide session, so chunks of an upload reuse the pooled connection
+upload_session = requests.Session()
+
+
+class UploadSessionNotFound(Exception):
+    """The resumable upload session expired or was cancelled"""
+
+
+def parse_content_range(content_range):
+    """
+    Parses a Content-Range header of a chunk
+    :param content_range: header like "bytes 0-262143/1048576"
+    :return: (first byte, last byte, total size) or None when it is not valid
+    """
+    match = CONTENT_RANGE_PATTERN.match(content_range or "")
+    if not match:
+        return None
+
+    first, last, total = (int(group) for group in match.groups())
+    if first > last or last >= total:
+        return None
+
+    return first, last, total
+
+
+def _persisted_size(response, size):
+    if response.status_code in (200, 201):
+        return size
+
+    if response.status_code == RESUME_INCOMPLETE:
+        match = RANGE_PATTERN.match(response.headers.get("Range", ""))
+        return int(match.group(1)) + 1 if match else 0
+
+    if response.status_code in (404, 410):
+        raise UploadSessionNotFound(response.text)
+
+    response.raise_for_status()
+    raise requests.HTTPError(
+        f"Unexpected upload response {response.status_code}", response=response
+    )
+
+
+def upload_chunk(session_url, chunk, first, size):
+    """
+    Sends a chunk to a Cloud Storage resumable upload session, the upload is
+    completed by the chunk that holds the last byte
+    :param session_url: resumable upload session url
+    :param chunk: bytes of the chunk
+    :param first: offset of the chunk in the upload
+    :param size: total size of the upload
+    :return: number of bytes Cloud Storage persisted
+    """
+    response = upload_session.put(
+        session_url,
+        data=chunk,
+        headers={"Content-Range": f"bytes {first}-{first + len(chunk) - 1}/{size}"},
+        timeout=UPLOAD_REQUEST_TIMEOUT,
+    )
+    return _persisted_size(response, size)
+
+
+def get_persisted_size(session_url, size):
+    """
+    Queries the status of a Cloud Storage resumable upload session, so a client
+    can resume from the first byte that was not persisted
+    :param session_url: resumable upload session url
+    :param size: total size of the upload
+    :return: number of bytes Cloud Storage persisted
+    """
+    response = upload_session.put(
+        session_url,
+        data=b"",
+        headers={"Content-Range": f"bytes */{size}"},
+        timeout=UPLOAD_REQUEST_TIMEOUT,
+    )
+    return _persisted_size(response, size)
+
+
+def upload_blob_name(upload):
+    """
+    Returns the name of the blob an AttachmentUploads entity uploads to, PDFs
+    are uploaded to the pending prefix to be flattened
+    """
+    if upload["content_type"] == "application/pdf":
+        return f"{PENDING_ATTACHMENTS_PREFIX}/{upload['name']}"
+
+    return f"{ATTACHMENTS_PREFIX}/{upload['name']}"
+
+
+class UploadCleanup:
+    """
+    Process-wide cleanup of abandoned resumable uploads
+
+    An upload expires expiry seconds after it was started, well within the
+    week Cloud Storage keeps a resumable upload session. Once every interval
+    the AttachmentUploads entities of expired uploads are deleted. An upload
+    that Cloud Storage completed, but that was never added to its expense,
+    has its blob deleted as well.
+    """
+
+    def __init__(
+        self,
+        expiry=DEFAULT_ATTACHMENT_UPLOAD_EXPIRY,
+        interval=DEFAULT_ATTACHMENT_UPLOAD_CLEANUP_INTERVAL,
+    ):
+        self.expiry = expiry
+        self.interval = interval
+
+        self._last_run = None
+        self._lock = threading.Lock()
+
+    def _expired_before(self):
+        return datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            seconds=self.expiry
+        )
+
+    def is_expired(self, upload):
+        """Returns whether an AttachmentUploads entity has expired"""
+        return upload["created"] < self._expired_before()
+
+    def run_if_due(self, ds_client, bucket):
+        """Runs the cleanup when it did not run for interval seconds"""
+        now = time.monotonic()
+        with self._lock:
+            if self._last_run is not None and now - self._last_run < self.interval:
+                return
+            self._last_run = now
+
+        try:
+            self.run(ds_client, bucket)
+        except Exception:
+            logging.exception("Cleaning up the expired attachment uploads failed")
+
+    def run(self, ds_client, bucket):
+        """
+        Deletes the expired uploads, at most UPLOAD_CLEANUP_BATCH_SIZE at a time
+        :param ds_client: Datastore client
+        :param bucket: attachments bucket
+        :return: number of deleted uploads
+        """
+        query = ds_client.query(kind=ATTACHMENT_UPLOAD_KIND)
+        query.add_filter("created", "<", self._expired_before())
+
+        keys = []
+        for upload in query.fetch(limit=UPLOAD_CLEANUP_BATCH_SIZE):
+            if not upload.get("completed"):
+                try:
+                    if (
+                        get_persisted_size(upload["session_url"], upload["size"])
+                        == upload["size"]
+                    ):
+                        bucket.blob(upload_blob_name(upload)).delete()
+                except (UploadSessionNotFound, gcp_exceptions.NotFound):
+                    pass
+                except Exception:
+                    logging.exception(f"Cleaning up upload '{upload['name']}' failed")
+                    continue
+
+            keys.append(upload.key)
+
+        if keys:
+            ds_client.delete_multi(keys)
+            logging.info(f"Deleted {len(keys)} expired attachment uploads")
+
+        return len(keys)
+
+
+upload_cleanup = UploadCleanup(
+    expiry=getattr(
+        config, "ATTACHMENT_UPLOAD_EXPIRY", DEFAULT_ATTACHMENT_UPLOAD_EXPIRY
+    ),
+    interval=getattr(
+        config,
+        "ATTACHMENT_UPLOAD_CLEANUP_INTERVAL",
+        DEFAULT_ATTACHMENT_UPLOAD_CLEANUP_INTERVAL,
+    ),
+)
@@ -0,0 +1,64 @@
+import logging
+import threading
+
+from flask import g, has_app_context
+
+
+class BucketHandles:
+    """
+    Process-wide handles of Cloud Storage buckets, keyed by bucket name
+
+    client.get_bucket does a metadata GET on the bucket for every call, while
+    the controllers only need a handle to name blobs and list them. Handles are
+    built with client.bucket, which does no request, and are shared between
+    requests as long as the same client is used. Every handle that is handed
+    out is a bucket metadata call that is no longer made, these are counted per
+    request on flask.g and for the process.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def get(self, cs_client, bucket_name):
+        """
+        Returns a handle of a bucket, without checking that it exists
+        :param cs_client: Cloud Storage client
+        :param bucket_name: name of the bucket
+        :return: google.cloud.storage.Bucket
+        """
+        with self._lock:
+            bucket = self._buckets.get(bucket_name)
+            if bucket is not None and bucket.client is cs_client:
+                self.hits += 1
+            else:
+                self.misses += 1
+                bucket = self._buckets[bucket_name] = cs_client.bucket(bucket_name)
+
+        if has_app_context():
+            g.storage_metadata_calls_saved = (
+                g.get("storage_metadata_calls_saved", 0) + 1
+            )
+
+        return bucket
+
+    def invalidate(self):
+        """Drops the handles, they are built again on the next use"""
+        with self._lock:
+            self._buckets = {}
+
+        logging.info(f"Bucket handles invalidated: {self.stats()}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "metadata_calls_saved": self.hits + self.misses,
+            }
+
+
+bucket_handles = BucketHandles()
@@ -3,7 +3,7 @@ import inspect
 
 from datetime import datetime
 from openapi_server.models.expense_data import ExpenseData
-from google.cloud import datastore
+from openapi_server.controllers.client_registry import client_registry
 
 
 class BusinessRulesEngine:
@@ -12,8 +12,14 @@ class BusinessRulesEngine:
 
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, ds_client=None):
+        self._ds_client = ds_client
+
+    @property
+    def ds_client(self):
+        if self._ds_client is None:
+            self._ds_client = client_registry.get_datastore()
+        return self._ds_client
 
     def process_rules(self, data, employee, expense=None):
         self.pao_rule(data, employee)
@@ -40,8 +46,6 @@ class BusinessRulesEngine:
             raise ValueError("Dit account is niet meer actief")
 
     def duplicate_rule(self, modified_data, employee, original_expense=None):
-        ds = datastore.Client()
-
         # Values when expense is new (original_expense = None)
         check_amount = modified_data.get("amount", "")
         check_date = modified_data.get("transaction_date", "")
@@ -53,7 +57,7 @@ class BusinessRulesEngine:
             check_date = modified_data.get("transaction_date", original_expense["transaction_date"])
             expense_id = original_expense.id
 
-        expenses_ds = ds.query(kind="Expenses")
+        expenses_ds = self.ds_client.query(kind="Expenses")
 
         expenses_ds.add_filter("transaction_date", "=", check_date)
         expenses_ds.add_filter("employee.afas_data.email_address", "=", employee["email_address"])
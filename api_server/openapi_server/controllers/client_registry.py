@@ -0,0 +1,85 @@
+import logging
+import threading
+
+import firebase_admin
+from google.cloud import datastore, storage
+
+
+def get_firebase_app():
+    """Returns the default Firebase app, initializing it when there is none"""
+    if len(firebase_admin._apps) <= 0:
+        return firebase_admin.initialize_app()
+
+    return firebase_admin.get_app()
+
+
+class ClientRegistry:
+    """
+    Process-wide Datastore, Cloud Storage and Firebase clients
+
+    Building a client discovers the credentials and sets up its own gRPC
+    channel or HTTP connection pool, so every client is built once and shared
+    by all requests, the controllers and the business rules. The Datastore
+    client keeps its transactions per thread, so sharing it between request
+    threads is safe.
+    """
+
+    def __init__(
+        self,
+        datastore_factory=datastore.Client,
+        storage_factory=storage.Client,
+        firebase_factory=get_firebase_app,
+    ):
+        self.created = 0
+
+        self._factories = {
+            "datastore": datastore_factory,
+            "storage": storage_factory,
+            "firebase": firebase_factory,
+        }
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name):
+        client = self._clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(name)
+                if client is None:
+                    client = self._clients[name] = self._factories[name]()
+                    self.created += 1
+
+        return client
+
+    def get_datastore(self):
+        """:return: google.cloud.datastore.Client"""
+        return self._get("datastore")
+
+    def get_storage(self):
+        """:return: google.cloud.storage.Client"""
+        return self._get("storage")
+
+    def get_firebase_app(self):
+        """:return: firebase_admin.App"""
+        return self._get("firebase")
+
+    def initialize(self):
+        """Builds all clients, so the first request does not have to"""
+        for name in self._factories:
+            self._get(name)
+
+        logging.info(f"Clients initialized: {', '.join(self._factories)}")
+
+    def reset(self):
+        """Drops the clients, they are built again on the next use"""
+        with self._lock:
+            self._clients = {}
+
+        logging.info(f"Client registry reset: {self.stats()}")
+
+    def stats(self):
+        with self._lock:
+            return {"created": self.created, "clients": sorted(self._clients)}
+
+
+client_registry = ClientRegistry()
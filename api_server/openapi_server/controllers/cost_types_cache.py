@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+
+import config
+
+DEFAULT_COST_TYPES_CACHE_TTL = 300  # seconds
+
+
+class CostTypesCache:
+    """
+    Process-wide cache of the CostTypes kind, keyed by key.name
+
+    CostTypes are reference data that hardly ever change, so the whole kind is
+    fetched once and shared between requests. They are maintained outside this
+    API, so COST_TYPES_CACHE_TTL is the only bound on how long an edit takes to
+    show.
+    """
+
+    def __init__(self, ttl=DEFAULT_COST_TYPES_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._cost_types = None
+        self._index = None
+        self._expires_at = 0.0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _load(self, ds_client):
+        with self._lock:
+            if self._cost_types is not None and time.monotonic() < self._expires_at:
+                self.hits += 1
+                return self._cost_types, self._index
+
+            self.misses += 1
+            generation = self._generation
+
+        cost_types = {
+            cost_type.key.name: cost_type
+            for cost_type in ds_client.query(kind="CostTypes").fetch()
+        }
+        index = {
+            name: (cost_type, cost_type.get("Active", False))
+            for name, cost_type in cost_types.items()
+        }
+
+        with self._lock:
+            # Do not store a result that was fetched before an invalidation
+            if generation == self._generation:
+                self._cost_types = cost_types
+                self._index = index
+                self._expires_at = time.monotonic() + self.ttl
+
+        return cost_types, index
+
+    def get_all(self, ds_client):
+        """
+        Returns all cost types as a dict of key.name to entity
+        :param ds_client: Datastore client used when the cache has to be (re)filled
+        :return: dict
+        """
+        return self._load(ds_client)[0]
+
+    def get_index(self, ds_client):
+        """
+        Returns all cost types as a dict of key.name to a tuple (entity, active)
+        :param ds_client: Datastore client used when the cache has to be (re)filled
+        :return: dict
+        """
+        return self._load(ds_client)[1]
+
+    def get(self, ds_client, cost_type_id):
+        """
+        Returns a single cost type entity or None when it does not exist
+        :param ds_client: Datastore client used when the cache has to be (re)filled
+        :param cost_type_id: key.name of the cost type
+        """
+        return self.get_all(ds_client).get(cost_type_id)
+
+    def invalidate(self):
+        """
+        Drops the cached cost types, the next lookup will query Datastore. Used
+        to isolate tests, as nothing in this API writes CostTypes.
+        """
+        with self._lock:
+            self._cost_types = None
+            self._index = None
+            self._expires_at = 0.0
+            self._generation += 1
+
+        logging.info(f"CostTypes cache invalidated: {self.stats()}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._cost_types) if self._cost_types is not None else 0,
+            }
+
+
+cost_types_cache = CostTypesCache(
+    ttl=getattr(config, "COST_TYPES_CACHE_TTL", DEFAULT_COST_TYPES_CACHE_TTL)
+)
@@ -1,29 +1,29 @@
 import base64
+import collections
+import concurrent.futures
 import copy
 import csv
 import datetime
 import hashlib
+import heapq
 import io
+import itertools
 import json
 import logging
 import os
 import re
+import secrets
 import tempfile
-import xml.etree.cElementTree as ET  # nosec
 from abc import abstractmethod
 from decimal import Decimal
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from io import BytesIO
 from typing import Any, Dict
 
 import config
 import connexion
 import dateutil
 import defusedxml.minidom as MD
-import firebase_admin
-import google.auth
-import googleapiclient.discovery
 import pandas as pd
 import pytz
 import requests
@@ -31,25 +31,67 @@ import unidecode
 from apiclient import errors
 from defusedxml import defuse_stdlib
 from firebase_admin import messaging as fb_messaging
-from flask import Response, g, jsonify, make_response, request, send_file
-from google.cloud import datastore, secretmanager_v1, storage
-from openapi_server.auth import get_delegated_credentials
+from flask import (Response, g, jsonify, make_response, request,
+                   stream_with_context)
+from google.api_core import exceptions as gcp_exceptions
+from google.cloud import datastore
+from openapi_server.controllers.afas_employee_cache import afas_employee_cache
+from openapi_server.controllers.afas_index import get_afas_employee
+from openapi_server.controllers.attachment_processing import (
+    ATTACHMENT_STATUS_PENDING, ATTACHMENT_STATUS_PROCESSED, ATTACHMENTS_PREFIX,
+    PENDING_ATTACHMENTS_PREFIX, attachment_processor, attachment_status)
+from openapi_server.controllers.attachment_uploads import (
+    ATTACHMENT_UPLOAD_KIND, DEFAULT_ATTACHMENT_UPLOAD_CHUNK_SIZE,
+    DEFAULT_ATTACHMENT_UPLOAD_MAX_SIZE, UPLOAD_CHUNK_ALIGNMENT,
+    UploadSessionNotFound, get_persisted_size, parse_content_range,
+    upload_blob_name, upload_chunk, upload_cleanup)
+from openapi_server.controllers.bucket_handles import bucket_handles
 from openapi_server.controllers.businessrules_controller import \
     BusinessRulesEngine
+from openapi_server.controllers.client_registry import client_registry
+from openapi_server.controllers.cost_types_cache import cost_types_cache
+from openapi_server.controllers.expense_ids import expense_ids
+from openapi_server.controllers.expense_summaries import (build_expense_summary,
+                                                          expenses_list_kind)
+from openapi_server.controllers.gmail_service import gmail_service_factory
+from openapi_server.controllers.mail_template import get_mail_template
+from openapi_server.controllers.manager_inbox import (
+    inbox_key, is_complete, lease_coordinator_inboxes, update_manager_inboxes)
+from openapi_server.controllers.notification_queue import notification_queue
+from openapi_server.controllers.payment_file import generate_payment_file
+from openapi_server.controllers.power2pay_session import power2pay_session
+from openapi_server.controllers.signing_credentials import signing_credentials
 from openapi_server.controllers.translate_responses import \
     make_response_translated
 from openapi_server.models.attachment_data import AttachmentData
 from openapi_server.models.employee_profile import \
     EmployeeProfile  # noqa: E501
 from openapi_server.models.expense_data import ExpenseData
-from OpenSSL import crypto
-from pikepdf import Pdf
 
 logger = logging.getLogger(__name__)
 defuse_stdlib()
 
 # Constants
 EXPORTABLE_STATUSES = ["approved"]
+CSV_STREAM_CHUNK_SIZE = 64 * 1024  # Characters buffered before a CSV chunk is sent
+EXPORT_QUERY_PAGE_SIZE = 500
+EXPORT_CHUNK_SIZE = 166  # Expenses per commit, each writes 3 entities (max. 500)
+EXPORT_MAX_WORKERS = 4
+EXPORT_COMMIT_ATTEMPTS = 3
+UPDATE_COMMIT_ATTEMPTS = 3
+MANAGER_INBOX_MAX_WORKERS = 4
+DEFAULT_MANAGER_INBOX_PAGE_SIZE = 50
+ATTACHMENT_DOWNLOAD_WORKERS = 4
+ATTACHMENT_ENCODE_CHUNK_SIZE = 3 * 64 * 1024  # Multiple of 3, so chunks need no padding
+DEFAULT_ATTACHMENT_SIGNED_URL_EXPIRATION = 300  # seconds
+ATTACHMENT_SIGNING_WORKERS = 4
+ATTACHMENT_CONTENT_TYPES = ["image/png", "image/jpeg", "image/jpg", "application/pdf"]
+ATTACHMENT_UPLOAD_ID_BYTES = 24
+DATASTORE_LOOKUP_LIMIT = 1000  # Keys per get_multi
+PAYMENT_FILE_SPOOL_SIZE = 1024 * 1024  # Bytes kept in memory before spooling to disk
+ISO_DATE_PATTERN = (
+    r"\d{4}-\d{2}-\d{2}(?:T\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?(?:Z|[+-]\d{2}:?\d{2})?$"
+)
 VWT_TIME_ZONE = "Europe/Amsterdam"
 FILTERED_OUT_ON_PROCESS = [
     "approved",
@@ -106,14 +148,10 @@ class ClaimExpenses:
 
     """
 
-    def __init__(self):
-        if len(firebase_admin._apps) <= 0:
-            self.fb_app = firebase_admin.initialize_app()  # Firebase
-        else:
-            self.fb_app = firebase_admin.get_app()  # Firebase
-
-        self.ds_client = datastore.Client()  # Datastore
-        self.cs_client = storage.Client()  # CloudStores
+    def __init__(self, clients=client_registry):
+        self.fb_app = clients.get_firebase_app()  # Firebase
+        self.ds_client = clients.get_datastore()  # Datastore
+        self.cs_client = clients.get_storage()  # CloudStores
         self.employee_info = g.token
         self.bucket_name = config.GOOGLE_STORAGE_BUCKET
 
@@ -137,45 +175,39 @@ class ClaimExpenses:
                 f"Could not transform unique name '{unique_name}' to lowercase"
             )
         else:
-            employees = self._query_afas_employee_on_field("upn", unique_name)
-
-            # NOTE: this is a temporary fallback query for Recognize accounts (DAT-7510)
-            if not employees:
-                employees = self._query_afas_employee_on_field("email_address", unique_name)
+            return afas_employee_cache.get(
+                unique_name, lambda: self._query_afas_employee(unique_name)
+            )
+        return None
 
-            if employees and len(employees) == 1:
-                return dict(employees[0].items())
+    def _query_afas_employee(self, unique_name):
+        employee = get_afas_employee(self.ds_client, "upn", unique_name)
 
-            logging.warning(f"No detail of {unique_name} found in HRM -AFAS")
-        return None
+        # NOTE: this is a temporary fallback query for Recognize accounts (DAT-7510)
+        if not employee:
+            employee = get_afas_employee(self.ds_client, "email_address", unique_name)
 
-    def _query_afas_employee_on_field(self, field: str, value, limit: int = 1) -> list:
-        """
-        Returns a list of all employees that match the 'equals' query.
+        if employee:
+            return dict(employee.items())
 
-        :param field: name of the database field to check.
-        :type field: str
-        :param value: passing value of the field in the database.
-        :type value: any
-        :param limit: limit on returned employees
+        logging.warning(f"No detail of {unique_name} found in HRM -AFAS")
+        return None
 
-        :return: a list of all employees that match the 'equals' query.
-        :rtype: list
-        """
-        query = self.ds_client.query(kind="AFAS_HRM")
-        query.add_filter(field, "=", value)
-        return list(query.fetch(limit=limit))
+    @staticmethod
+    def _attachment_filename(name):
+        """Prefixes the name of an uploaded attachment with the upload time"""
+        today = pytz.UTC.localize(datetime.datetime.now())
+        return (
+            f"{today.hour:02d}:{today.minute:02d}:{today.second:02d}-{today.year}{today.month}{today.day}"
+            f"-{name}"
+        )
 
     def create_attachment(self, attachment, expenses_id, email):
         """Creates an attachment"""
-        today = pytz.UTC.localize(datetime.datetime.now())
         email_name = email.split("@")[0]
-        filename = (
-            f"{today.hour:02d}:{today.minute:02d}:{today.second:02d}-{today.year}{today.month}{today.day}"
-            f"-{attachment.name}"
-        )
-        bucket = self.cs_client.get_bucket(self.bucket_name)
-        blob = bucket.blob(f"exports/attachments/{email_name}/{expenses_id}/{filename}")
+        filename = self._attachment_filename(attachment.name)
+        bucket = bucket_handles.get(self.cs_client, self.bucket_name)
+        name = f"{email_name}/{expenses_id}/{filename}"
 
         try:
             if "," not in attachment.content:
@@ -190,31 +222,41 @@ class ClaimExpenses:
                 return False
             content_type = content_type.group()
             if content_type == "application/pdf":
-                # If a PDF is uploaded, we will process it first
-                # by flattening its annotations (e.g. images, links, videos, etc.).
-                pdf = Pdf.open(
-                    io.BytesIO(content)
-                )  # Creating PDF representation from content bytes.
-                pdf.flatten_annotations()  # Flattening annotations.
-
-                pdf_stream = io.BytesIO()  # Create a new stream to save the data to.
-                pdf.save(pdf_stream)  # Save the PDF to the new stream.
-
-                pdf_stream.seek(0)  # Reset stream index so we can read from start.
-                content = pdf_stream.read()  # Read stream.
-
-                pdf_stream.close()
-                pdf.close()
-
+                # If a PDF is uploaded, its annotations (e.g. images, links, videos,
+                # etc.) are flattened by a background worker. Until then the raw
+                # upload is stored under the pending prefix.
+                blob = bucket.blob(f"{PENDING_ATTACHMENTS_PREFIX}/{name}")
+                blob.metadata = {"status": ATTACHMENT_STATUS_PENDING}
+                status = ATTACHMENT_STATUS_PENDING
+            else:
+                blob = bucket.blob(f"{ATTACHMENTS_PREFIX}/{name}")
+                status = ATTACHMENT_STATUS_PROCESSED
             blob.upload_from_string(
-                content,  # Upload content (can be decoded b64 from request or read data from temp flat file)
+                content,  # Upload content decoded from the b64 in the request
                 content_type=content_type,
             )
-            return True
         except Exception:
             logging.exception("Something went wrong with the attachment upload")
             return False
 
+        if not self._add_uploaded_attachment(
+            expenses_id,
+            blob,
+            {
+                "name": filename,
+                "content_type": content_type,
+                "size": len(content),
+                "status": status,
+            },
+        ):
+            return False
+
+        if status == ATTACHMENT_STATUS_PENDING:
+            attachment_processor.submit(
+                bucket, name, content, content_type, self._set_attachment_status
+            )
+        return True
+
     def delete_attachment(self, expenses_id, attachments_name):
         """
         Deletes attachment based on expense id and attachment name
@@ -231,22 +273,122 @@ class ClaimExpenses:
         if expense["employee"]["email"] != self.employee_info["unique_name"]:
             return make_response_translated("Geen overeenkomst op e-mail", 403)
 
-        bucket = self.cs_client.get_bucket(self.bucket_name)
-        blob = bucket.blob(
-            f"exports/attachments/{email_name}/{expenses_id}/{attachments_name}"
-        )
+        bucket = bucket_handles.get(self.cs_client, self.bucket_name)
+        name = f"{email_name}/{expenses_id}/{attachments_name}"
 
-        blob.delete()
+        try:
+            bucket.blob(f"{ATTACHMENTS_PREFIX}/{name}").delete()
+        except gcp_exceptions.NotFound:
+            # PDFs are kept under the pending prefix until they are processed
+            bucket.blob(f"{PENDING_ATTACHMENTS_PREFIX}/{name}").delete()
+
+        self._update_attachments(expenses_id, removed=attachments_name)
 
         return make_response("", 204)
 
+    def _list_attachments(self, expense):
+        """
+        Lists the attachments of an expense in Cloud Storage, used for expenses
+        that were created before their attachments were kept on the entity
+        :return: list of dicts with the "name", "content_type", "size" and "status"
+        """
+        email_name = expense["employee"]["email"].split("@")[0]
+        expenses_bucket = bucket_handles.get(self.cs_client, self.bucket_name)
+
+        attachments = {}
+        for prefix in [ATTACHMENTS_PREFIX, PENDING_ATTACHMENTS_PREFIX]:
+            for blob in expenses_bucket.list_blobs(
+                prefix=f"{prefix}/{email_name}/{str(expense.key.id)}"
+            ):
+                attachments.setdefault(
+                    blob.name.split("/")[-1],
+                    {
+                        "name": blob.name.split("/")[-1],
+                        "content_type": blob.content_type,
+                        "size": blob.size,
+                        "status": attachment_status(blob),
+                    },
+                )
+
+        return list(attachments.values())
+
+    def _update_attachments(self, expenses_id, added=None, removed=None, status=None):
+        """
+        Keeps the attachments on the expense, so checking whether it has any
+        does not need a Cloud Storage list call
+        :param expenses_id:
+        :param added: dict with the "name", "content_type", "size" and "status" of a
+            new attachment
+        :param removed: name of a deleted attachment
+        :param status: (name, status) of an attachment that was processed
+        """
+        expense_key = self.ds_client.key("Expenses", expenses_id)
+
+        # Older expenses have their attachments listed once, outside the
+        # transaction so it is not held open during the Cloud Storage call
+        expense = self.ds_client.get(expense_key)
+        if not expense:
+            return
+        listed = None if "attachments" in expense else self._list_attachments(expense)
+
+        with self.ds_client.transaction():
+            expense = self.ds_client.get(expense_key)
+            if not expense:
+                return
+
+            attachments = [
+                attachment
+                for attachment in expense.get("attachments", listed or [])
+                if attachment["name"] not in (removed, added and added["name"])
+            ]
+            if added:
+                attachments.append(added)
+            if status:
+                for attachment in attachments:
+                    if attachment["name"] == status[0]:
+                        attachment["status"] = status[1]
+
+            expense["attachments"] = attachments
+            expense.exclude_from_indexes.add("attachments")
+            self.ds_client.put(expense)
+
+    def _add_uploaded_attachment(self, expenses_id, blob, added):
+        """
+        Adds an uploaded attachment to the expense, the blob is deleted again
+        when the expense can not be updated so it is not left unreferenced
+        :return: True when the attachment was added
+        """
+        try:
+            self._update_attachments(expenses_id, added=added)
+        except Exception:
+            logging.exception(f"Adding attachment '{blob.name}' to the expense failed")
+
+            try:
+                blob.delete()
+            except Exception:
+                logging.exception(f"Deleting attachment '{blob.name}' failed")
+
+            return False
+
+        return True
+
+    def _set_attachment_status(self, name, status):
+        """
+        Keeps the status of a processed PDF on its expense, called by the
+        attachment processor
+        :param name: attachment name as "<email name>/<expense id>/<filename>"
+        :param status:
+        """
+        email_name, expenses_id, filename = name.split("/")
+        self._update_attachments(int(expenses_id), status=(filename, status))
+
     def get_cost_types(self):
         """
         Get cost types from a CSV file
         :return:
         """
 
-        cost_types = self.ds_client.query(kind="CostTypes").fetch()
+        cost_types = cost_types_cache.get_all(self.ds_client).values()
 
         if cost_types:
             results = [
@@ -291,6 +433,9 @@ class ClaimExpenses:
             else None
         )
 
+        # Make sure cost types are not queried as part of the transaction
+        cost_types_cache.get_all(self.ds_client)
+
         with self.ds_client.transaction(read_only=True):
             exp_key = self.ds_client.key("Expenses", expenses_id)
             expense = self.ds_client.get(exp_key)
@@ -345,8 +490,14 @@ class ClaimExpenses:
     def _check_attachment_permission(self, expense):
         pass
 
-    def get_attachment(self, expenses_id):
-        """Get attachments with expenses_id"""
+    def get_attachment(self, expenses_id, mode="content"):
+        """
+        Get attachments with expenses_id
+        :param expenses_id:
+        :param mode: "content" to return the base64 encoded attachments,
+        "signed_url" to return short-lived signed urls to the attachments
+        :return:
+        """
         with self.ds_client.transaction(read_only=True):
             exp_key = self.ds_client.key("Expenses", expenses_id)
             expense = self.ds_client.get(exp_key)
@@ -358,23 +509,95 @@ class ClaimExpenses:
 
         email_name = expense["employee"]["email"].split("@")[0]
 
-        expenses_bucket = self.cs_client.get_bucket(self.bucket_name)
-        blobs = expenses_bucket.list_blobs(
-            prefix=f"exports/attachments/{email_name}/{str(expenses_id)}"
+        expenses_bucket = bucket_handles.get(self.cs_client, self.bucket_name)
+        blobs = list(
+            expenses_bucket.list_blobs(
+                prefix=f"{ATTACHMENTS_PREFIX}/{email_name}/{str(expenses_id)}"
+            )
         )
-        results = []
-        for blob in blobs:
-            content = blob.download_as_string()
-            stream = BytesIO(content)
-            stream_read = base64.b64encode(stream.read(len(content)))
-            content_result = {
-                "content_type": blob.content_type,
-                "content": stream_read.decode("utf-8"),
+        pending_blobs = self._get_pending_attachments(
+            expenses_bucket, email_name, expenses_id, blobs
+        )
+
+        if mode == "signed_url":
+            return jsonify(
+                self._get_attachment_signed_urls(blobs)
+                + [self._get_pending_attachment(blob) for blob in pending_blobs]
+            )
+
+        # No Content-Length is set, so the JSON is sent with chunked transfer encoding
+        return Response(
+            stream_with_context(generate_attachments_json(blobs, pending_blobs)),
+            mimetype="application/json",
+        )
+
+    @staticmethod
+    def _get_pending_attachments(bucket, email_name, expenses_id, blobs):
+        """
+        Returns the PDFs that are not processed yet, a PDF can be listed under
+        both prefixes for a moment after it is processed
+        """
+        processed = {blob.name.split("/")[-1] for blob in blobs}
+
+        return [
+            blob
+            for blob in bucket.list_blobs(
+                prefix=f"{PENDING_ATTACHMENTS_PREFIX}/{email_name}/{str(expenses_id)}"
+            )
+            if blob.name.split("/")[-1] not in processed
+        ]
+
+    @staticmethod
+    def _get_pending_attachment(blob):
+        """Pending attachments are listed without their content"""
+        return {
+            "name": blob.name.split("/")[-1],
+            "content_type": blob.content_type,
+            "size": blob.size,
+            "status": attachment_status(blob),
+        }
+
+    def _get_attachment_signed_urls(self, blobs):
+        """
+        Creates V4 signed urls to download the attachments from Cloud Storage
+        :param blobs: attachment blobs
+        :return: list of attachments with their url, content type and size
+        """
+        expiration = datetime.timedelta(
+            seconds=getattr(
+                config,
+                "ATTACHMENT_SIGNED_URL_EXPIRATION",
+                DEFAULT_ATTACHMENT_SIGNED_URL_EXPIRATION,
+            )
+        )
+        expires = datetime.datetime.utcnow() + expiration
+        signing_arguments = signing_credentials.get_signing_arguments()
+
+        def sign(blob):
+            return blob.generate_signed_url(
+                version="v4", expiration=expiration, method="GET", **signing_arguments
+            )
+
+        if signing_arguments and len(blobs) > 1:
+            # Every url is signed by a request to the IAM API of its own
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=ATTACHMENT_SIGNING_WORKERS
+            ) as executor:
+                urls = list(executor.map(sign, blobs))
+        else:
+            urls = [sign(blob) for blob in blobs]
+
+        return [
+            {
                 "name": blob.name.split("/")[-1],
+                "content_type": blob.content_type,
+                "size": blob.size,
+                "url": url,
+                "expires": expires.isoformat(timespec="seconds") + "Z",
+                "status": attachment_status(blob),
             }
-            results.append(content_result)
-
-        return jsonify(results)
+            for blob, url in zip(blobs, urls)
+        ]
 
     @abstractmethod
     def get_all_expenses(self):
@@ -451,6 +674,7 @@ class ClaimExpenses:
                             + "Z",
                             "status": dict(export_date="never", text=ready_text),
                             "manager_type": data.manager_type,
+                            "attachments": [],
                         }
                     except KeyError:
                         return make_response_translated("Er ging iets fout", 400)
@@ -462,14 +686,15 @@ class ClaimExpenses:
                         if isinstance(data, ExpenseData)
                         else data
                     )
-                    BusinessRulesEngine().duplicate_rule(modified_data, afas_data)
+                    BusinessRulesEngine(self.ds_client).duplicate_rule(
+                        modified_data, afas_data
+                    )
                     if "flags" in modified_data:
                         new_expense["flags"] = modified_data["flags"]
                         response["flags"] = modified_data["flags"]
 
                     entity.update(new_expense)
-                    self.ds_client.put(entity)
-                    self.expense_journal({}, entity)
+                    self._put_expense(entity, old_expense={})
 
                     response["id"] = entity.key.id_or_name
 
@@ -540,89 +765,39 @@ class ClaimExpenses:
                     "Sommige gegevens ontbraken of waren onjuist", 400
                 )
 
-        with self.ds_client.transaction():
-            exp_key = self.ds_client.key("Expenses", expenses_id)
-            expense = self.ds_client.get(exp_key)
-            old_expense = copy.deepcopy(expense)
-
-            if not expense:
-                return make_response_translated("Declaratie niet gevonden", 404)
-
-            # Check validity cost-type
-            cost_type_entity, cost_type_active = self._process_cost_type(
-                data.get("cost_type", expense["cost_type"])
-            )
-            if "cost_type" in data:
-                if cost_type_entity is None or not cost_type_active:
-                    return make_response_translated("Geen geldige kostensoort", 400)
-                data["cost_type"] = cost_type_entity.key.name
-
-            if (
-                expense["status"]["text"] == "draft"
-                or "rejected" in expense["status"]["text"]
-            ) and "ready" in data.get("status", ""):
-
-                if len(data) > 1:
-                    return make_response_translated(
-                        "Het indienen van een declaratie is niet toegestaan tijdens het aanpassen van velden",
-                        403,
-                    )
-
-                data["min_amount"] = cost_type_entity.get("MinAmount", 50)
-                if data["min_amount"] == 0 or data["min_amount"] <= data.get(
-                    "amount", expense["amount"]
-                ):
-                    data["status"] = "ready_for_manager"
-                else:
-                    data["status"] = "ready_for_creditor"
-
-            allowed_fields, allowed_statuses = self._prepare_context_update_expense(
-                expense
-            )
-            if not allowed_fields or not allowed_statuses:
-                return make_response_translated(
-                    "De inhoud van deze methode is niet geldig", 403
-                )
+        # Make sure cost types are not queried as part of the transaction
+        cost_types_cache.get_all(self.ds_client)
 
+        exp_key = self.ds_client.key("Expenses", expenses_id)
+        for attempt in range(1, UPDATE_COMMIT_ATTEMPTS + 1):
+            update = copy.deepcopy(data)
             try:
-                BusinessRulesEngine().employed_rule(expense["employee"]["afas_data"])
-                BusinessRulesEngine().pao_rule(data, expense["employee"]["afas_data"])
-                data["manager_type"] = cost_type_entity.get(
-                    "ManagerType", "linemanager"
+                # Transactions are optimistic: the commit fails with a conflict when
+                # the expense or an inbox it moves between was changed after it was
+                # read, the lease coordinators' inbox is sharded to make that rare
+                with self.ds_client.transaction():
+                    expense = self.ds_client.get(exp_key)
+                    old_expense = copy.deepcopy(expense)
+
+                    if not expense:
+                        return make_response_translated("Declaratie niet gevonden", 404)
+
+                    error = self._apply_expense_update(expense, old_expense, update)
+            except gcp_exceptions.Conflict as exception:
+                logging.warning(
+                    f"Updating expense {expenses_id} conflicted on attempt "
+                    f"{attempt}: {exception}"
                 )
-            except ValueError as exception:
-                return make_response_translated(str(exception), 400)
-
-            if not self._has_attachments(expense, data):
-                return make_response_translated(
-                    "De declaratie moet minimaal één bijlage hebben", 403
-                )
-
-            if "rnote_id" in data:
-                rnote_id, rnote = self._process_rejection_note(
-                    data.get("rnote_id"), data.get("rnote")
-                )
-                if not rnote_id or not rnote:
-                    return make_response_translated("Geen geldige afwijzing", 400)
-                data["rnote_id"] = rnote_id
-                data["rnote"] = rnote
-
-            BusinessRulesEngine().duplicate_rule(
-                data, expense["employee"]["afas_data"], expense
-            )
-            # If there are no warnings to display: remove flags property from entity
-            if "flags" not in data and "flags" in expense:
-                del expense["flags"]
-
-            valid_update = self._update_expenses(
-                data, allowed_fields, allowed_statuses, expense
+            else:
+                break
+        else:
+            return make_response_translated(
+                "Declaratie is tegelijkertijd gewijzigd, probeer het opnieuw", 409
             )
-            if not valid_update:
-                return make_response_translated(
-                    "De inhoud van deze methode is niet geldig", 403
-                )
 
-            self.expense_journal(old_expense, expense)
+        if error:
+            return error
+        data = update
 
         if data["status"] in [
             "rejected_by_manager",
@@ -631,7 +806,9 @@ class ClaimExpenses:
             "ready_for_manager",
             "ready_for_creditor",
         ]:
-            self.send_notification(
+            notification_queue.enqueue(
+                f"'rejected_expense' for expense '{expense.key.id_or_name}'",
+                self.send_notification,
                 "rejected_expense",
                 expense["employee"]["afas_data"],
                 expense.key.id_or_name,
@@ -640,7 +817,9 @@ class ClaimExpenses:
         elif data["status"] == "ready_for_manager" and old_expense["status"][
             "text"
         ] in ["draft", "rejected_by_manager", "rejected_by_creditor"]:
-            self.send_notification(
+            notification_queue.enqueue(
+                f"'assess_expense' for expense '{expense.key.id_or_name}'",
+                self.send_notification,
                 "assess_expense",
                 expense["employee"]["afas_data"],
                 expense.key.id_or_name,
@@ -651,7 +830,130 @@ class ClaimExpenses:
             jsonify(self._prepare_response_update_expense(expense)), 200
         )
 
-    def _update_expenses(self, data, allowed_fields, allowed_statuses, expense):
+    def _apply_expense_update(self, expense, old_expense, data):
+        """
+        Validates the update of an expense and stores it, must be called in the
+        transaction the expense was read in
+        :param expense: Expenses entity, it is updated in place
+        :param old_expense: copy of the expense before the update
+        :param data: the update, it is completed with the derived fields
+        :return: error response, None when the expense was updated
+        """
+        cost_type_entity, error = self._apply_cost_type(expense, data)
+        if error:
+            return error
+
+        error = self._apply_status_transition(expense, data, cost_type_entity)
+        if error:
+            return error
+
+        allowed_fields, allowed_statuses = self._prepare_context_update_expense(expense)
+        if not allowed_fields or not allowed_statuses:
+            return make_response_translated(
+                "De inhoud van deze methode is niet geldig", 403
+            )
+
+        try:
+            BusinessRulesEngine().employed_rule(expense["employee"]["afas_data"])
+            BusinessRulesEngine().pao_rule(data, expense["employee"]["afas_data"])
+            data["manager_type"] = cost_type_entity.get("ManagerType", "linemanager")
+        except ValueError as exception:
+            return make_response_translated(str(exception), 400)
+
+        if not self._has_attachments(expense, data):
+            return make_response_translated(
+                "De declaratie moet minimaal één bijlage hebben", 403
+            )
+
+        if "rnote_id" in data and not self._apply_rejection_note(data):
+            return make_response_translated("Geen geldige afwijzing", 400)
+
+        BusinessRulesEngine(self.ds_client).duplicate_rule(
+            data, expense["employee"]["afas_data"], expense
+        )
+        # If there are no warnings to display: remove flags property from entity
+        if "flags" not in data and "flags" in expense:
+            del expense["flags"]
+
+        valid_update = self._update_expenses(
+            data, allowed_fields, allowed_statuses, expense, old_expense
+        )
+        if not valid_update:
+            return make_response_translated(
+                "De inhoud van deze methode is niet geldig", 403
+            )
+
+        return None
+
+    def _apply_rejection_note(self, data):
+        """
+        Completes the rejection note of an update from the known rejection notes
+        :param data: the update, its rnote_id and rnote are set
+        :return: False when the rejection note is not valid
+        """
+        rnote_id, rnote = self._process_rejection_note(
+            data.get("rnote_id"), data.get("rnote")
+        )
+        if not rnote_id or not rnote:
+            return False
+
+        data["rnote_id"] = rnote_id
+        data["rnote"] = rnote
+        return True
+
+    def _apply_cost_type(self, expense, data):
+        """
+        Validates the cost type of an update
+        :param expense: Expenses entity
+        :param data: the update, its cost_type is set to the key of the cost type
+        :return: tuple of the CostTypes entity of the expense and an error response
+        """
+        # Check validity cost-type
+        cost_type_entity, cost_type_active = self._process_cost_type(
+            data.get("cost_type", expense["cost_type"])
+        )
+        if "cost_type" in data:
+            if cost_type_entity is None or not cost_type_active:
+                return None, make_response_translated("Geen geldige kostensoort", 400)
+            data["cost_type"] = cost_type_entity.key.name
+
+        return cost_type_entity, None
+
+    @staticmethod
+    def _apply_status_transition(expense, data, cost_type_entity):
+        """
+        Resolves the submission of a draft or rejected expense to the status it
+        moves to, which depends on the minimum amount of its cost type
+        :param expense: Expenses entity
+        :param data: the update, its status and min_amount are set
+        :param cost_type_entity: CostTypes entity of the expense
+        :return: error response, None when the transition is allowed
+        """
+        if not (
+            expense["status"]["text"] == "draft"
+            or "rejected" in expense["status"]["text"]
+        ) or "ready" not in data.get("status", ""):
+            return None
+
+        if len(data) > 1:
+            return make_response_translated(
+                "Het indienen van een declaratie is niet toegestaan tijdens het aanpassen van velden",
+                403,
+            )
+
+        data["min_amount"] = cost_type_entity.get("MinAmount", 50)
+        if data["min_amount"] == 0 or data["min_amount"] <= data.get(
+            "amount", expense["amount"]
+        ):
+            data["status"] = "ready_for_manager"
+        else:
+            data["status"] = "ready_for_creditor"
+
+        return None
+
+    def _update_expenses(
+        self, data, allowed_fields, allowed_statuses, expense, old_expense=None
+    ):
         items_to_update = list(allowed_fields.intersection(set(data.keys())))
         need_to_save = False
         for item in items_to_update:
@@ -682,25 +984,119 @@ class ClaimExpenses:
                 return False
 
         if need_to_save:
-            self.ds_client.put(expense)
+            self._put_expense(expense, old_expense)
             return True
 
         return False
 
     def update_exported_expenses(self, expenses_exported, document_time):
         """
-        Do some sanity changed to keep data updated.
-        :param document_type: A Payment or a booking file
-        :param expenses_exported: Expense <Entity Keys>
-        :param document_date: Date when it was exported
+        Set the status of the exported expenses to exported. The expenses are updated
+        in chunks, each in its own transaction, and the chunks run in parallel.
+        :param expenses_exported: Expense entities
+        :param document_time: Date when it was exported
+        :return: list with the outcome of every chunk, a chunk that could not be
+        committed has an error
+        """
+        keys = [self.ds_client.key("Expenses", exp.id) for exp in expenses_exported]
+        chunks = [
+            keys[index : index + EXPORT_CHUNK_SIZE]
+            for index in range(0, len(keys), EXPORT_CHUNK_SIZE)
+        ]
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=EXPORT_MAX_WORKERS
+        ) as executor:
+            outcomes = list(
+                executor.map(
+                    self._update_exported_chunk,
+                    range(len(chunks)),
+                    chunks,
+                    itertools.repeat(document_time),
+                )
+            )
+
+        for chunk, outcome in zip(chunks, outcomes):
+            if outcome["error"]:
+                logging.error(
+                    f"Could not update exported expenses "
+                    f"{[key.id for key in chunk]}: {outcome}"
+                )
+            else:
+                logging.info(f"Updated exported expenses: {outcome}")
+
+            if outcome["skipped"]:
+                logging.error(
+                    f"Exported expenses {outcome['skipped']} changed status during "
+                    f"the export and were not set to exported"
+                )
+
+        return outcomes
+
+    def _update_exported_chunk(self, chunk_number, keys, document_time):
+        outcome = {
+            "chunk": chunk_number,
+            "expenses": len(keys),
+            "exported": 0,
+            "skipped": [],
+            "missing": [],
+            "attempts": 0,
+            "error": None,
+        }
+
+        for attempt in range(1, EXPORT_COMMIT_ATTEMPTS + 1):
+            outcome["attempts"] = attempt
+            missing = []
+            skipped = []
+
+            try:
+                # Transactions are optimistic: the commit fails with a conflict when
+                # one of the expenses was changed after it was read
+                with self.ds_client.transaction():
+                    expenses = self.ds_client.get_multi(keys, missing=missing)
+                    for expense in expenses:
+                        if expense["status"]["text"] not in EXPORTABLE_STATUSES:
+                            skipped.append(expense.key.id)
+                            continue
+
+                        old_expense = copy.deepcopy(expense)
+                        expense["status"]["export_date"] = document_time
+                        expense["status"]["text"] = "exported"
+                        self._put_expense(expense, old_expense)
+            except gcp_exceptions.Conflict as exception:
+                outcome["error"] = str(exception)
+            except Exception as exception:
+                logging.exception(f"Updating exported chunk {chunk_number} failed")
+                outcome["error"] = str(exception)
+                break
+            else:
+                outcome["exported"] = len(expenses) - len(skipped)
+                outcome["skipped"] = skipped
+                outcome["missing"] = [entity.key.id for entity in missing]
+                outcome["error"] = None
+                break
+
+        return outcome
+
+    def _put_expense(self, expense, old_expense=None):
+        """
+        Store an expense together with its summary for the list endpoints, the
+        inboxes of the managers it moves between and, when old_expense is given,
+        its Expenses_Journal entry in one put_multi. The summary and journal
+        refer to the id of the expense, so a new expense gets a reserved id
+        from the expense_ids pool instead of being stored with a partial key.
+        :param expense: Expenses entity, its key is completed when partial
+        :param old_expense: expense before the mutation, an empty dict for a new expense
         """
+        if expense.key.is_partial:
+            expense.key = expense_ids.complete_key(self.ds_client, expense.key)
 
-        for exp in expenses_exported:
-            with self.ds_client.transaction():
-                expense = self.ds_client.get(self.ds_client.key("Expenses", exp.id))
-                expense["status"]["export_date"] = document_time
-                expense["status"]["text"] = "exported"
-                self.ds_client.put(expense)
+        entities = [expense, build_expense_summary(self.ds_client, expense)]
+        entities.extend(update_manager_inboxes(self.ds_client, expense, old_expense))
+        if old_expense is not None:
+            entities.append(self.expense_journal(old_expense, expense))
+
+        self.ds_client.put_multi(entities)
 
     def _has_attachments(self, expense, data):
         allowed_statuses_new = [
@@ -716,15 +1112,18 @@ class ClaimExpenses:
         ):
             return True
 
-        email_name = expense["employee"]["email"].split("@")[0]
+        if "attachments" in expense:
+            attachments = expense["attachments"]
+        else:
+            attachments = self._list_attachments(expense)
 
-        expenses_bucket = self.cs_client.get_bucket(self.bucket_name)
-        blobs = expenses_bucket.list_blobs(
-            prefix=f"exports/attachments/{email_name}/{str(expense.key.id)}"
+        # PDFs that are pending or failed to process can not be reviewed yet
+        return any(
+            attachment.get("status", ATTACHMENT_STATUS_PROCESSED)
+            == ATTACHMENT_STATUS_PROCESSED
+            for attachment in attachments
         )
 
-        return True if len(list(blobs)) > 0 else False
-
     @staticmethod
     def _process_rejection_note(rnote_id, rnote=None):
         if (rnote and not rnote_id) or not REJECTION_NOTES.get(rnote_id, None):
@@ -764,15 +1163,28 @@ class ClaimExpenses:
 
     def filter_expenses_to_export(self):
         """
-        Query the expenses to return desired values
+        Query the expenses with an exportable status. Every status is selected with an
+        indexed equality query that is read page by page using query cursors, so the
+        cost does not grow with the number of already exported expenses.
         :return:
         """
 
         never_exported = []
-        expenses_query = self.ds_client.query(kind="Expenses")
-        for entity in expenses_query.fetch():
-            if entity["status"]["text"] in EXPORTABLE_STATUSES:
-                never_exported.append(entity)
+        for status in EXPORTABLE_STATUSES:
+            expenses_query = self.ds_client.query(kind="Expenses")
+            expenses_query.add_filter("status.text", "=", status)
+
+            cursor = None
+            while True:
+                query_iter = expenses_query.fetch(
+                    limit=EXPORT_QUERY_PAGE_SIZE, start_cursor=cursor
+                )
+                entities = list(next(query_iter.pages, []))
+                never_exported.extend(entities)
+
+                cursor = query_iter.next_page_token
+                if not entities or not cursor:
+                    break
 
         return never_exported
 
@@ -820,7 +1232,12 @@ class ClaimExpenses:
             ]
         }
 
-        self.update_exported_expenses(expense_claims_to_export, now)
+        outcomes = self.update_exported_expenses(expense_claims_to_export, now)
+        if any(outcome["error"] for outcome in outcomes):
+            # The files are sent, expenses that are still approved would be paid again
+            return make_response_translated(
+                "Kan declaraties niet als geëxporteerd markeren", 500
+            )
 
         return make_response(jsonify(retval), 200)
 
@@ -828,85 +1245,80 @@ class ClaimExpenses:
         self, expense_claims_to_export, export_filename, document_date
     ):
         """
-        Create a booking file
+        Create a booking file. The file is built column by column: cost types are
+        resolved with one batched lookup and transaction dates are parsed at once.
         :return:
         """
-        booking_file_data = []
-        for expense_detail in expense_claims_to_export:
-            # try:
-            #     department_number_aka_afdeling_code = expense_detail["employee"][
-            #         "afas_data"
-            #     ]["Afdeling Code"]
-            # except Exception:
-            #     department_number_aka_afdeling_code = 0000
-            # company_number = self.ds_client.get(
-            #     self.ds_client.key(
-            #         "Departments", department_number_aka_afdeling_code
-            #     )
-            # )
-            logger.debug(f" transaction date [{expense_detail['transaction_date']}]")
-
-            trans_date = dateutil.parser.parse(
-                expense_detail["transaction_date"]
-            ).strftime("%d-%m-%Y")
-
-            boekingsomschrijving_bron = f"{expense_detail['employee']['afas_data']['Personeelsnummer']} {trans_date}"
-
-            expense_detail["boekingsomschrijving_bron"] = boekingsomschrijving_bron
-
-            grootboek_number = expense_detail["cost_type"]
-            cost_type_split = (
-                grootboek_number.split(":")[1]
-                if ":" in grootboek_number
-                else grootboek_number
+        transaction_dates = self._format_transaction_dates(
+            pd.Series(
+                [expense["transaction_date"] for expense in expense_claims_to_export],
+                dtype=object,
             )
+        )
+        personeelsnummers = pd.Series(
+            [
+                expense["employee"]["afas_data"]["Personeelsnummer"]
+                for expense in expense_claims_to_export
+            ],
+            dtype=object,
+        ).astype(str)
+        boekingsomschrijving_bron = personeelsnummers + " " + transaction_dates
 
-            try:
-                key = self.ds_client.key("CostTypes", cost_type_split)
-                cost_entity = self.ds_client.get(key=key)
-                grootboek_number = cost_entity["Grootboek"]
-            except Exception:
-                logging.warning("Old cost_type")
-                grootboek_number = cost_type_split
+        for expense_detail, omschrijving in zip(
+            expense_claims_to_export, boekingsomschrijving_bron
+        ):
+            expense_detail["boekingsomschrijving_bron"] = omschrijving
 
-            booking_file_data.append(
-                {
-                    "BoekingsomschrijvingBron": boekingsomschrijving_bron,
-                    "Document-datum": document_date.strftime("%d%m%Y"),
-                    "Boekings-jaar": document_date.strftime("%Y"),
-                    "Periode": document_date.strftime("%m"),
-                    "Bron-bedrijfs-nummer": config.BOOKING_FILE_STATICS[
-                        "Bron-bedrijfs-nummer"
-                    ],
-                    "Bron gr boekrek": config.BOOKING_FILE_STATICS[
-                        "Bron-grootboek-rekening"
-                    ],
-                    "Bron Org Code": config.BOOKING_FILE_STATICS["Bron-org-code"],
-                    "Bron Process": "000",
-                    "Bron Produkt": "000",
-                    "Bron EC": "000",
-                    "Bron VP": "00",
-                    "Doel-bedrijfs-nummer": config.BOOKING_FILE_STATICS[
-                        "Doel-bedrijfs-nummer"
-                    ],
-                    "Doel-gr boekrek": grootboek_number,
-                    "Doel Org code": config.BOOKING_FILE_STATICS["Doel-org-code"],
-                    "Doel Proces": "000",
-                    "Doel Produkt": "000",
-                    "Doel EC": "000",
-                    "Doel VP": "00",
-                    "D/C": "C",
-                    "Bedrag excl. BTW": expense_detail["amount"],
-                    "BTW-Bedrag": "0,00",
-                }
-            )
+        cost_types = pd.Series(
+            [expense["cost_type"] for expense in expense_claims_to_export], dtype=object
+        )
+        cost_type_ids = cost_types.where(
+            ~cost_types.str.contains(":", regex=False),
+            cost_types.str.split(":").str[1],
+        )
+        general_ledgers = self._get_general_ledgers(cost_type_ids.unique())
+        grootboek_numbers = cost_type_ids.map(
+            lambda cost_type_id: general_ledgers.get(cost_type_id, cost_type_id)
+        )
 
-        booking_file = pd.DataFrame(booking_file_data).to_csv(
-            sep=";", index=False, decimal=","
+        booking_file_data = pd.DataFrame(
+            {
+                "BoekingsomschrijvingBron": boekingsomschrijving_bron,
+                "Document-datum": document_date.strftime("%d%m%Y"),
+                "Boekings-jaar": document_date.strftime("%Y"),
+                "Periode": document_date.strftime("%m"),
+                "Bron-bedrijfs-nummer": config.BOOKING_FILE_STATICS[
+                    "Bron-bedrijfs-nummer"
+                ],
+                "Bron gr boekrek": config.BOOKING_FILE_STATICS[
+                    "Bron-grootboek-rekening"
+                ],
+                "Bron Org Code": config.BOOKING_FILE_STATICS["Bron-org-code"],
+                "Bron Process": "000",
+                "Bron Produkt": "000",
+                "Bron EC": "000",
+                "Bron VP": "00",
+                "Doel-bedrijfs-nummer": config.BOOKING_FILE_STATICS[
+                    "Doel-bedrijfs-nummer"
+                ],
+                "Doel-gr boekrek": grootboek_numbers,
+                "Doel Org code": config.BOOKING_FILE_STATICS["Doel-org-code"],
+                "Doel Proces": "000",
+                "Doel Produkt": "000",
+                "Doel EC": "000",
+                "Doel VP": "00",
+                "D/C": "C",
+                "Bedrag excl. BTW": pd.Series(
+                    [expense["amount"] for expense in expense_claims_to_export]
+                ),
+                "BTW-Bedrag": "0,00",
+            }
         )
 
+        booking_file = booking_file_data.to_csv(sep=";", index=False, decimal=",")
+
         # Save File to CloudStorage
-        bucket = self.cs_client.get_bucket(self.bucket_name)
+        bucket = bucket_handles.get(self.cs_client, self.bucket_name)
 
         blob = bucket.blob(
             f"exports/booking_file/{document_date.year}/{document_date.month}/{document_date.day}/{export_filename}"
@@ -916,214 +1328,175 @@ class ClaimExpenses:
 
         return True, export_filename, booking_file
 
-    def _gather_creditor_name(self, expense):
-        return unidecode.unidecode(expense["employee"]["afas_data"].get("Naam"))
-
-    def create_payment_file(
-        self, expense_claims_to_export, export_filename, document_time
-    ):
-
+    @staticmethod
+    def _format_transaction_dates(transaction_dates):
         """
-        Creates an XML file from claim expenses that have been exported. Thus a claim must have a status
-        ==> status -- 'booking-file-created'
+        Formats transaction dates as dd-mm-YYYY. ISO 8601 dates are parsed in one
+        go on their date part, which is what dateutil keeps for them as well; any
+        other format falls back to dateutil.
+        :param transaction_dates: Series of transaction date strings
+        :return: Series of formatted dates
         """
-        booking_timestamp_id = document_time.strftime("%Y%m%d%H%M%S")
-
-        message_id = f"200/DEC/{booking_timestamp_id}"
-        payment_info_id = f"200/DEC/{booking_timestamp_id}"
-
-        # Set namespaces
-        ET.register_namespace("", "urn:iso:std:iso:20022:tech:xsd:pain.001.001.03")
-        root = ET.Element("{urn:iso:std:iso:20022:tech:xsd:pain.001.001.03}Document")
-
-        root.set("xmlns:xsi", "http://www.w3.org/2001/XMLSchema-instance")
-
-        customer_header = ET.SubElement(root, "CstmrCdtTrfInitn")
-
-        ctrl_sum = Decimal(0)
-        for expense in expense_claims_to_export:
-            ctrl_sum += Decimal(str(expense["amount"]))
-
-        # Group Header
-        header = ET.SubElement(customer_header, "GrpHdr")
-        ET.SubElement(header, "MsgId").text = message_id
-        ET.SubElement(header, "CreDtTm").text = document_time.isoformat(
-            timespec="seconds"
-        )
-        ET.SubElement(header, "NbOfTxs").text = str(
-            len(expense_claims_to_export)  # Number Of Transactions in the batch
-        )
-        ET.SubElement(header, "CtrlSum").text = str(
-            ctrl_sum
-        )  # Total amount of the batch
-        initiating_party = ET.SubElement(header, "InitgPty")
-        ET.SubElement(initiating_party, "Nm").text = config.OWN_ACCOUNT["bedrijf"]
-
-        #  Payment Information
-        payment_info = ET.SubElement(customer_header, "PmtInf")
-        ET.SubElement(payment_info, "PmtInfId").text = message_id
-        ET.SubElement(payment_info, "PmtMtd").text = "TRF"  # Standard Value
-        ET.SubElement(payment_info, "NbOfTxs").text = str(
-            len(expense_claims_to_export)  # Number Of Transactions in the batch
+        is_iso_date = transaction_dates.str.match(ISO_DATE_PATTERN, na=False)
+        parsed_dates = pd.to_datetime(
+            transaction_dates.where(is_iso_date).str.slice(0, 10),
+            format="%Y-%m-%d",
+            errors="coerce",
         )
-        ET.SubElement(payment_info, "CtrlSum").text = str(
-            ctrl_sum
-        )  # Total amount of the batch
-
-        # Payment Type Information
-        payment_typ_info = ET.SubElement(payment_info, "PmtTpInf")
-        ET.SubElement(payment_typ_info, "InstrPrty").text = "NORM"
-        payment_tp_service_level = ET.SubElement(payment_typ_info, "SvcLvl")
-        ET.SubElement(payment_tp_service_level, "Cd").text = "SEPA"
-
-        ET.SubElement(
-            payment_info, "ReqdExctnDt"
-        ).text = document_time.date().isoformat()
-
-        # Debitor Information
-        payment_debitor_info = ET.SubElement(payment_info, "Dbtr")
-        ET.SubElement(payment_debitor_info, "Nm").text = "VWT BV"
-        payment_debitor_account = ET.SubElement(payment_info, "DbtrAcct")
-        payment_debitor_account_id = ET.SubElement(payment_debitor_account, "Id")
-        ET.SubElement(payment_debitor_account_id, "IBAN").text = config.OWN_ACCOUNT[
-            "iban"
-        ]
-
-        # Debitor Agent Tags Information
-        payment_debitor_agent = ET.SubElement(payment_info, "DbtrAgt")
-        payment_debitor_agent_id = ET.SubElement(payment_debitor_agent, "FinInstnId")
-        ET.SubElement(payment_debitor_agent_id, "BIC").text = config.OWN_ACCOUNT["bic"]
-        for expense in expense_claims_to_export:
-            # Transaction Transfer Information
-            transfer = ET.SubElement(payment_info, "CdtTrfTxInf")
-            transfer_payment_id = ET.SubElement(transfer, "PmtId")
-            ET.SubElement(transfer_payment_id, "InstrId").text = payment_info_id
-            ET.SubElement(transfer_payment_id, "EndToEndId").text = expense[
-                "boekingsomschrijving_bron"
-            ]
 
-            # Amount
-            amount = ET.SubElement(transfer, "Amt")
-            ET.SubElement(amount, "InstdAmt", Ccy="EUR").text = str(expense["amount"])
-            ET.SubElement(transfer, "ChrgBr").text = "SLEV"
-
-            iban = expense["employee"]["afas_data"].get("IBAN")
-            if not iban:
-                iban = ""
-
-            # Creditor Agent Tag Information
-            amount_agent = ET.SubElement(transfer, "CdtrAgt")
-            payment_creditor_agent_id = ET.SubElement(amount_agent, "FinInstnId")
-            ET.SubElement(
-                payment_creditor_agent_id, "BIC"
-            ).text = self.get_iban_details(iban)
-
-            # Creditor name
-            creditor_name = ET.SubElement(transfer, "Cdtr")
-            ET.SubElement(creditor_name, "Nm").text = self._gather_creditor_name(
-                expense
+        formatted_dates = parsed_dates.dt.strftime("%d-%m-%Y").astype(object)
+        unparsed = parsed_dates.isna()
+        if unparsed.any():
+            formatted_dates[unparsed] = transaction_dates[unparsed].map(
+                lambda transaction_date: dateutil.parser.parse(
+                    transaction_date
+                ).strftime("%d-%m-%Y")
             )
 
-            # Creditor Account
-            creditor_account = ET.SubElement(transfer, "CdtrAcct")
-            creditor_account_id = ET.SubElement(creditor_account, "Id")
-
-            # <ValidationPass> on whitespaces
-            ET.SubElement(creditor_account_id, "IBAN").text = iban.replace(" ", "")
-
-            # Remittance Information
-            remittance_info = ET.SubElement(transfer, "RmtInf")
-            ET.SubElement(remittance_info, "Ustrd").text = expense[
-                "boekingsomschrijving_bron"
-            ]
-
-        payment_xml_string = ET.tostring(root, encoding="utf8", method="xml")
+        return formatted_dates
 
-        # Save File to CloudStorage
-        bucket = self.cs_client.get_bucket(self.bucket_name)
-        blob = bucket.blob(
-            f"exports/payment_file/{document_time.year}/{document_time.month}/{document_time.day}/{export_filename}"
-        )
-        blob.upload_from_string(payment_xml_string, content_type="application/xml")
+    def _get_general_ledgers(self, cost_type_ids):
+        """
+        Looks up the general ledger (Grootboek) of the cost types with batched
+        lookups, at most DATASTORE_LOOKUP_LIMIT keys per call
+        :param cost_type_ids: unique cost type ids
+        :return: dict of cost type id to general ledger; old cost types are left out
+        """
+        keys = [
+            self.ds_client.key("CostTypes", cost_type_id)
+            for cost_type_id in cost_type_ids
+        ]
 
-        payment_file = MD.parseString(payment_xml_string).toprettyxml(encoding="utf-8")
+        general_ledgers = {}
+        for start in range(0, len(keys), DATASTORE_LOOKUP_LIMIT):
+            for cost_type in self.ds_client.get_multi(
+                keys[start : start + DATASTORE_LOOKUP_LIMIT]
+            ):
+                if "Grootboek" in cost_type:
+                    general_ledgers[cost_type.key.name] = cost_type["Grootboek"]
 
-        if (
-            config.POWER2PAY_URL
-            and config.POWER2PAY_AUTH_USER
-            and config.POWER2PAY_AUTH_PASSWORD
-        ):
-            if not self.send_to_power2pay(payment_xml_string):
-                return False, None, jsonify({"Info": "Failed to upload payment file"})
+        old_cost_types = len(keys) - len(general_ledgers)
+        if old_cost_types:
+            logging.warning(f"Old cost_type: {old_cost_types} cost types not found")
 
-            logger.info("Power2Pay upload successful")
-        else:
-            logger.warning("Sending to Power2Pay is disabled")
+        return general_ledgers
 
-        return True, export_filename, payment_file
-
-    def get_secret(self, project_id, secret_id):
+    def _gather_creditor_name(self, expense):
+        return unidecode.unidecode(expense["employee"]["afas_data"].get("Naam"))
 
-        client = secretmanager_v1.SecretManagerServiceClient()
+    def create_payment_file(
+        self, expense_claims_to_export, export_filename, document_time
+    ):
 
-        secret_name = client.secret_version_path(project_id, secret_id, "latest")
+        """
+        Creates an XML file from claim expenses that have been exported. Thus a claim must have a status
+        ==> status -- 'booking-file-created'
+        The document is streamed into a spooled temporary file, a transaction at a
+        time, so large batches do not hold the whole document in memory.
+        """
+        with tempfile.SpooledTemporaryFile(
+            max_size=PAYMENT_FILE_SPOOL_SIZE
+        ) as payment_xml:
+            for chunk in self._generate_payment_file(
+                expense_claims_to_export, document_time
+            ):
+                payment_xml.write(chunk.encode("utf-8"))
 
-        response = client.access_secret_version(request={"name": secret_name})
-        payload = response.payload.data.decode("UTF-8")
+            # Save File to CloudStorage
+            bucket = bucket_handles.get(self.cs_client, self.bucket_name)
+            blob = bucket.blob(
+                f"exports/payment_file/{document_time.year}/{document_time.month}/{document_time.day}/{export_filename}"
+            )
+            blob.upload_from_file(
+                payment_xml, rewind=True, content_type="application/xml"
+            )
 
-        return payload
+            if (
+                config.POWER2PAY_URL
+                and config.POWER2PAY_AUTH_USER
+                and config.POWER2PAY_AUTH_PASSWORD
+            ):
+                payment_xml.seek(0)
+                if not self.send_to_power2pay(payment_xml):
+                    return (
+                        False,
+                        None,
+                        jsonify({"Info": "Failed to upload payment file"}),
+                    )
 
-    def make_temp(self, str):
-        with tempfile.NamedTemporaryFile(mode="w", delete=False) as temp_file:
-            temp_file.write(str)
+                logger.info("Power2Pay upload successful")
+            else:
+                logger.warning("Sending to Power2Pay is disabled")
 
-        return temp_file.name
+        # The document is not kept, it is read from the bucket when requested
+        return True, export_filename, None
 
-    def get_certificates(self):
+    def _generate_payment_file(self, expense_claims_to_export, document_time):
+        """
+        Generates the payment file of the expenses chunk by chunk. The number of
+        transactions and the control sum are computed in a first pass over the
+        amounts, after which the transactions are written one by one.
+        """
+        booking_timestamp_id = document_time.strftime("%Y%m%d%H%M%S")
 
-        passphrase = self.get_secret(
-            os.environ["GOOGLE_CLOUD_PROJECT"], config.PASSPHRASE
-        )
-        key = self.get_secret(os.environ["GOOGLE_CLOUD_PROJECT"], config.KEY)
-        certificate = self.get_secret(
-            os.environ["GOOGLE_CLOUD_PROJECT"], config.CERTIFICATE
-        )
+        message_id = f"200/DEC/{booking_timestamp_id}"
+        payment_info_id = f"200/DEC/{booking_timestamp_id}"
 
-        pk = crypto.load_privatekey(crypto.FILETYPE_PEM, key, passphrase.encode())
+        ctrl_sum = Decimal(0)
+        for expense in expense_claims_to_export:
+            ctrl_sum += Decimal(str(expense["amount"]))
 
-        key_file = self.make_temp(
-            str(
-                crypto.dump_privatekey(
-                    crypto.FILETYPE_PEM, pk, cipher=None, passphrase=None
-                ),
-                "utf-8",
-            )
+        return generate_payment_file(
+            message_id=message_id,
+            creation_time=document_time.isoformat(timespec="seconds"),
+            number_of_transactions=len(expense_claims_to_export),
+            control_sum=ctrl_sum,
+            initiating_party=config.OWN_ACCOUNT["bedrijf"],
+            execution_date=document_time.date().isoformat(),
+            debtor={
+                "name": "VWT BV",
+                "iban": config.OWN_ACCOUNT["iban"],
+                "bic": config.OWN_ACCOUNT["bic"],
+            },
+            transactions=(
+                self._payment_transaction(expense, payment_info_id)
+                for expense in expense_claims_to_export
+            ),
         )
 
-        cert_file = self.make_temp(certificate)
+    def _payment_transaction(self, expense, payment_info_id):
+        iban = expense["employee"]["afas_data"].get("IBAN")
+        if not iban:
+            iban = ""
 
-        return (cert_file, key_file)
-
-    def send_to_power2pay(self, payment_xml_string):
+        return {
+            "instruction_id": payment_info_id,
+            "end_to_end_id": expense["boekingsomschrijving_bron"],
+            "amount": str(expense["amount"]),
+            "bic": self.get_iban_details(iban),
+            "name": self._gather_creditor_name(expense),
+            # <ValidationPass> on whitespaces
+            "iban": iban.replace(" ", ""),
+            "remittance": expense["boekingsomschrijving_bron"],
+        }
 
-        cert = self.get_certificates()
-        auth_password = self.get_secret(
-            os.environ["GOOGLE_CLOUD_PROJECT"], config.POWER2PAY_AUTH_PASSWORD
-        )
-        r = requests.post(
-            config.POWER2PAY_URL,
-            data=payment_xml_string,
-            cert=cert,
-            verify=True,
-            auth=(config.POWER2PAY_AUTH_USER, auth_password),
-        )
+    def send_to_power2pay(self, payment_xml):
+        try:
+            r = power2pay_session.get().post(config.POWER2PAY_URL, data=payment_xml)
+        except requests.exceptions.SSLError:
+            power2pay_session.invalidate()
+            raise
 
         logger.info(f"Power2Pay send result {r.status_code}: {r.content}")
 
+        if r.status_code in (401, 403):
+            # Credentials may have been rotated, fetch them again on the next export
+            power2pay_session.invalidate()
+
         return r.ok
 
     def get_all_documents_list(self):
-        expenses_bucket = self.cs_client.get_bucket(self.bucket_name)
+        expenses_bucket = bucket_handles.get(self.cs_client, self.bucket_name)
 
         all_exports_files = {"file_list": []}
         blobs = expenses_bucket.list_blobs(prefix=f"exports/booking_file")
@@ -1146,7 +1519,7 @@ class ClaimExpenses:
 
     def get_single_document_reference(self, document_id, document_type):
         document_date = datetime.datetime.strptime(document_id, "%Y%m%d%H%M%S")
-        expenses_bucket = self.cs_client.get_bucket(self.bucket_name)
+        expenses_bucket = bucket_handles.get(self.cs_client, self.bucket_name)
 
         blob = expenses_bucket.blob(
             f"exports/{document_type}/{document_date.year}/{document_date.month}/{document_date.day}/{document_id}"
@@ -1159,40 +1532,60 @@ class ClaimExpenses:
             return export_file
 
     def _create_expenses_query(self):
-        return self.ds_client.query(kind="Expenses", order=["-claim_date"])
+        return self.ds_client.query(kind=expenses_list_kind(), order=["-claim_date"])
+
+    @staticmethod
+    def _fetch_page(query, limit=None, cursor=None):
+        """
+        Fetch all entities of a query, or a single page of them when a limit is given
+        :param query: Datastore query
+        :param limit: maximum number of entities in the page
+        :param cursor: Datastore cursor returned with a previous page
+        :return: tuple of the entities and the cursor of the next page (None if there is none)
+        """
+        if limit is None:
+            return query.fetch(), None
+
+        query_iter = query.fetch(limit=limit, start_cursor=cursor)
+        try:
+            entities = list(next(query_iter.pages))
+        except (gcp_exceptions.BadRequest, ValueError):
+            raise ValueError("Geen geldige queryparameter")
+
+        next_cursor = query_iter.next_page_token
+        if next_cursor and isinstance(next_cursor, bytes):
+            next_cursor = next_cursor.decode("utf-8")
+
+        return entities, next_cursor or None
 
-    def _process_cost_type(self, cost_type, cost_type_list=None):
+    def _process_cost_type(self, cost_type, cost_type_index=None):
+        """
+        Returns the cost type entity and its active flag, or (None, False) if the
+        cost type does not exist
+        :param cost_type: cost type id, optionally prefixed like 'description:id'
+        :param cost_type_index: dict of key.name to (entity, active), see CostTypesCache.get_index
+        """
         cost_type_split = cost_type.split(":")
         cost_type_id = cost_type
 
         if len(cost_type_split) == 2:
             cost_type_id = cost_type_split[1]
 
-        if cost_type_list is None:
-            key = self.ds_client.key("CostTypes", cost_type_id)
-            cost_type_entity = self.ds_client.get(key=key)
-        else:
-            for ct in cost_type_list:
-                if ct.key.name == cost_type_id:
-                    cost_type_entity = ct
-                    break
-
-        cost_type_active = False
-        if cost_type_entity is not None:
-            cost_type_active = cost_type_entity.get("Active", False)
+        if cost_type_index is None:
+            cost_type_index = cost_types_cache.get_index(self.ds_client)
 
-        return cost_type_entity, cost_type_active
+        return cost_type_index.get(cost_type_id, (None, False))
 
     def _process_expenses_info(self, expenses_info):
         expenses_data = expenses_info.fetch()
         if expenses_data:
-            cost_type_list = list(self.ds_client.query(kind="CostTypes").fetch())
+            cost_type_index = cost_types_cache.get_index(self.ds_client)
 
             expenses_list = []
             for ed in expenses_data:
 
                 cost_type_entity, cost_type_active = self._process_cost_type(
-                    ed["cost_type"], cost_type_list
+                    ed["cost_type"], cost_type_index
                 )
                 cost_type = (
                     None if cost_type_entity is None else cost_type_entity.key.name
@@ -1216,6 +1609,12 @@ class ClaimExpenses:
         return make_response("", 204)
 
     def expense_journal(self, old_expense, expense):
+        """
+        Create the Expenses_Journal entity with the changes between two versions of an expense
+        :param old_expense: expense before the mutation, an empty dict for a new expense
+        :param expense: expense after the mutation
+        :return: Expenses_Journal entity, not yet stored
+        """
         changed = []
 
         def default(o):
@@ -1249,7 +1648,7 @@ class ClaimExpenses:
                 "User": self.employee_info["unique_name"],
             }
         )
-        self.ds_client.put(entity)
+        return entity
 
     def get_employee_locale(self, unique_name):
         locale_list = ["nl", "en", "de"]
@@ -1351,13 +1750,18 @@ class ClaimExpenses:
         msg["Reply-To"] = config.GMAIL_ADDEXPENSE_REPLYTO
         msg["To"] = to
 
-        with open("gmail_template.html", "r") as mail_template:
-            msg_html = mail_template.read()
-
-        msg_html = msg_html.replace("$MAIL_TITLE", mail_body["title"][locale])
-        msg_html = msg_html.replace("$MAIL_SALUTATION", mail_body["salutation"][locale])
-        msg_html = msg_html.replace("$MAIL_BODY", mail_body["body"][locale])
-        msg_html = msg_html.replace("$MAIL_FOOTER", mail_body["footer"][locale])
+        # The footer only depends on the locale, so it is part of the static segments
+        msg_html = (
+            get_mail_template()
+            .partial({"$MAIL_FOOTER": mail_body["footer"][locale]})
+            .render(
+                {
+                    "$MAIL_TITLE": mail_body["title"][locale],
+                    "$MAIL_SALUTATION": mail_body["salutation"][locale],
+                    "$MAIL_BODY": mail_body["body"][locale],
+                }
+            )
+        )
 
         msg.attach(MIMEText(msg_html, "html"))
         raw = base64.urlsafe_b64encode(msg.as_bytes())
@@ -1366,6 +1770,9 @@ class ClaimExpenses:
         return {"raw": raw}
 
     def send_mail_notification(self, mail_body, afas_data, expense_id, locale):
+        # The body is completed below, a retry has to start from the original
+        mail_body = copy.deepcopy(mail_body)
+
         if (
             hasattr(config, "GMAIL_STATUS")
             and config.GMAIL_STATUS
@@ -1435,8 +1842,10 @@ class ClaimExpenses:
                     logging.error(
                         "An exception occurred when sending an email: {}".format(e)
                     )
+                    raise  # Retried by the notification queue
                 except Exception as e:
                     logging.error("An error occurred: {}".format(e))
+                    raise
             else:
                 logging.info("Gmail service could not be created")
         else:
@@ -1459,14 +1868,11 @@ class ClaimExpenses:
                     "Voornaam": "Lease Coördinator",
                 }
             elif "Manager_personeelsnummer" in afas_data:
-                query = self.ds_client.query(kind="AFAS_HRM")
-                query.add_filter(
-                    "Personeelsnummer", "=", afas_data["Manager_personeelsnummer"]
+                recipient = get_afas_employee(
+                    self.ds_client,
+                    "Personeelsnummer",
+                    afas_data["Manager_personeelsnummer"],
                 )
-                db_data = list(query.fetch(limit=1))
-
-                if len(db_data) == 1:
-                    recipient = db_data[0]
 
             notification_body = {
                 "title": {
@@ -1496,12 +1902,12 @@ class ClaimExpenses:
             }
 
         if recipient and "upn" not in recipient:
-            query = self.ds_client.query(kind="AFAS_HRM")
-            query.add_filter("Personeelsnummer", "=", recipient["Personeelsnummer"])
-            db_data = list(query.fetch(limit=1))
-
-            if len(db_data) == 1:
-                recipient = db_data[0]
+            recipient = (
+                get_afas_employee(
+                    self.ds_client, "Personeelsnummer", recipient["Personeelsnummer"]
+                )
+                or recipient
+            )
 
         if (
             notification_body
@@ -1519,8 +1925,14 @@ class ClaimExpenses:
                 )
 
             if not notification_status:
-                self.send_mail_notification(
-                    notification_body, recipient, expense_id, locale
+                # Queued on its own, so retrying the mail does not resend the push
+                notification_queue.enqueue(
+                    f"mail for expense '{expense_id}'",
+                    self.send_mail_notification,
+                    notification_body,
+                    recipient,
+                    expense_id,
+                    locale,
                 )
         else:
             logging.info(f"No notification sent for expense '{expense_id}'")
@@ -1595,8 +2007,8 @@ class ClaimExpenses:
 
 
 class EmployeeExpenses(ClaimExpenses):
-    def __init__(self, employee_id):
-        super().__init__()
+    def __init__(self, employee_id, clients=client_registry):
+        super().__init__(clients)
         self.employee_id = employee_id
 
     def _check_attachment_permission(self, expense):
@@ -1651,25 +2063,252 @@ class EmployeeExpenses(ClaimExpenses):
             }
             return fields, allowed_status_transitions[expense["status"]["text"]]
 
-        return {}, {}
+        return {}, {}
+
+    def add_attachment(self, expense_id, data):
+        expense_key = self.ds_client.key("Expenses", expense_id)
+        expense = self.ds_client.get(expense_key)
+        if not expense:
+            return make_response_translated("Declaratie niet gevonden", 404)
+        if expense["employee"]["email"] != self.employee_info["unique_name"]:
+            return make_response_translated("Ongeautoriseerd", 403)
+
+        creation = self.create_attachment(
+            data, expense.key.id_or_name, self.employee_info["unique_name"]
+        )
+
+        if not creation:
+            return make_response_translated(
+                "Er ging iets fout tijdens het uploaden van bestanden", 400
+            )
+        return 201
+
+    def _get_attachment_upload(self, expense_id, upload_id):
+        """
+        Returns the resumable upload of an attachment of the employee, unless
+        it expired
+        :return: (upload entity, None) or (None, error response)
+        """
+        upload = self.ds_client.get(
+            self.ds_client.key(ATTACHMENT_UPLOAD_KIND, upload_id)
+        )
+        if (
+            not upload
+            or upload["expense_id"] != expense_id
+            or upload["email"] != self.employee_info["unique_name"]
+            or upload_cleanup.is_expired(upload)
+        ):
+            return None, make_response_translated("Upload niet gevonden", 404)
+
+        return upload, None
+
+    def initiate_attachment_upload(self, expense_id, data):
+        """
+        Starts a resumable upload of an attachment, the content is sent in
+        chunks to upload_attachment_chunk and stored by Cloud Storage directly.
+        Expired uploads are cleaned up when that is due.
+        :param expense_id:
+        :param data: dict with the "name", "content_type" and "size" of the file
+        :return: upload id and the chunk size to use
+        """
+        expense_key = self.ds_client.key("Expenses", expense_id)
+        expense = self.ds_client.get(expense_key)
+        if not expense:
+            return make_response_translated("Declaratie niet gevonden", 404)
+        if expense["employee"]["email"] != self.employee_info["unique_name"]:
+            return make_response_translated("Ongeautoriseerd", 403)
+
+        if data.get("content_type") not in ATTACHMENT_CONTENT_TYPES or not data.get(
+            "name"
+        ):
+            return make_response_translated(
+                "Sommige gegevens ontbraken of waren onjuist", 400
+            )
+        max_size = getattr(
+            config, "ATTACHMENT_UPLOAD_MAX_SIZE", DEFAULT_ATTACHMENT_UPLOAD_MAX_SIZE
+        )
+        if not 0 < data.get("size", 0) <= max_size:
+            return make_response_translated("Bijlage is te groot", 400)
+
+        email_name = self.employee_info["unique_name"].split("@")[0]
+        name = (
+            f"{email_name}/{expense.key.id_or_name}/"
+            f"{self._attachment_filename(data['name'])}"
+        )
+
+        bucket = bucket_handles.get(self.cs_client, self.bucket_name)
+        blob = bucket.blob(
+            upload_blob_name({"name": name, "content_type": data["content_type"]})
+        )
+        if data["content_type"] == "application/pdf":
+            # Uploaded PDFs are flattened when the upload is complete
+            blob.metadata = {"status": ATTACHMENT_STATUS_PENDING}
+
+        session_url = blob.create_resumable_upload_session(
+            content_type=data["content_type"], size=data["size"]
+        )
+
+        upload_id = secrets.token_urlsafe(ATTACHMENT_UPLOAD_ID_BYTES)
+        upload = datastore.Entity(
+            self.ds_client.key(ATTACHMENT_UPLOAD_KIND, upload_id),
+            exclude_from_indexes=("session_url",),
+        )
+        upload.update(
+            {
+                "expense_id": expense.key.id_or_name,
+                "email": self.employee_info["unique_name"],
+                "name": name,
+                "content_type": data["content_type"],
+                "size": data["size"],
+                "session_url": session_url,
+                "created": datetime.datetime.now(datetime.timezone.utc),
+            }
+        )
+        self.ds_client.put(upload)
+
+        upload_cleanup.run_if_due(self.ds_client, bucket)
+
+        return make_response(
+            jsonify(
+                {
+                    "upload_id": upload_id,
+                    "size": data["size"],
+                    "chunk_size": getattr(
+                        config,
+                        "ATTACHMENT_UPLOAD_CHUNK_SIZE",
+                        DEFAULT_ATTACHMENT_UPLOAD_CHUNK_SIZE,
+                    ),
+                }
+            ),
+            201,
+        )
+
+    def get_attachment_upload_status(self, expense_id, upload_id):
+        """
+        Returns the number of bytes that were persisted, so an interrupted
+        upload can be resumed from there
+        :param expense_id:
+        :param upload_id:
+        """
+        upload, error = self._get_attachment_upload(expense_id, upload_id)
+        if error:
+            return error
 
-    def add_attachment(self, expense_id, data):
-        expense_key = self.ds_client.key("Expenses", expense_id)
-        expense = self.ds_client.get(expense_key)
-        if not expense:
-            return make_response_translated("Declaratie niet gevonden", 404)
-        if expense["employee"]["email"] != self.employee_info["unique_name"]:
-            return make_response_translated("Ongeautoriseerd", 403)
+        try:
+            offset = get_persisted_size(upload["session_url"], upload["size"])
+        except UploadSessionNotFound:
+            return make_response_translated("Upload niet gevonden", 404)
 
-        creation = self.create_attachment(
-            data, expense.key.id_or_name, self.employee_info["unique_name"]
+        return jsonify(
+            {"upload_id": upload_id, "offset": offset, "size": upload["size"]}
         )
 
-        if not creation:
+    def upload_attachment_chunk(self, expense_id, upload_id, content_range, chunk):
+        """
+        Sends a chunk of an attachment to its resumable upload, the chunk that
+        completes the upload adds the attachment to the expense
+        :param expense_id:
+        :param upload_id:
+        :param content_range: Content-Range header of the chunk
+        :param chunk: bytes of the chunk
+        """
+        upload, error = self._get_attachment_upload(expense_id, upload_id)
+        if error:
+            return error
+
+        first, last, size = parse_content_range(content_range) or (0, -1, None)
+        if (
+            size != upload["size"]
+            or last - first + 1 != len(chunk)
+            # Only the last chunk can be of any size
+            or (last + 1 < size and len(chunk) % UPLOAD_CHUNK_ALIGNMENT)
+        ):
             return make_response_translated(
-                "Er ging iets fout tijdens het uploaden van bestanden", 400
+                "Sommige gegevens ontbraken of waren onjuist", 400
             )
-        return 201
+
+        try:
+            offset = upload_chunk(upload["session_url"], chunk, first, size)
+        except UploadSessionNotFound:
+            return make_response_translated("Upload niet gevonden", 404)
+
+        status = {"upload_id": upload_id, "offset": offset, "size": upload["size"]}
+        if offset == upload["size"]:
+            status["attachment"], error = self._complete_attachment_upload(
+                expense_id, upload
+            )
+            if error:
+                return error
+
+        return jsonify(status)
+
+    def finalize_attachment_upload(self, expense_id, upload_id):
+        """
+        Completes a resumable upload, when the last chunk did not already
+        :param expense_id:
+        :param upload_id:
+        """
+        upload, error = self._get_attachment_upload(expense_id, upload_id)
+        if error:
+            return error
+
+        if not upload.get("completed"):
+            try:
+                offset = get_persisted_size(upload["session_url"], upload["size"])
+            except UploadSessionNotFound:
+                return make_response_translated("Upload niet gevonden", 404)
+
+            if offset < upload["size"]:
+                return make_response_translated("Upload is niet compleet", 409)
+
+        attachment, error = self._complete_attachment_upload(expense_id, upload)
+        if error:
+            return error
+
+        return make_response(jsonify(attachment), 201)
+
+    def _complete_attachment_upload(self, expense_id, upload):
+        """
+        Adds a completely uploaded attachment to the expense and queues uploaded
+        PDFs to be flattened. The upload is kept as completed until it expires,
+        so completing it again returns the same attachment.
+        :return: (attachment, None) or (None, error response)
+        """
+        bucket = bucket_handles.get(self.cs_client, self.bucket_name)
+        blob = bucket.blob(upload_blob_name(upload))
+        if upload["content_type"] == "application/pdf":
+            status = ATTACHMENT_STATUS_PENDING
+        else:
+            status = ATTACHMENT_STATUS_PROCESSED
+        attachment = {
+            "name": upload["name"].split("/")[-1],
+            "content_type": upload["content_type"],
+            "size": upload["size"],
+            "status": status,
+        }
+
+        if upload.get("completed"):
+            return attachment, None
+
+        if not self._add_uploaded_attachment(expense_id, blob, attachment):
+            self.ds_client.delete(upload.key)
+            return None, make_response_translated(
+                "Er ging iets fout tijdens het uploaden van bestanden", 500
+            )
+
+        upload["completed"] = True
+        self.ds_client.put(upload)
+
+        if status == ATTACHMENT_STATUS_PENDING:
+            attachment_processor.submit(
+                bucket,
+                upload["name"],
+                None,
+                upload["content_type"],
+                self._set_attachment_status,
+            )
+
+        return attachment, None
 
 
 class ManagerExpenses(ClaimExpenses):
@@ -1693,40 +2332,45 @@ class ManagerExpenses(ClaimExpenses):
             == self.get_manager_identifying_value()
         )
 
-    def _process_expenses_info(self, expenses_info):
+    def _process_expenses_info(self, expenses_info, cost_type_index=None):
         expenses_data = expenses_info.fetch()
         if expenses_data:
-            cost_type_list = list(self.ds_client.query(kind="CostTypes").fetch())
+            if cost_type_index is None:
+                cost_type_index = cost_types_cache.get_index(self.ds_client)
 
-            expenses_list = []
-            for ed in expenses_data:
+            return [
+                self._process_expense_info(ed.id, ed, cost_type_index)
+                for ed in expenses_data
+            ]
+        return []
 
-                cost_type_entity, cost_type_active = self._process_cost_type(
-                    ed["cost_type"], cost_type_list
-                )
-                cost_type = (
-                    None if cost_type_entity is None else cost_type_entity.key.name
-                )
+    def _process_expense_info(self, expense_id, ed, cost_type_index):
+        """
+        Creates the list item of an expense or of its inbox entry
+        :param expense_id: id of the expense
+        :param ed: Expenses entity, or the entry of the expense in a ManagerInbox
+        :param cost_type_index: see CostTypesCache.get_index
+        """
+        cost_type_entity, cost_type_active = self._process_cost_type(
+            ed["cost_type"], cost_type_index
+        )
+        cost_type = None if cost_type_entity is None else cost_type_entity.key.name
 
-                expenses_list.append(
-                    {
-                        "id": ed.id,
-                        "amount": ed["amount"],
-                        "note": ed["note"],
-                        "cost_type": cost_type,
-                        "claim_date": ed["claim_date"],
-                        "transaction_date": ed["transaction_date"],
-                        "employee": ed["employee"]["full_name"],
-                        "status": self._merge_rejection_note(ed["status"]),
-                        "manager_type": ed.get("manager_type"),
-                        "flags": ed.get("flags", {}),
-                    }
-                )
-            return expenses_list
-        return []
+        return {
+            "id": expense_id,
+            "amount": ed["amount"],
+            "note": ed["note"],
+            "cost_type": cost_type,
+            "claim_date": ed["claim_date"],
+            "transaction_date": ed["transaction_date"],
+            "employee": ed["employee"]["full_name"],
+            "status": self._merge_rejection_note(ed["status"]),
+            "manager_type": ed.get("manager_type"),
+            "flags": ed.get("flags", {}),
+        }
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, clients=client_registry):
+        super().__init__(clients)
         self.manager_number = self.get_manager_identifying_value()
 
     def get_manager_identifying_value(self):
@@ -1736,51 +2380,130 @@ class ManagerExpenses(ClaimExpenses):
 
         return None
 
+    def _create_inbox_query(self, property_name, value):
+        expenses_query = self._create_expenses_query()
+        expenses_query.add_filter("status.text", "=", "ready_for_manager")
+        expenses_query.add_filter(property_name, "=", value)
+        return expenses_query
+
     def get_all_expenses(self):
-        expense_data = []
+        expense_data = self._query_inbox_expenses()
+
+        if expense_data:
+            return jsonify(expense_data)
 
-        # Fetch configured managers
+        return make_response("", 204)
+
+    def _query_inbox_expenses(self):
+        """
+        Query the expenses that are ready for this manager. The queries of the
+        inbox run concurrently, share one cost type index and are merged on
+        claim_date, as each of them is already sorted.
+        """
+        queries = []
+
+        # Fetch configured managers, one query per employee because Datastore
+        # has no IN filter and equality filters on one property never all match
         configured_managers = config.AFAS_DATA_EMEND.get("managers", dict())
         if str(self.manager_number) in configured_managers:
-            employees = configured_managers[str(self.manager_number)].get("employees", list())
-            expenses_query = self._create_expenses_query()
-
-            expenses_query.add_filter("status.text", "=", "ready_for_manager")
+            employees = configured_managers[str(self.manager_number)].get(
+                "employees", list()
+            )
             for employee in employees:
-                expenses_query.add_filter("employee.afas_data.Personeelsnummer", "=", int(employee))
-
-            expense_data += self._process_expenses_info(expenses_query)
+                queries.append(
+                    self._create_inbox_query(
+                        "employee.afas_data.Personeelsnummer", int(employee)
+                    )
+                )
 
         # Retrieve manager's expenses
-        expenses_info = self._create_expenses_query()
-        expenses_info.add_filter("status.text", "=", "ready_for_manager")
-        expenses_info.add_filter(
-            "employee.afas_data.Manager_personeelsnummer", "=", self.manager_number
+        manager_index = len(queries)
+        queries.append(
+            self._create_inbox_query(
+                "employee.afas_data.Manager_personeelsnummer", self.manager_number
+            )
         )
 
-        for expense in self._process_expenses_info(expenses_info):
-            if (
-                "manager_type" in expense
-                and expense["manager_type"] == "leasecoordinator"
-            ):
-                continue
-
-            expense_data.append(expense)
-
         # Retrieve lease coordinator's expenses if correct role
         if "leasecoordinator.write" in self.employee_info.get("scopes", []):
-            expenses_lease = self._create_expenses_query()
-            expenses_lease.add_filter("manager_type", "=", "leasecoordinator")
-            expenses_lease.add_filter("status.text", "=", "ready_for_manager")
+            queries.append(self._create_inbox_query("manager_type", "leasecoordinator"))
+
+        cost_type_index = cost_types_cache.get_index(self.ds_client)
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(len(queries), MANAGER_INBOX_MAX_WORKERS)
+        ) as executor:
+            expense_lists = list(
+                executor.map(
+                    lambda query: self._process_expenses_info(query, cost_type_index),
+                    queries,
+                )
+            )
 
-            expense_data = expense_data + self._process_expenses_info(expenses_lease)
+        # Expenses for the lease coordinator are not for the manager
+        expense_lists[manager_index] = [
+            expense
+            for expense in expense_lists[manager_index]
+            if expense["manager_type"] != "leasecoordinator"
+        ]
 
-            expense_data.sort(key=lambda x: x["claim_date"], reverse=True)
+        expense_data = []
+        expense_ids = set()
+        for expense in heapq.merge(
+            *expense_lists, key=lambda x: x["claim_date"], reverse=True
+        ):
+            if expense["id"] not in expense_ids:
+                expense_ids.add(expense["id"])
+                expense_data.append(expense)
 
-        if expense_data:
-            return jsonify(expense_data)
+        return expense_data
 
-        return make_response("", 204)
+    def get_inbox(self, limit=None):
+        """
+        Get the number of expenses that are ready for this manager and the
+        first of them. Both are read from the ManagerInbox entities with a
+        single lookup, the expenses are queried when an inbox does not hold
+        all of them or when employees are configured for the manager.
+        :param limit: maximum number of expenses returned
+        """
+        limit = limit or getattr(
+            config, "MANAGER_INBOX_PAGE_SIZE", DEFAULT_MANAGER_INBOX_PAGE_SIZE
+        )
+        configured_managers = config.AFAS_DATA_EMEND.get("managers", dict())
+
+        if (
+            not getattr(config, "MANAGER_INBOX_ENABLED", False)
+            or self.manager_number is None
+            or str(self.manager_number) in configured_managers
+        ):
+            expense_data = self._query_inbox_expenses()
+            return jsonify(
+                {"count": len(expense_data), "expenses": expense_data[:limit]}
+            )
+
+        names = [str(self.manager_number)]
+        if "leasecoordinator.write" in self.employee_info.get("scopes", []):
+            names.extend(lease_coordinator_inboxes())
+
+        inboxes = self.ds_client.get_multi(
+            [inbox_key(self.ds_client, name) for name in names]
+        )
+        count = sum(inbox["count"] for inbox in inboxes)
+
+        if all(is_complete(inbox) for inbox in inboxes):
+            cost_type_index = cost_types_cache.get_index(self.ds_client)
+            entries = heapq.merge(
+                *[inbox["expenses"] for inbox in inboxes],
+                key=lambda x: x["claim_date"],
+                reverse=True,
+            )
+            expense_data = [
+                self._process_expense_info(entry["id"], entry, cost_type_index)
+                for entry in itertools.islice(entries, limit)
+            ]
+        else:
+            expense_data = self._query_inbox_expenses()[:limit]
+
+        return jsonify({"count": count, "expenses": expense_data})
 
     def _prepare_context_update_expense(self, expense):
         # Check if expense is for manager
@@ -1835,24 +2558,28 @@ class ControllerExpenses(ClaimExpenses):
     def _check_attachment_permission(self, expense):
         return True
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, clients=client_registry):
+        super().__init__(clients)
 
-    def get_all_expenses(self):
-        """Get JSON of all the expenses"""
+    def get_all_expenses(self, limit=None, cursor=None):
+        """Get JSON of all the expenses, or a single page of them when a limit is given"""
 
-        expenses_info = self.ds_client.query(kind="Expenses")
+        expenses_info = self.ds_client.query(kind=expenses_list_kind())
 
-        expenses_data = expenses_info.fetch()
+        try:
+            expenses_data, next_cursor = self._fetch_page(expenses_info, limit, cursor)
+        except ValueError as exception:
+            return make_response_translated(str(exception), 400)
 
-        if expenses_data:
+        # A page is always returned, even an empty one, so clients can stop paging
+        if expenses_data or limit is not None:
 
-            cost_type_list = list(self.ds_client.query(kind="CostTypes").fetch())
+            cost_type_index = cost_types_cache.get_index(self.ds_client)
             results = []
 
             for ed in expenses_data:
                 cost_type_entity, cost_type_active = self._process_cost_type(
-                    ed["cost_type"], cost_type_list
+                    ed["cost_type"], cost_type_index
                 )
                 cost_type = (
                     None if cost_type_entity is None else cost_type_entity.key.name
@@ -1877,6 +2604,10 @@ class ControllerExpenses(ClaimExpenses):
                         "status": self._merge_rejection_note(ed["status"]),
                     }
                 )
+
+            if limit is not None:
+                return jsonify({"expenses": results, "next_cursor": next_cursor})
+
             return jsonify(results)
 
         return make_response("", 204)
@@ -1889,11 +2620,17 @@ class CreditorExpenses(ClaimExpenses):
     def _check_attachment_permission(self, expense):
         return True
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, clients=client_registry):
+        super().__init__(clients)
 
-    def get_all_expenses(self, expenses_list, date_from, date_to):
-        """Get JSON/CSV of all the expenses"""
+    def get_all_expenses(
+        self, expenses_list, date_from, date_to, limit=None, cursor=None, stream=False
+    ):
+        """
+        Get JSON/CSV of all the expenses, or a single page of them when a limit is given
+        :param stream: return the expense rows as a generator instead of a list
+        :return: tuple of the expense rows and the cursor of the next page
+        """
         day_from = "1970-01-01T00:00:00Z"
         day_to = datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z"
 
@@ -1905,75 +2642,76 @@ class CreditorExpenses(ClaimExpenses):
         if date_from > date_to:
             return make_response_translated("Startdatum is later dan einddatum", 403)
 
-        expenses_ds = self.ds_client.query(kind="Expenses")
+        expenses_ds = self.ds_client.query(kind=expenses_list_kind())
         expenses_ds.add_filter("claim_date", ">=", day_from)
         expenses_ds.add_filter("claim_date", "<=", day_to)
-        expenses_data = expenses_ds.fetch()
 
-        query_filter: Dict[Any, str] = dict(
-            creditor="ready_for_creditor", creditor2="approved"
-        )
+        try:
+            expenses_data, next_cursor = self._fetch_page(expenses_ds, limit, cursor)
+        except ValueError as exception:
+            return make_response_translated(str(exception), 400)
 
-        if expenses_data:
-            cost_type_list = list(self.ds_client.query(kind="CostTypes").fetch())
-            results = []
+        if expenses_data or limit is not None:
+            expense_rows = self._generate_expense_rows(expenses_list, expenses_data)
+            if stream:
+                return expense_rows, next_cursor
 
-            for expense in expenses_data:
-                expense["status"] = self._merge_rejection_note(expense["status"])
+            return list(expense_rows), next_cursor
 
-                cost_type_entity, cost_type_active = self._process_cost_type(
-                    expense["cost_type"], cost_type_list
-                )
-                cost_type = (
-                    None if cost_type_entity is None else cost_type_entity.key.name
-                )
+        return make_response("", 204)
 
-                expense_row = {
-                    "id": expense.id,
-                    "amount": expense["amount"],
-                    "note": expense["note"],
-                    "cost_type": cost_type,
-                    "claim_date": expense["claim_date"],
-                    "transaction_date": expense["transaction_date"],
-                    "employee": expense["employee"]["full_name"],
-                    "company_name": expense["employee"]["afas_data"]["Bedrijf"],
-                    "department_code": expense["employee"]["afas_data"][
-                        "Afdeling Code"
-                    ],
-                    "department_descr": expense["employee"]["afas_data"][
-                        "Afdelingsomschrijving"
-                    ],
-                    "status": expense["status"],
-                    "auto_approved": expense.get("auto_approved", ""),
-                    "manager": expense.get("employee", {})
-                    .get("afas_data", {})
-                    .get(
-                        "Manager_personeelsnummer", "Manager not found: check expense"
-                    ),
-                    "export_date": expense["status"].get("export_date", ""),
-                    "flags": expense.get("flags", {}),
-                }
+    def _generate_expense_rows(self, expenses_list, expenses_data):
+        query_filter: Dict[Any, str] = dict(
+            creditor="ready_for_creditor", creditor2="approved"
+        )
+        cost_type_index = cost_types_cache.get_index(self.ds_client)
 
-                expense_row["export_date"] = (expense_row["export_date"], "")[
-                    expense_row["export_date"] == "never"
-                ]
+        for expense in expenses_data:
+            expense["status"] = self._merge_rejection_note(expense["status"])
+
+            cost_type_entity, cost_type_active = self._process_cost_type(
+                expense["cost_type"], cost_type_index
+            )
+            cost_type = None if cost_type_entity is None else cost_type_entity.key.name
 
-                if expenses_list == "expenses_creditor":
-                    if (
-                        query_filter["creditor"] == expense["status"]["text"]
-                        or query_filter["creditor2"] == expense["status"]["text"]
-                    ):
-                        results.append(expense_row)
+            expense_row = {
+                "id": expense.id,
+                "amount": expense["amount"],
+                "note": expense["note"],
+                "cost_type": cost_type,
+                "claim_date": expense["claim_date"],
+                "transaction_date": expense["transaction_date"],
+                "employee": expense["employee"]["full_name"],
+                "company_name": expense["employee"]["afas_data"]["Bedrijf"],
+                "department_code": expense["employee"]["afas_data"]["Afdeling Code"],
+                "department_descr": expense["employee"]["afas_data"][
+                    "Afdelingsomschrijving"
+                ],
+                "status": expense["status"],
+                "auto_approved": expense.get("auto_approved", ""),
+                "manager": expense.get("employee", {})
+                .get("afas_data", {})
+                .get("Manager_personeelsnummer", "Manager not found: check expense"),
+                "export_date": expense["status"].get("export_date", ""),
+                "flags": expense.get("flags", {}),
+            }
 
-                if expenses_list == "expenses_all":
-                    results.append(expense_row)
+            expense_row["export_date"] = (expense_row["export_date"], "")[
+                expense_row["export_date"] == "never"
+            ]
 
-            return results
+            if expenses_list == "expenses_creditor":
+                if (
+                    query_filter["creditor"] == expense["status"]["text"]
+                    or query_filter["creditor2"] == expense["status"]["text"]
+                ):
+                    yield expense_row
 
-        return make_response("", 204)
+            if expenses_list == "expenses_all":
+                yield expense_row
 
     def get_all_expenses_journal(self, date_from, date_to):
-        """Get CSV of all the expenses from Expenses_Journal"""
+        """Get a generator of all the expense changes from Expenses_Journal"""
         day_from = "1970-01-01T00:00:00Z"
         day_to = datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z"
 
@@ -1988,17 +2726,13 @@ class CreditorExpenses(ClaimExpenses):
         expenses_ds = self.ds_client.query(kind="Expenses_Journal")
         expenses_ds.add_filter("Time", ">=", day_from)
         expenses_ds.add_filter("Time", "<=", day_to)
-        expenses_data = expenses_ds.fetch()
-
-        if expenses_data:
-            results = []
-
-            for expense in expenses_data:
-                if expense["Attributes_Changed"] != "[]":
-                    results += self.expense_changes(expense)
-            return results
 
-        return make_response("", 204)
+        return (
+            change
+            for expense in expenses_ds.fetch()
+            if expense["Attributes_Changed"] != "[]"
+            for change in self.expense_changes(expense)
+        )
 
     def expense_changes(self, expense):
         """
@@ -2154,20 +2888,39 @@ def add_expense():
         return jsonify("Something is wrong with the request"), 400
 
 
-def get_all_creditor_expenses(expenses_list, date_from, date_to):
+def get_all_creditor_expenses(
+    expenses_list, date_from, date_to, limit=None, cursor=None
+):
     """
-    Get all expenses
+    Get all expenses, paginated when a limit is given and JSON is requested
     :rtype: None
     """
     if expenses_list not in ["expenses_creditor", "expenses_all"]:
         return make_response_translated("Geen geldige queryparameter", 400)
 
+    format_expense = connexion.request.headers["Accept"]
+
+    # CSV exports are streamed and always contain every expense in the date range
+    stream = "application/json" not in format_expense
+    if stream:
+        limit = cursor = None
+
     expense_instance = CreditorExpenses()
     expenses_data = expense_instance.get_all_expenses(
-        expenses_list=expenses_list, date_from=date_from, date_to=date_to
+        expenses_list=expenses_list,
+        date_from=date_from,
+        date_to=date_to,
+        limit=limit,
+        cursor=cursor,
+        stream=stream,
     )
 
-    format_expense = connexion.request.headers["Accept"]
+    if isinstance(expenses_data, Response):
+        return expenses_data
+
+    expenses_data, next_cursor = expenses_data
+    if limit is not None:
+        return jsonify({"expenses": expenses_data, "next_cursor": next_cursor})
 
     return get_expenses_format(
         expenses_data=expenses_data, format_expense=format_expense
@@ -2260,58 +3013,160 @@ def get_document(document_id, document_type):
 def get_expenses_format(expenses_data, format_expense):
     """
     Get format of expenses export: csv/json
-    :param expenses_data:
+    :param expenses_data: list or iterator of expense rows
     :param format_expense:
-    :param extra_fields:
     :return:
     """
-    if not expenses_data:
-        return make_response("", 204)
-
     if isinstance(expenses_data, Response):
         return expenses_data
 
     if "application/json" in format_expense:
         logging.debug("Creating json table")
+        expenses_data = list(expenses_data or [])
+        if not expenses_data:
+            return make_response("", 204)
+
         return jsonify(expenses_data)
 
     if "text/csv" in format_expense:
-        logging.debug("Creating csv file")
+        logging.debug("Creating csv stream")
         try:
-            with tempfile.NamedTemporaryFile("w") as csv_file:
-                # Set CSV writer and header
-                field_names = list(expenses_data[0].keys())
-                csv_writer = csv.DictWriter(
-                    csv_file,
-                    fieldnames=field_names,
-                    delimiter=",",
-                    quotechar='"',
-                    quoting=csv.QUOTE_MINIMAL,
-                )
-                csv_writer.writeheader()
+            expenses_iter = iter(expenses_data or [])
+            first_expense = next(expenses_iter, None)
+        except Exception:
+            logging.exception(
+                "Exception on reading expenses for CSV in get_all_expenses"
+            )
+            return make_response_translated("Er ging iets fout", 400)
+
+        if first_expense is None:
+            return make_response("", 204)
+
+        # No Content-Length is set, so the CSV is sent with chunked transfer encoding
+        return Response(
+            stream_with_context(generate_csv(first_expense, expenses_iter)),
+            mimetype="text/csv",
+            headers={"Content-Disposition": "attachment; filename=tmp.csv"},
+        )
+
+    return make_response_translated("Verzoek mist een Accept-header", 400)
 
-                for expense in expenses_data:
-                    if "status" in expense:
-                        expense["status"] = expense["status"]["text"]
 
-                    for field in expense:
-                        if isinstance(expense[field], str):
-                            expense[field] = expense[field].replace("\n", " ")
+def generate_attachments_json(blobs, pending_blobs=()):
+    """
+    Generate the JSON list of attachments with their base64 encoded content.
+    Attachments are downloaded concurrently by a bounded pool and the content
+    is encoded and sent in chunks. Besides the attachment being sent, at most
+    ATTACHMENT_DOWNLOAD_WORKERS downloaded attachments are held in memory.
+
+    The first attachment is downloaded before this returns, so when it fails
+    this raises and the request fails as a whole. A later download failure can
+    no longer change the status: the response is then aborted without its
+    terminating chunk, so clients see a failed transfer instead of a complete
+    list.
+    :param blobs: list of attachment blobs
+    :param pending_blobs: list of unprocessed attachment blobs, listed without content
+    :return: iterator of str
+    """
+    chunks = _generate_attachments_json(blobs, pending_blobs)
+
+    return itertools.chain([next(chunks)], chunks)
+
 
-                    csv_writer.writerow(expense)
+def _generate_attachments_json(blobs, pending_blobs):
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=ATTACHMENT_DOWNLOAD_WORKERS
+    ) as executor:
+        downloads = collections.deque()
+        blobs_iter = iter(blobs)
 
-                csv_file.flush()
-                return send_file(
-                    csv_file.name,
-                    mimetype="text/csv",
-                    as_attachment=True,
-                    attachment_filename="tmp.csv",
+        for blob in itertools.islice(blobs_iter, ATTACHMENT_DOWNLOAD_WORKERS):
+            downloads.append((blob, executor.submit(blob.download_as_bytes)))
+
+        if downloads:
+            downloads[0][1].result()
+
+        yield "["
+
+        separator = ""
+        while downloads:
+            blob, download = downloads.popleft()
+            try:
+                content = memoryview(download.result())
+            except Exception:
+                logging.exception(f"Downloading attachment '{blob.name}' failed")
+                raise
+            del download
+
+            next_blob = next(blobs_iter, None)
+            if next_blob is not None:
+                downloads.append(
+                    (next_blob, executor.submit(next_blob.download_as_bytes))
                 )
-        except Exception:
-            logging.exception("Exception on writing/sending CSV in get_all_expenses")
-            return make_response_translated("Er ging iets fout", 400)
 
-    return make_response_translated("Verzoek mist een Accept-header", 400)
+            yield f'{separator}{{"content":"'
+            for start in range(0, len(content), ATTACHMENT_ENCODE_CHUNK_SIZE):
+                yield base64.b64encode(
+                    content[start : start + ATTACHMENT_ENCODE_CHUNK_SIZE]
+                ).decode("utf-8")
+            yield (
+                f'","content_type":{json.dumps(blob.content_type)},'
+                f'"name":{json.dumps(blob.name.split("/")[-1])},'
+                f'"status":{json.dumps(attachment_status(blob))}}}'
+            )
+
+            separator = ","
+            del content
+
+        for blob in pending_blobs:
+            yield separator + json.dumps(
+                {
+                    "content_type": blob.content_type,
+                    "name": blob.name.split("/")[-1],
+                    "status": attachment_status(blob),
+                }
+            )
+            separator = ","
+
+        yield "]"
+
+
+def generate_csv(first_expense, expenses_iter):
+    """
+    Generate CSV chunks of expense rows, the header is based on the first row
+    :param first_expense: first expense row
+    :param expenses_iter: iterator of the remaining expense rows
+    """
+    csv_buffer = io.StringIO()
+    csv_writer = csv.DictWriter(
+        csv_buffer,
+        fieldnames=list(first_expense.keys()),
+        delimiter=",",
+        quotechar='"',
+        quoting=csv.QUOTE_MINIMAL,
+    )
+    csv_writer.writeheader()
+
+    try:
+        for expense in itertools.chain([first_expense], expenses_iter):
+            if "status" in expense:
+                expense["status"] = expense["status"]["text"]
+
+            for field in expense:
+                if isinstance(expense[field], str):
+                    expense[field] = expense[field].replace("\n", " ")
+
+            csv_writer.writerow(expense)
+
+            if csv_buffer.tell() >= CSV_STREAM_CHUNK_SIZE:
+                yield csv_buffer.getvalue()
+                csv_buffer.seek(0)
+                csv_buffer.truncate(0)
+    except Exception:
+        logging.exception("Exception on writing/sending CSV in get_all_expenses")
+        raise
+
+    yield csv_buffer.getvalue()
 
 
 def get_document_list():
@@ -2335,13 +3190,22 @@ def get_managers_expenses():
     return expense_instance.get_all_expenses()
 
 
-def get_controller_expenses():
+def get_managers_inbox(limit=None):
+    """
+    Get the number of expenses waiting for the manager and the first of them
+    :return:
+    """
+    expense_instance = ManagerExpenses()
+    return expense_instance.get_inbox(limit=limit)
+
+
+def get_controller_expenses(limit=None, cursor=None):
     """
-    Get all expenses for controller
+    Get all expenses for controller, paginated when a limit is given
     :return:
     """
     expense_instance = ControllerExpenses()
-    return expense_instance.get_all_expenses()
+    return expense_instance.get_all_expenses(limit=limit, cursor=cursor)
 
 
 def get_employee_expenses(employee_id):
@@ -2458,34 +3322,36 @@ def get_expenses_controller(expenses_id):
     return expense_instance.get_expenses(expenses_id, "controller")
 
 
-def get_attachment_creditor(expenses_id):
+def get_attachment_creditor(expenses_id, mode="content"):
     """
     Get attachment by expenses id
     :param expenses_id:
+    :param mode:
     :return:
     """
     expense_instance = CreditorExpenses()
-    return expense_instance.get_attachment(expenses_id)
+    return expense_instance.get_attachment(expenses_id, mode)
 
 
-def get_attachment_manager(expenses_id):
+def get_attachment_manager(expenses_id, mode="content"):
     expense_instance = ManagerExpenses()
-    return expense_instance.get_attachment(expenses_id)
+    return expense_instance.get_attachment(expenses_id, mode)
 
 
-def get_attachment_controllers(expenses_id):
+def get_attachment_controllers(expenses_id, mode="content"):
     expense_instance = ControllerExpenses()
-    return expense_instance.get_attachment(expenses_id)
+    return expense_instance.get_attachment(expenses_id, mode)
 
 
-def get_attachment_employee(expenses_id):
+def get_attachment_employee(expenses_id, mode="content"):
     """
     Get attachment by expenses id
     :param expenses_id:
+    :param mode:
     :return:
     """
     expense_instance = EmployeeExpenses(None)
-    return expense_instance.get_attachment(expenses_id)
+    return expense_instance.get_attachment(expenses_id, mode)
 
 
 def delete_attachment(expenses_id, attachments_name):
@@ -2512,6 +3378,49 @@ def add_attachment_employee(expenses_id):
         return jsonify("Something went wrong. Please try again later"), 500
 
 
+def initiate_attachment_upload_employee(expenses_id):
+    try:
+        if connexion.request.is_json:
+            expense_instance = EmployeeExpenses(None)
+            form_data = json.loads(connexion.request.get_data().decode())
+            return expense_instance.initiate_attachment_upload(expenses_id, form_data)
+    except Exception:
+        logging.exception("Exception on initiate_attachment_upload")
+        return jsonify("Something went wrong. Please try again later"), 500
+
+
+def get_attachment_upload_employee(expenses_id, upload_id):
+    try:
+        expense_instance = EmployeeExpenses(None)
+        return expense_instance.get_attachment_upload_status(expenses_id, upload_id)
+    except Exception:
+        logging.exception("Exception on get_attachment_upload")
+        return jsonify("Something went wrong. Please try again later"), 500
+
+
+def upload_attachment_chunk_employee(expenses_id, upload_id):
+    try:
+        expense_instance = EmployeeExpenses(None)
+        return expense_instance.upload_attachment_chunk(
+            expenses_id,
+            upload_id,
+            connexion.request.headers.get("Content-Range"),
+            connexion.request.get_data(),
+        )
+    except Exception:
+        logging.exception("Exception on upload_attachment_chunk")
+        return jsonify("Something went wrong. Please try again later"), 500
+
+
+def finalize_attachment_upload_employee(expenses_id, upload_id):
+    try:
+        expense_instance = EmployeeExpenses(None)
+        return expense_instance.finalize_attachment_upload(expenses_id, upload_id)
+    except Exception:
+        logging.exception("Exception on finalize_attachment_upload")
+        return jsonify("Something went wrong. Please try again later"), 500
+
+
 def api_base_url():
     base_url = request.host_url
 
@@ -2525,14 +3434,7 @@ def api_base_url():
 
 
 def initialise_gmail_service(subject, scopes):
-    credentials, project_id = google.auth.default(
-        scopes=["https://www.googleapis.com/auth/iam"]
-    )
-    delegated_credentials = get_delegated_credentials(credentials, subject, scopes)
-    gmail_service = googleapiclient.discovery.build(
-        "gmail", "v1", credentials=delegated_credentials, cache_discovery=False
-    )
-    return gmail_service
+    return gmail_service_factory.get(subject, scopes)
 
 
 def get_employee_profile():
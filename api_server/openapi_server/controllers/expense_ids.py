@@ -0,0 +1,48 @@
+import threading
+import weakref
+
+import config
+
+DEFAULT_EXPENSE_ID_BLOCK_SIZE = 20
+
+
+class ExpenseIdPool:
+    """
+    Process-wide pool of ids reserved with allocate_ids, per Datastore client
+    and kind
+
+    A new expense needs its id before it is stored, as its summary and its
+    Expenses_Journal entry refer to it and are written in the same put_multi.
+    Reserving the ids in blocks saves the allocate_ids RPC on most adds. Ids
+    left in the pool when the instance stops are never used, which only leaves
+    gaps in the ids.
+    """
+
+    def __init__(self, block_size=DEFAULT_EXPENSE_ID_BLOCK_SIZE):
+        self.block_size = block_size
+
+        self._keys = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def complete_key(self, ds_client, incomplete_key):
+        """
+        Returns a complete key with a reserved id for an incomplete key
+        :param ds_client: Datastore client used when the pool has to be refilled
+        :param incomplete_key: partial key without parent
+        :return: complete key of the same kind
+        """
+        with self._lock:
+            keys = self._keys.setdefault(ds_client, {}).setdefault(
+                incomplete_key.kind, []
+            )
+            if not keys:
+                keys.extend(
+                    reversed(ds_client.allocate_ids(incomplete_key, self.block_size))
+                )
+
+            return keys.pop()
+
+
+expense_ids = ExpenseIdPool(
+    block_size=getattr(config, "EXPENSE_ID_BLOCK_SIZE", DEFAULT_EXPENSE_ID_BLOCK_SIZE)
+)
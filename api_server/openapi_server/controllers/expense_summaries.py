@@ -0,0 +1,96 @@
+import logging
+
+import config
+from google.cloud import datastore
+
+SUMMARY_KIND = "Expenses_Summary"
+SUMMARY_AFAS_FIELDS = [
+    "Personeelsnummer",
+    "Manager_personeelsnummer",
+    "Bedrijf",
+    "Afdeling Code",
+    "Afdelingsomschrijving",
+]
+SUMMARY_FIELDS = [
+    "amount",
+    "note",
+    "cost_type",
+    "claim_date",
+    "transaction_date",
+    "manager_type",
+    "auto_approved",
+    "flags",
+]
+
+
+def expenses_list_kind():
+    """
+    Returns the kind the list endpoints query: the lightweight summaries when
+    enabled in the config, otherwise the full Expenses entities
+    """
+    if getattr(config, "EXPENSES_LIST_FROM_SUMMARIES", False):
+        return SUMMARY_KIND
+
+    return "Expenses"
+
+
+def build_expense_summary(ds_client, expense):
+    """
+    Creates the summary entity of an expense. The summary has the same id and
+    nesting as the expense but only holds the properties the list endpoints
+    read, so listing does not load the embedded afas_data record.
+    :param ds_client: Datastore client
+    :param expense: Expenses entity, must have a complete key
+    :return: Expenses_Summary entity
+    """
+    employee = expense.get("employee", {})
+    afas_data = employee.get("afas_data") or {}
+
+    summary = datastore.Entity(key=ds_client.key(SUMMARY_KIND, expense.key.id))
+    summary.update(
+        {field: expense[field] for field in SUMMARY_FIELDS if field in expense}
+    )
+    summary["status"] = dict(expense["status"])
+    summary["employee"] = {
+        "email": employee.get("email"),
+        "full_name": employee.get("full_name"),
+        "afas_data": {
+            field: afas_data[field]
+            for field in SUMMARY_AFAS_FIELDS
+            if field in afas_data
+        },
+    }
+
+    return summary
+
+
+def backfill_expense_summaries(ds_client, batch_size=500):
+    """
+    Writes a summary for every existing expense, to be run once before
+    EXPENSES_LIST_FROM_SUMMARIES is enabled
+    :param ds_client: Datastore client
+    :param batch_size: number of summaries per put_multi, at most 500
+    :return: number of summaries written
+    """
+    summaries = []
+    count = 0
+
+    for expense in ds_client.query(kind="Expenses").fetch():
+        summaries.append(build_expense_summary(ds_client, expense))
+
+        if len(summaries) >= batch_size:
+            ds_client.put_multi(summaries)
+            count += len(summaries)
+            summaries = []
+
+    if summaries:
+        ds_client.put_multi(summaries)
+        count += len(summaries)
+
+    logging.info(f"Backfilled {count} expense summaries")
+    return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    backfill_expense_summaries(datastore.Client())
@@ -0,0 +1,150 @@
+import datetime
+import logging
+import threading
+
+import config
+import google.auth
+import requests
+from googleapiclient import discovery, discovery_cache
+from openapi_server.auth import get_delegated_credentials
+
+DEFAULT_GMAIL_CREDENTIALS_MARGIN = 300  # seconds before expiry to renew
+GMAIL_BATCH_SIZE = 100  # Maximum number of requests in a Gmail batch
+GMAIL_DISCOVERY_URL = "https://gmail.googleapis.com/$discovery/rest?version=v1"
+
+
+class GmailServiceFactory:
+    """
+    Process-wide factory of Gmail services
+
+    The discovery document is loaded once and the delegated credentials are
+    kept until shortly before they expire. Services are built per thread from
+    both, as the underlying httplib2 connection is not thread-safe, and are
+    reused for every mail sent on that thread.
+    """
+
+    def __init__(self, expiry_margin=DEFAULT_GMAIL_CREDENTIALS_MARGIN):
+        self.expiry_margin = datetime.timedelta(seconds=expiry_margin)
+        self.hits = 0
+        self.misses = 0
+
+        self._document = None
+        self._credentials = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _get_discovery_document(self):
+        if self._document is None:
+            self._document = discovery_cache.get_static_doc("gmail", "v1")
+
+            if self._document is None:
+                response = requests.get(GMAIL_DISCOVERY_URL, timeout=30)
+                response.raise_for_status()
+                self._document = response.text
+
+        return self._document
+
+    def _is_valid(self, credentials):
+        # Delegated credentials get their first token when the first mail is sent
+        if credentials.expiry is None:
+            return True
+
+        return credentials.expiry - datetime.datetime.utcnow() > self.expiry_margin
+
+    def _get_credentials(self, subject, scopes):
+        with self._lock:
+            credentials = self._credentials.get((subject, scopes))
+            if credentials is not None and self._is_valid(credentials):
+                self.hits += 1
+                return credentials
+
+            self.misses += 1
+
+            source_credentials, project_id = google.auth.default(
+                scopes=["https://www.googleapis.com/auth/iam"]
+            )
+            credentials = get_delegated_credentials(
+                source_credentials, subject, list(scopes)
+            )
+            self._credentials[(subject, scopes)] = credentials
+
+            return credentials
+
+    def get(self, subject, scopes):
+        """
+        Returns a Gmail service for the current thread
+        :param subject: address the service account acts on behalf of
+        :param scopes: list of Gmail scopes
+        :return: googleapiclient Resource
+        """
+        scopes = tuple(scopes)
+        credentials = self._get_credentials(subject, scopes)
+
+        services = getattr(self._local, "services", None)
+        if services is None:
+            services = self._local.services = {}
+
+        cached = services.get((subject, scopes))
+        if cached is not None and cached[0] is credentials:
+            return cached[1]
+
+        with self._lock:
+            document = self._get_discovery_document()
+
+        service = discovery.build_from_document(document, credentials=credentials)
+        services[(subject, scopes)] = (credentials, service)
+
+        return service
+
+    @staticmethod
+    def send_batch(service, messages, user_id="me"):
+        """
+        Sends messages with Gmail batch requests, so they share one HTTP
+        connection and request instead of one each
+        :param service: Gmail service
+        :param messages: list of message bodies, like generate_mail returns
+        :param user_id: sending user
+        :return: list of (message id, exception) tuples in the order of messages
+        """
+        results = [(None, None)] * len(messages)
+
+        def callback(request_id, response, exception):
+            results[int(request_id)] = (
+                response["id"] if exception is None else None,
+                exception,
+            )
+
+        for start in range(0, len(messages), GMAIL_BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=callback)
+            for index in range(start, min(start + GMAIL_BATCH_SIZE, len(messages))):
+                batch.add(
+                    service.users()
+                    .messages()
+                    .send(userId=user_id, body=messages[index]),
+                    request_id=str(index),
+                )
+            batch.execute()
+
+        failures = sum(1 for message_id, exception in results if exception is not None)
+        if failures:
+            logging.error(f"{failures} of {len(messages)} batched emails failed")
+
+        return results
+
+    def invalidate(self):
+        """Drops the cached credentials, services are rebuilt on the next mail"""
+        with self._lock:
+            self._credentials = {}
+
+        logging.info(f"Gmail credentials cache invalidated: {self.stats()}")
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+gmail_service_factory = GmailServiceFactory(
+    expiry_margin=getattr(
+        config, "GMAIL_CREDENTIALS_MARGIN", DEFAULT_GMAIL_CREDENTIALS_MARGIN
+    )
+)
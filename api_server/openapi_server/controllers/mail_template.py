@@ -0,0 +1,103 @@
+import logging
+import re
+import threading
+
+MAIL_TEMPLATE_FILE = "gmail_template.html"
+MAIL_PLACEHOLDERS = ["$MAIL_TITLE", "$MAIL_SALUTATION", "$MAIL_BODY", "$MAIL_FOOTER"]
+
+
+class MailTemplate:
+    """
+    Mail template compiled into static segments and placeholders
+
+    All placeholders are substituted in a single pass, so a value that contains
+    a placeholder is never substituted again. Values that are the same for many
+    mails, like the footer of a locale, can be bound into the static segments
+    once with partial.
+    """
+
+    PLACEHOLDER_PATTERN = re.compile(
+        "({})".format(
+            "|".join(
+                re.escape(placeholder)
+                for placeholder in sorted(MAIL_PLACEHOLDERS, key=len, reverse=True)
+            )
+        )
+    )
+
+    def __init__(self, segments, placeholders):
+        self._segments = segments
+        self._placeholders = placeholders
+        self._partials = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def compile(cls, template):
+        parts = cls.PLACEHOLDER_PATTERN.split(template)
+        return cls(parts[::2], parts[1::2])
+
+    def partial(self, values):
+        """
+        Returns the template with the given placeholders rendered into the static
+        segments. Partials are cached, so this is cheap to call for every mail.
+        :param values: dict of placeholder to value
+        :return: MailTemplate
+        """
+        cache_key = tuple(sorted(values.items()))
+        compiled = self._partials.get(cache_key)
+        if compiled is not None:
+            return compiled
+
+        segments = [self._segments[0]]
+        placeholders = []
+        for placeholder, segment in zip(self._placeholders, self._segments[1:]):
+            if placeholder in values:
+                segments[-1] += values[placeholder] + segment
+            else:
+                placeholders.append(placeholder)
+                segments.append(segment)
+
+        compiled = MailTemplate(segments, placeholders)
+        with self._lock:
+            self._partials[cache_key] = compiled
+
+        return compiled
+
+    def render(self, values):
+        """
+        Renders the template
+        :param values: dict of placeholder to value for every remaining placeholder
+        :return: str
+        """
+        parts = [self._segments[0]]
+        for placeholder, segment in zip(self._placeholders, self._segments[1:]):
+            parts.append(values[placeholder])
+            parts.append(segment)
+
+        return "".join(parts)
+
+
+_mail_template = None
+_mail_template_lock = threading.Lock()
+
+
+def get_mail_template():
+    """
+    Returns the compiled mail template, it is read from disk only once
+    :return: MailTemplate
+    """
+    global _mail_template
+
+    if _mail_template is None:
+        with _mail_template_lock:
+            if _mail_template is None:
+                with open(MAIL_TEMPLATE_FILE, "r") as mail_template:
+                    _mail_template = MailTemplate.compile(mail_template.read())
+
+    return _mail_template
+
+
+try:
+    get_mail_template()
+except FileNotFoundError:
+    logging.info(f"Mail template '{MAIL_TEMPLATE_FILE}' is loaded on first use")
@@ -0,0 +1,189 @@
+import datetime
+import logging
+
+from google.cloud import datastore
+
+INBOX_KIND = "ManagerInbox"
+INBOX_STATUS = "ready_for_manager"
+LEASE_COORDINATOR_INBOX = "leasecoordinator"
+LEASE_COORDINATOR_INBOX_SHARDS = 8  # Spreads the writes to the shared inbox
+INBOX_MAX_EXPENSES = 1000  # Keeps the inbox well below the 1 MiB entity limit
+INBOX_EXPENSE_FIELDS = [
+    "amount",
+    "note",
+    "cost_type",
+    "claim_date",
+    "transaction_date",
+    "manager_type",
+    "flags",
+]
+
+
+def inbox_name(expense):
+    """
+    Returns the name of the inbox an expense is waiting in: the number of the
+    manager, or the shard of the inbox shared by the lease coordinators
+    :param expense: Expenses entity or None, must have a complete key
+    :return: name of the inbox, None when the expense is not waiting for a manager
+    """
+    if not expense or expense["status"]["text"] != INBOX_STATUS:
+        return None
+
+    if expense.get("manager_type") == "leasecoordinator":
+        shard = expense.key.id % LEASE_COORDINATOR_INBOX_SHARDS
+        return f"{LEASE_COORDINATOR_INBOX}-{shard}"
+
+    afas_data = expense["employee"].get("afas_data") or {}
+    if afas_data.get("Manager_personeelsnummer") is None:
+        return None
+
+    return str(afas_data["Manager_personeelsnummer"])
+
+
+def lease_coordinator_inboxes():
+    """
+    Returns the names of the shards of the inbox shared by the lease
+    coordinators. Every expense that is submitted or assessed for a lease
+    coordinator updates the inbox in its transaction, a single entity would
+    make those transactions conflict.
+    """
+    return [
+        f"{LEASE_COORDINATOR_INBOX}-{shard}"
+        for shard in range(LEASE_COORDINATOR_INBOX_SHARDS)
+    ]
+
+
+def inbox_key(ds_client, name):
+    return ds_client.key(INBOX_KIND, name)
+
+
+def create_inbox(ds_client, name):
+    inbox = datastore.Entity(
+        key=inbox_key(ds_client, name), exclude_from_indexes=("expense_ids", "expenses")
+    )
+    inbox.update({"count": 0, "expense_ids": [], "expenses": []})
+    return inbox
+
+
+def build_inbox_entry(expense):
+    """
+    Creates the lightweight summary of an expense that is kept in the inbox,
+    with the properties the manager list reads
+    :param expense: Expenses entity, must have a complete key
+    :return: dict
+    """
+    entry = {
+        field: expense[field] for field in INBOX_EXPENSE_FIELDS if field in expense
+    }
+    entry["id"] = expense.key.id
+    entry["status"] = dict(expense["status"])
+    entry["employee"] = {"full_name": expense["employee"]["full_name"]}
+    return entry
+
+
+def is_complete(inbox):
+    """Whether the inbox holds the summary of every expense it counts"""
+    return len(inbox["expenses"]) == inbox["count"]
+
+
+def remove_from_inbox(inbox, expense_id):
+    inbox["expense_ids"] = [
+        other for other in inbox["expense_ids"] if other != expense_id
+    ]
+    inbox["expenses"] = [
+        entry for entry in inbox["expenses"] if entry["id"] != expense_id
+    ]
+    inbox["count"] = len(inbox["expense_ids"])
+
+
+def add_to_inbox(inbox, expense):
+    """
+    Adds an expense to the inbox, its summary is only kept while the inbox is
+    complete and below INBOX_MAX_EXPENSES, otherwise only the count is
+    """
+    complete = is_complete(inbox)
+
+    inbox["expense_ids"] = inbox["expense_ids"] + [expense.key.id]
+    inbox["count"] = len(inbox["expense_ids"])
+
+    if complete and len(inbox["expenses"]) < INBOX_MAX_EXPENSES:
+        inbox["expenses"] = sorted(
+            inbox["expenses"] + [build_inbox_entry(expense)],
+            key=lambda entry: entry["claim_date"],
+            reverse=True,
+        )
+
+
+def update_manager_inboxes(ds_client, expense, old_expense=None):
+    """
+    Moves an expense between the inboxes when its status or manager changes,
+    and refreshes its summary while it stays in an inbox. Must be called in
+    the transaction that stores the expense, the inboxes it returns are stored
+    in the same commit.
+    :param ds_client: Datastore client
+    :param expense: Expenses entity after the mutation, must have a complete key
+    :param old_expense: expense before the mutation, None or an empty dict for a new one
+    :return: list of changed ManagerInbox entities
+    """
+    old_name = inbox_name(old_expense)
+    new_name = inbox_name(expense)
+    names = [name for name in dict.fromkeys([old_name, new_name]) if name]
+    if not names:
+        return []
+
+    inboxes = {
+        inbox.key.name: inbox
+        for inbox in ds_client.get_multi([inbox_key(ds_client, name) for name in names])
+    }
+
+    changed = []
+    for name in names:
+        inbox = inboxes.get(name) or create_inbox(ds_client, name)
+        remove_from_inbox(inbox, expense.key.id)
+        if name == new_name:
+            add_to_inbox(inbox, expense)
+
+        inbox["updated"] = (
+            datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z"
+        )
+        changed.append(inbox)
+
+    return changed
+
+
+def rebuild_manager_inboxes(ds_client, batch_size=500):
+    """
+    Rebuilds every inbox from the expenses that are ready for a manager, to be
+    run once before MANAGER_INBOX_ENABLED is enabled and again when the number
+    of lease coordinator inbox shards changes
+    :param ds_client: Datastore client
+    :param batch_size: number of inboxes per put_multi, at most 500
+    :return: number of inboxes written
+    """
+    inboxes = {}
+
+    query = ds_client.query(kind="Expenses", order=["-claim_date"])
+    query.add_filter("status.text", "=", INBOX_STATUS)
+    for expense in query.fetch():
+        name = inbox_name(expense)
+        if name:
+            if name not in inboxes:
+                inboxes[name] = create_inbox(ds_client, name)
+            add_to_inbox(inboxes[name], expense)
+
+    # Inboxes that have emptied are kept, but have to be reset
+    for inbox in ds_client.query(kind=INBOX_KIND).fetch():
+        if inbox.key.name not in inboxes:
+            inboxes[inbox.key.name] = create_inbox(ds_client, inbox.key.name)
+
+    entities = list(inboxes.values())
+    for index in range(0, len(entities), batch_size):
+        ds_client.put_multi(entities[index : index + batch_size])
+
+    logging.info(f"Rebuilt {len(entities)} manager inboxes")
+    return len(entities)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    rebuild_manager_inboxes(datastore.Client())
@@ -0,0 +1,184 @@
+import atexit
+import concurrent.futures
+import logging
+import threading
+import time
+
+import config
+
+DEFAULT_NOTIFICATION_WORKERS = 2
+DEFAULT_NOTIFICATION_ATTEMPTS = 3
+DEFAULT_NOTIFICATION_RETRY_DELAY = 1.0  # seconds, doubled after every attempt
+DEFAULT_NOTIFICATION_SHUTDOWN_TIMEOUT = 10.0  # seconds
+
+
+class NotificationQueue:
+    """
+    Process-wide queue that delivers notifications on background workers
+
+    Sending a notification queries Datastore, FCM and Gmail, so it is taken off
+    the request thread. A delivery that raises is retried with an exponential
+    backoff, so a notification that is sent in steps queues every step that
+    must not be repeated as a notification of its own. With zero workers
+    notifications are delivered inline, which is the local stand-in used by
+    tests.
+
+    Notifications are kept in memory only: at shutdown the queue is given
+    shutdown_timeout seconds, the notifications that are not delivered by then
+    are logged as lost.
+    """
+
+    def __init__(
+        self,
+        max_workers=DEFAULT_NOTIFICATION_WORKERS,
+        attempts=DEFAULT_NOTIFICATION_ATTEMPTS,
+        retry_delay=DEFAULT_NOTIFICATION_RETRY_DELAY,
+        shutdown_timeout=DEFAULT_NOTIFICATION_SHUTDOWN_TIMEOUT,
+    ):
+        self.max_workers = max_workers
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.shutdown_timeout = shutdown_timeout
+
+        self.queued = 0
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
+        self.delivery_time = 0.0
+
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix="notification",
+                )
+
+            return self._executor
+
+    def _deliver(self, description, func, args, kwargs, queued_at):
+        for attempt in range(1, self.attempts + 1):
+            try:
+                func(*args, **kwargs)
+            except Exception as exception:
+                if attempt == self.attempts:
+                    with self._lock:
+                        self.failed += 1
+                    logging.exception(
+                        f"Notification {description} failed after {attempt} attempts: "
+                        f"{exception}, {self.stats()}"
+                    )
+                    return False
+
+                logging.warning(
+                    f"Notification {description} failed on attempt {attempt}, "
+                    f"retrying: {exception}"
+                )
+                with self._lock:
+                    self.retried += 1
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            else:
+                with self._lock:
+                    self.delivered += 1
+                    self.delivery_time += time.monotonic() - queued_at
+                return True
+
+    def enqueue(self, description, func, *args, **kwargs):
+        """
+        Queues a notification, the call returns before it is delivered
+        :param description: description of the notification used in logging
+        :param func: callable that delivers the notification, raises to be retried
+        :return: concurrent.futures.Future that resolves to whether it was delivered
+        """
+        with self._lock:
+            self.queued += 1
+
+        if self.max_workers:
+            try:
+                future = self._get_executor().submit(
+                    self._deliver, description, func, args, kwargs, time.monotonic()
+                )
+            except RuntimeError:
+                # No new workers can be started once the interpreter shuts down
+                logging.warning(f"Delivering notification {description} inline")
+            else:
+                with self._lock:
+                    self._pending[future] = description
+                future.add_done_callback(self._done)
+
+                return future
+
+        future = concurrent.futures.Future()
+        future.set_result(
+            self._deliver(description, func, args, kwargs, time.monotonic())
+        )
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.pop(future, None)
+
+    def flush(self, timeout=None):
+        """
+        Waits until the queued notifications are delivered or have failed
+        :param timeout: maximum number of seconds to wait
+        :return: True when the queue is empty
+        """
+        with self._lock:
+            pending = list(self._pending)
+
+        done, not_done = concurrent.futures.wait(pending, timeout=timeout)
+        return not not_done
+
+    def shutdown(self):
+        """
+        Waits at most shutdown_timeout seconds for the queued notifications and
+        stops the workers, the notifications that are not delivered are logged
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is None:
+            return
+
+        executor.shutdown(wait=False)
+        if not self.flush(timeout=self.shutdown_timeout):
+            with self._lock:
+                undelivered = list(self._pending.values())
+
+            logging.error(
+                f"Shutting down before {len(undelivered)} notifications were "
+                f"delivered: {', '.join(undelivered)}"
+            )
+
+        logging.info(f"Notification queue stopped: {self.stats()}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self.queued,
+                "pending": len(self._pending),
+                "delivered": self.delivered,
+                "retried": self.retried,
+                "failed": self.failed,
+                "average_delivery_time": self.delivery_time / self.delivered
+                if self.delivered
+                else 0.0,
+            }
+
+
+notification_queue = NotificationQueue(
+    max_workers=getattr(config, "NOTIFICATION_WORKERS", DEFAULT_NOTIFICATION_WORKERS),
+    attempts=getattr(config, "NOTIFICATION_ATTEMPTS", DEFAULT_NOTIFICATION_ATTEMPTS),
+    retry_delay=getattr(
+        config, "NOTIFICATION_RETRY_DELAY", DEFAULT_NOTIFICATION_RETRY_DELAY
+    ),
+    shutdown_timeout=getattr(
+        config, "NOTIFICATION_SHUTDOWN_TIMEOUT", DEFAULT_NOTIFICATION_SHUTDOWN_TIMEOUT
+    ),
+)
+atexit.register(notification_queue.shutdown)
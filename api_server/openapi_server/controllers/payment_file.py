@@ -0,0 +1,144 @@
+from xml.sax.saxutils import escape
+
+PAIN_001_NAMESPACE = "urn:iso:std:iso:20022:tech:xsd:pain.001.001.03"
+XSI_NAMESPACE = "http://www.w3.org/2001/XMLSchema-instance"
+QUOTE_ENTITIES = {'"': "&quot;"}
+
+
+class XmlChunkWriter:
+    """
+    Serializes XML elements one at a time, so a document can be written
+    without building it in memory. The output matches what
+    xml.etree.ElementTree.tostring writes.
+    """
+
+    @staticmethod
+    def declaration():
+        return "<?xml version='1.0' encoding='utf8'?>\n"
+
+    @staticmethod
+    def _start_tag(tag, attributes):
+        attributes = "".join(
+            f' {name}="{escape(value, QUOTE_ENTITIES)}"'
+            for name, value in attributes.items()
+        )
+        return f"<{tag}{attributes}"
+
+    def start(self, tag, attributes=None):
+        return f"{self._start_tag(tag, attributes or {})}>"
+
+    @staticmethod
+    def end(tag):
+        return f"</{tag}>"
+
+    def element(self, tag, text, attributes=None):
+        start_tag = self._start_tag(tag, attributes or {})
+        if not text:
+            return f"{start_tag} />"
+
+        return f"{start_tag}>{escape(text)}</{tag}>"
+
+    def elements(self, tag, children):
+        """
+        Serializes an element that only holds text elements
+        :param tag: tag of the parent element
+        :param children: list of (tag, text) or (tag, text, attributes) tuples
+        :return: str
+        """
+        return (
+            self.start(tag)
+            + "".join(self.element(*child) for child in children)
+            + self.end(tag)
+        )
+
+
+def generate_payment_file(
+    message_id,
+    creation_time,
+    number_of_transactions,
+    control_sum,
+    initiating_party,
+    execution_date,
+    debtor,
+    transactions,
+):
+    """
+    Generates a SEPA pain.001.001.03 credit transfer document chunk by chunk.
+    The group header totals are passed in, so the transactions can be written
+    as they are produced; one chunk is yielded per credit transfer.
+    :param message_id: message and payment information id
+    :param creation_time: ISO 8601 creation date and time
+    :param number_of_transactions: number of credit transfers in the batch
+    :param control_sum: total amount of the batch
+    :param initiating_party: name of the initiating party
+    :param execution_date: ISO 8601 requested execution date
+    :param debtor: dict with the debtor "name", "iban" and "bic"
+    :param transactions: iterable of dicts with "instruction_id",
+        "end_to_end_id", "amount", "bic", "name", "iban" and "remittance"
+    :return: generator of str
+    """
+    writer = XmlChunkWriter()
+
+    yield writer.declaration() + writer.start(
+        "Document", {"xmlns": PAIN_001_NAMESPACE, "xmlns:xsi": XSI_NAMESPACE}
+    ) + writer.start("CstmrCdtTrfInitn")
+
+    # Group Header
+    yield (
+        writer.start("GrpHdr")
+        + writer.element("MsgId", message_id)
+        + writer.element("CreDtTm", creation_time)
+        + writer.element("NbOfTxs", str(number_of_transactions))
+        + writer.element("CtrlSum", str(control_sum))
+        + writer.elements("InitgPty", [("Nm", initiating_party)])
+        + writer.end("GrpHdr")
+    )
+
+    # Payment Information
+    yield (
+        writer.start("PmtInf")
+        + writer.element("PmtInfId", message_id)
+        + writer.element("PmtMtd", "TRF")  # Standard Value
+        + writer.element("NbOfTxs", str(number_of_transactions))
+        + writer.element("CtrlSum", str(control_sum))
+        + writer.start("PmtTpInf")
+        + writer.element("InstrPrty", "NORM")
+        + writer.elements("SvcLvl", [("Cd", "SEPA")])
+        + writer.end("PmtTpInf")
+        + writer.element("ReqdExctnDt", execution_date)
+        + writer.elements("Dbtr", [("Nm", debtor["name"])])
+        + writer.start("DbtrAcct")
+        + writer.elements("Id", [("IBAN", debtor["iban"])])
+        + writer.end("DbtrAcct")
+        + writer.start("DbtrAgt")
+        + writer.elements("FinInstnId", [("BIC", debtor["bic"])])
+        + writer.end("DbtrAgt")
+    )
+
+    # Credit Transfer Transaction Information
+    for transaction in transactions:
+        yield (
+            writer.start("CdtTrfTxInf")
+            + writer.elements(
+                "PmtId",
+                [
+                    ("InstrId", transaction["instruction_id"]),
+                    ("EndToEndId", transaction["end_to_end_id"]),
+                ],
+            )
+            + writer.elements(
+                "Amt", [("InstdAmt", transaction["amount"], {"Ccy": "EUR"})]
+            )
+            + writer.element("ChrgBr", "SLEV")
+            + writer.start("CdtrAgt")
+            + writer.elements("FinInstnId", [("BIC", transaction["bic"])])
+            + writer.end("CdtrAgt")
+            + writer.elements("Cdtr", [("Nm", transaction["name"])])
+            + writer.start("CdtrAcct")
+            + writer.elements("Id", [("IBAN", transaction["iban"])])
+            + writer.end("CdtrAcct")
+            + writer.elements("RmtInf", [("Ustrd", transaction["remittance"])])
+            + writer.end("CdtTrfTxInf")
+        )
+
+    yield writer.end("PmtInf") + writer.end("CstmrCdtTrfInitn") + writer.end("Document")
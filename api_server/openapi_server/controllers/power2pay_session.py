@@ -0,0 +1,157 @@
+import contextlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import config
+import requests
+from google.cloud import secretmanager_v1
+from requests.adapters import HTTPAdapter
+from urllib3.util.ssl_ import create_urllib3_context
+
+DEFAULT_POWER2PAY_CREDENTIALS_TTL = 3600  # seconds
+SHARED_MEMORY_DIR = "/dev/shm"  # nosec
+
+
+class ClientCertificateAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that presents a client certificate from an SSL context, so the
+    certificate is loaded once instead of on every request
+    """
+
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        return super().proxy_manager_for(*args, **kwargs)
+
+
+@contextlib.contextmanager
+def _secret_file(content):
+    """
+    Writes a secret to a file that only exists within the context, on tmpfs
+    when available, as ssl can only load certificates from files
+    """
+    directory = SHARED_MEMORY_DIR if os.path.isdir(SHARED_MEMORY_DIR) else None
+    file_descriptor, file_name = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(file_descriptor, "w") as secret_file:
+            secret_file.write(content)
+        yield file_name
+    finally:
+        os.remove(file_name)
+
+
+def create_client_certificate_context(certificate, key, passphrase):
+    """
+    Creates an SSL context that presents the client certificate and verifies
+    the server against the CA bundle requests uses by default
+    :param certificate: PEM encoded certificate (chain)
+    :param key: PEM encoded private key, encrypted with the passphrase
+    :param passphrase: passphrase of the private key
+    :return: ssl.SSLContext
+    """
+    ssl_context = create_urllib3_context()
+    ssl_context.load_verify_locations(requests.certs.where())
+    with _secret_file(certificate) as cert_file, _secret_file(key) as key_file:
+        ssl_context.load_cert_chain(cert_file, key_file, password=passphrase)
+
+    return ssl_context
+
+
+class Power2PaySession:
+    """
+    Process-wide requests.Session for Power2Pay
+
+    The session holds the client certificate and basic auth credentials taken
+    from Secret Manager, so repeated exports reuse both the credentials and the
+    pooled TLS connection until the TTL expires or the session is invalidated.
+    """
+
+    def __init__(self, ttl=DEFAULT_POWER2PAY_CREDENTIALS_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._secret_client = None
+        self._session = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def get_secret(self, project_id, secret_id):
+        if self._secret_client is None:
+            self._secret_client = secretmanager_v1.SecretManagerServiceClient()
+
+        secret_name = self._secret_client.secret_version_path(
+            project_id, secret_id, "latest"
+        )
+
+        response = self._secret_client.access_secret_version(
+            request={"name": secret_name}
+        )
+        return response.payload.data.decode("UTF-8")
+
+    def _create_session(self):
+        project_id = os.environ["GOOGLE_CLOUD_PROJECT"]
+
+        ssl_context = create_client_certificate_context(
+            certificate=self.get_secret(project_id, config.CERTIFICATE),
+            key=self.get_secret(project_id, config.KEY),
+            passphrase=self.get_secret(project_id, config.PASSPHRASE),
+        )
+
+        session = requests.Session()
+        session.mount("https://", ClientCertificateAdapter(ssl_context))
+        session.auth = (
+            config.POWER2PAY_AUTH_USER,
+            self.get_secret(project_id, config.POWER2PAY_AUTH_PASSWORD),
+        )
+
+        return session
+
+    def get(self):
+        """
+        Returns the session, creating it when there is none or it expired
+        :return: requests.Session
+        """
+        with self._lock:
+            if self._session is not None and time.monotonic() < self._expires_at:
+                self.hits += 1
+                return self._session
+
+            self.misses += 1
+            if self._session is not None:
+                self._session.close()
+
+            self._session = self._create_session()
+            self._expires_at = time.monotonic() + self.ttl
+
+            return self._session
+
+    def invalidate(self):
+        """Closes the session, the next request will fetch the secrets again"""
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+
+            self._session = None
+            self._expires_at = 0.0
+
+        logging.info(f"Power2Pay session invalidated: {self.stats()}")
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+power2pay_session = Power2PaySession(
+    ttl=getattr(config, "POWER2PAY_CREDENTIALS_TTL", DEFAULT_POWER2PAY_CREDENTIALS_TTL)
+)
@@ -0,0 +1,54 @@
+import threading
+
+import google.auth
+import google.auth.credentials
+import google.auth.transport.requests
+
+CLOUD_PLATFORM_SCOPE = "https://www.googleapis.com/auth/cloud-platform"
+
+
+def get_default_credentials():
+    """Returns the credentials of the service account the API runs as"""
+    credentials, project_id = google.auth.default(scopes=[CLOUD_PLATFORM_SCOPE])
+    return credentials
+
+
+class SigningCredentials:
+    """
+    Process-wide credentials used to sign Cloud Storage urls
+
+    Credentials with a private key sign the urls locally. Credentials without
+    one, like the App Engine default service account, sign them through the
+    IAM API, so the service account and an access token are passed with every
+    url. The token is refreshed when it is about to expire.
+    """
+
+    def __init__(self, credentials_factory=get_default_credentials):
+        self.credentials_factory = credentials_factory
+
+        self._credentials = None
+        self._lock = threading.Lock()
+
+    def get_signing_arguments(self):
+        """
+        Returns the arguments for Blob.generate_signed_url
+        :return: dict, empty when the urls are signed locally
+        """
+        with self._lock:
+            if self._credentials is None:
+                self._credentials = self.credentials_factory()
+
+            credentials = self._credentials
+            if isinstance(credentials, google.auth.credentials.Signing):
+                return {}
+
+            if not credentials.valid:
+                credentials.refresh(google.auth.transport.requests.Request())
+
+            return {
+                "service_account_email": credentials.service_account_email,
+                "access_token": credentials.token,
+            }
+
+
+signing_credentials = SigningCredentials()
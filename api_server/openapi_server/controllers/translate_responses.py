@@ -79,6 +79,16 @@ def make_response_translated(message, http_code):
             "en": "Failed to upload booking and payment files",
             "de": "Fehler beim Hochladen der Buchungs- und Zahlungsdateien"
         },
+        "Kan declaraties niet als geëxporteerd markeren": {
+            "nl": "Kan declaraties niet als geëxporteerd markeren",
+            "en": "Failed to mark the expenses as exported",
+            "de": "Spesen konnten nicht als exportiert markiert werden"
+        },
+        "Declaratie is tegelijkertijd gewijzigd, probeer het opnieuw": {
+            "nl": "Declaratie is tegelijkertijd gewijzigd, probeer het opnieuw",
+            "en": "The expense was changed at the same time, please try again",
+            "de": "Die Spese wurde gleichzeitig geändert, bitte versuchen Sie es erneut"
+        },
         "De inhoud van deze methode is niet geldig": {
             "nl": "De inhoud van deze methode is niet geldig",
             "en": "The content of this method is not valid",
@@ -153,6 +163,21 @@ def make_response_translated(message, http_code):
             "nl": "Het declaratiebedrag moet hoger zijn dan €{},-",
             "en": "The expense amount must be higher than €{},-",
             "de": "Der Kostenbetrag muss höher als €{},- sein"
+        },
+        "Bijlage is te groot": {
+            "nl": "Bijlage is te groot",
+            "en": "Attachment is too large",
+            "de": "Anhang ist zu groß"
+        },
+        "Upload niet gevonden": {
+            "nl": "Upload niet gevonden",
+            "en": "Upload not found",
+            "de": "Upload nicht gefunden"
+        },
+        "Upload is niet compleet": {
+            "nl": "Upload is niet compleet",
+            "en": "Upload is not complete",
+            "de": "Upload ist nicht vollständig"
         }
     }
 
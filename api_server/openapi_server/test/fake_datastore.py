@@ -0,0 +1,244 @@
+import contextlib
+import itertools
+import operator
+
+OPERATORS = {
+    "=": operator.eq,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def _get_property(entity, property_name):
+    value = entity
+    for part in property_name.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+
+    return value
+
+
+def _matches(entity, filters):
+    for property_name, operator_name, expected in filters:
+        value = _get_property(entity, property_name)
+        if isinstance(value, list):
+            if not any(OPERATORS[operator_name](item, expected) for item in value):
+                return False
+        elif value is None or not OPERATORS[operator_name](value, expected):
+            return False
+
+    return True
+
+
+def _index_entries(properties, prefix=""):
+    """Yields (property_name, value) for every indexed leaf value"""
+    for name, value in properties.items():
+        property_name = f"{prefix}{name}"
+        if isinstance(value, dict):
+            yield from _index_entries(value, f"{property_name}.")
+        elif isinstance(value, list):
+            for item in value:
+                if not isinstance(item, dict):
+                    yield property_name, item
+        else:
+            yield property_name, value
+
+
+class FakeKey:
+    def __init__(self, kind, id_or_name=None):
+        self.kind = kind
+        self.id = id_or_name if isinstance(id_or_name, int) else None
+        self.name = id_or_name if isinstance(id_or_name, str) else None
+
+    @property
+    def id_or_name(self):
+        return self.id if self.id is not None else self.name
+
+    @property
+    def _flat_path(self):
+        # Used by datastore.Entity.__repr__
+        return (self.kind, self.id_or_name)
+
+    @property
+    def is_partial(self):
+        return self.id_or_name is None
+
+    def __eq__(self, other):
+        return (self.kind, self.id_or_name) == (other.kind, other.id_or_name)
+
+    def __hash__(self):
+        return hash((self.kind, self.id_or_name))
+
+
+class FakeEntity(dict):
+    def __init__(self, key, properties=None):
+        super().__init__(properties or {})
+        self.key = key
+        self.exclude_from_indexes = set()
+
+    @property
+    def id(self):
+        return self.key.id
+
+
+class FakeIterator:
+    """Iterator over a query result that supports pages and cursors"""
+
+    def __init__(self, client, entities, limit=None, start_cursor=None):
+        self.next_page_token = None
+
+        offset = int(start_cursor) if start_cursor else 0
+        end = len(entities) if limit is None else offset + limit
+        self._entities = entities[offset:end]
+
+        if end < len(entities):
+            self.next_page_token = str(end).encode("utf-8")
+
+        client.entities_read += len(self._entities)
+
+    @property
+    def pages(self):
+        yield iter(self._entities)
+
+    def __iter__(self):
+        return iter(self._entities)
+
+
+class FakeQuery:
+    def __init__(self, client, kind, order=None):
+        self.client = client
+        self.kind = kind
+        self.order = order or []
+        self.filters = []
+
+    def add_filter(self, property_name, operator_name, value):
+        self.filters.append((property_name, operator_name, value))
+        return self
+
+    def _candidates(self):
+        # Like Datastore, serve equality filters from the property index
+        buckets = [
+            self.client.index.get((self.kind, property_name, value), {})
+            for property_name, operator_name, value in self.filters
+            if operator_name == "="
+        ]
+        if buckets:
+            return min(buckets, key=len)
+
+        return self.client.kinds.get(self.kind, {})
+
+    def fetch(self, limit=None, start_cursor=None):
+        self.client.rpc_count += 1
+        entities = [
+            self.client.entities[key]
+            for key in self._candidates()
+            if _matches(self.client.entities[key], self.filters)
+        ]
+
+        for order in reversed(self.order):
+            property_name = order.lstrip("-")
+            entities.sort(
+                key=lambda entity: _get_property(entity, property_name),
+                reverse=order.startswith("-"),
+            )
+
+        return FakeIterator(self.client, entities, limit, start_cursor)
+
+
+class FakeDatastoreClient:
+    """
+    Minimal in-memory stand-in for google.cloud.datastore.Client, used by
+    benchmarks to exercise controller code without a Datastore backend.
+    Equality filters are served from a property index, like Datastore does.
+    """
+
+    def __init__(self):
+        self.entities = {}
+        self.kinds = {}
+        self.index = {}
+        self.rpc_count = 0
+        self.entities_read = 0
+        self._index_entries = {}
+        self._ids = itertools.count(1 << 32)
+
+    def key(self, kind, id_or_name=None):
+        return FakeKey(kind, id_or_name)
+
+    def query(self, kind, order=None):
+        return FakeQuery(self, kind, order)
+
+    def get(self, key):
+        self.rpc_count += 1
+        self.entities_read += key in self.entities
+        return self.entities.get(key)
+
+    def get_multi(self, keys, missing=None):
+        self.rpc_count += 1
+        found = []
+        for key in keys:
+            if key in self.entities:
+                found.append(self.entities[key])
+            elif missing is not None:
+                missing.append(FakeEntity(key))
+
+        self.entities_read += len(found)
+        return found
+
+    def transaction(self, **kwargs):
+        return contextlib.nullcontext()
+
+    def allocate_ids(self, incomplete_key, num_ids):
+        self.rpc_count += 1
+        return [FakeKey(incomplete_key.kind, next(self._ids)) for _ in range(num_ids)]
+
+    def _store(self, entity):
+        if entity.key.is_partial:
+            entity.key = FakeKey(entity.key.kind, next(self._ids))
+
+        for index_key in self._index_entries.pop(entity.key, []):
+            self.index[index_key].pop(entity.key, None)
+
+        index_keys = []
+        for property_name, value in _index_entries(entity):
+            index_key = (entity.key.kind, property_name, value)
+            try:
+                self.index.setdefault(index_key, {})[entity.key] = None
+            except TypeError:  # Unhashable values are not indexed
+                continue
+            index_keys.append(index_key)
+
+        self._index_entries[entity.key] = index_keys
+        self.kinds.setdefault(entity.key.kind, {})[entity.key] = None
+        self.entities[entity.key] = entity
+
+    def put(self, entity):
+        self.rpc_count += 1
+        self._store(entity)
+
+    def put_multi(self, entities):
+        self.rpc_count += 1
+        for entity in entities:
+            self._store(entity)
+
+    def _remove(self, key):
+        for index_key in self._index_entries.pop(key, []):
+            self.index[index_key].pop(key, None)
+        self.kinds.get(key.kind, {}).pop(key, None)
+        self.entities.pop(key, None)
+
+    def delete(self, key):
+        self.rpc_count += 1
+        self._remove(key)
+
+    def delete_multi(self, keys):
+        self.rpc_count += 1
+        for key in keys:
+            self._remove(key)
+
+    def add(self, kind, properties, id_or_name=None):
+        entity = FakeEntity(FakeKey(kind, id_or_name), properties)
+        self.put(entity)
+        return entity
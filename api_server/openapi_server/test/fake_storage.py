@@ -0,0 +1,247 @@
+import datetime
+import hashlib
+import threading
+import time
+
+import requests
+from google.api_core import exceptions
+from google.auth import credentials
+
+UPLOAD_READ_SIZE = 64 * 1024
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name, content_type=None):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = content_type
+        self.metadata = bucket.metadata.get(name)
+
+    def upload_from_string(self, data, content_type=None):
+        self.content_type = content_type
+        self.bucket.content_types[self.name] = content_type
+        self.bucket.metadata[self.name] = self.metadata
+        self.bucket.updated[self.name] = utcnow()
+        if self.bucket.keep_uploads:
+            self.bucket.blobs[self.name] = data
+        else:
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            self.bucket.blobs[self.name] = hashlib.sha256(data).hexdigest()
+
+    def upload_from_file(self, file_obj, rewind=False, content_type=None):
+        if rewind:
+            file_obj.seek(0)
+
+        if self.bucket.keep_uploads:
+            self.upload_from_string(file_obj.read(), content_type=content_type)
+            return
+
+        # Read in parts, like the storage client does for resumable uploads
+        self.content_type = content_type
+        self.bucket.content_types[self.name] = content_type
+        self.bucket.metadata[self.name] = self.metadata
+        self.bucket.updated[self.name] = utcnow()
+        digest = hashlib.sha256()
+        for data in iter(lambda: file_obj.read(UPLOAD_READ_SIZE), b""):
+            digest.update(data)
+        self.bucket.blobs[self.name] = digest.hexdigest()
+
+    def create_resumable_upload_session(self, content_type=None, size=None):
+        session_url = (
+            f"https://storage.googleapis.com/upload/storage/v1/b/{self.bucket.name}"
+            f"/o?uploadType=resumable&upload_id={len(self.bucket.client.upload_sessions)}"
+        )
+        self.bucket.client.upload_sessions[session_url] = {
+            "blob": self,
+            "content_type": content_type,
+            "size": size,
+            "data": bytearray(),
+        }
+        return session_url
+
+    def exists(self):
+        return self.name in self.bucket.blobs
+
+    def patch(self):
+        if not self.exists():
+            raise exceptions.NotFound(self.name)
+        self.bucket.metadata[self.name] = self.metadata
+        self.bucket.updated[self.name] = utcnow()
+
+    def delete(self):
+        if not self.exists():
+            raise exceptions.NotFound(self.name)
+        del self.bucket.blobs[self.name]
+        del self.bucket.content_types[self.name]
+        self.bucket.metadata.pop(self.name, None)
+        self.bucket.updated.pop(self.name, None)
+
+    @property
+    def size(self):
+        return len(self.bucket.blobs[self.name])
+
+    @property
+    def updated(self):
+        return self.bucket.updated.get(self.name)
+
+    def generate_signed_url(self, version, expiration, method, **kwargs):
+        with self.bucket.client.lock:
+            self.bucket.client.signed_urls += 1
+            self.bucket.client.signing_arguments.append(kwargs)
+        return (
+            f"https://storage.googleapis.com/{self.bucket.name}/{self.name}"
+            f"?X-Goog-Algorithm=GOOG4-RSA-SHA256&X-Goog-Expires="
+            f"{int(expiration.total_seconds())}"
+        )
+
+    def download_as_bytes(self):
+        client = self.bucket.client
+        with client.lock:
+            client.downloads += 1
+            client.active_downloads += 1
+            client.max_active_downloads = max(
+                client.max_active_downloads, client.active_downloads
+            )
+
+        time.sleep(client.download_latency)
+
+        with client.lock:
+            client.active_downloads -= 1
+
+        data = self.bucket.blobs[self.name]
+        return data.encode("utf-8") if isinstance(data, str) else data
+
+
+class FakeBucket:
+    def __init__(self, client, name, keep_uploads=True):
+        self.client = client
+        self.name = name
+        self.keep_uploads = keep_uploads
+        self.blobs = {}
+        self.content_types = {}
+        self.metadata = {}
+        self.updated = {}
+
+    def blob(self, name):
+        return FakeBlob(self, name, self.content_types.get(name))
+
+    def list_blobs(self, prefix=""):
+        self.client.list_calls += 1
+        return [
+            self.blob(name) for name in sorted(self.blobs) if name.startswith(prefix)
+        ]
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = ""
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code), response=self)
+
+
+class FakeUploadSession:
+    """
+    Stand-in for the requests.Session that sends chunks to resumable upload
+    sessions, it answers like Cloud Storage does
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.requests = 0
+
+    def put(self, url, data, headers, timeout=None):
+        self.requests += 1
+        upload = self.client.upload_sessions.get(url)
+        if upload is None:
+            return FakeResponse(404)
+
+        byte_range = headers["Content-Range"].split(" ")[1].split("/")[0]
+        if byte_range != "*":
+            first = int(byte_range.split("-")[0])
+            if first <= len(upload["data"]):
+                upload["data"][first:] = data
+
+        if len(upload["data"]) == upload["size"]:
+            if not upload.get("complete"):
+                upload["blob"].upload_from_string(
+                    bytes(upload["data"]), content_type=upload["content_type"]
+                )
+                upload["complete"] = True
+            return FakeResponse(200)
+
+        if not upload["data"]:
+            return FakeResponse(308)
+
+        return FakeResponse(308, {"Range": f"bytes=0-{len(upload['data']) - 1}"})
+
+
+class FakeSigningCredentials(credentials.Signing):
+    """Credentials with a private key, so urls are signed locally"""
+
+    def sign_bytes(self, message):
+        return hashlib.sha256(message).digest()
+
+    @property
+    def signer_email(self):
+        return "api@example.iam.gserviceaccount.com"
+
+    @property
+    def signer(self):
+        return None
+
+
+class FakeTokenCredentials(credentials.Credentials):
+    """Credentials without a private key, so urls are signed through IAM"""
+
+    service_account_email = "api@example.iam.gserviceaccount.com"
+
+    def __init__(self):
+        super().__init__()
+        self.refreshes = 0
+
+    def refresh(self, request):
+        self.refreshes += 1
+        self.token = f"token-{self.refreshes}"
+        self.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+
+class FakeStorageClient:
+    """
+    Minimal in-memory stand-in for google.cloud.storage.Client, used by tests
+    to capture the files the controllers upload. Without keep_uploads only a
+    SHA-256 digest of every upload is kept, for memory benchmarks, and
+    download_latency simulates the round trip of every download, and
+    max_active_downloads counts how many of them overlapped.
+    """
+
+    def __init__(self, keep_uploads=True, download_latency=0.0):
+        self.keep_uploads = keep_uploads
+        self.download_latency = download_latency
+        self.buckets = {}
+        self.list_calls = 0
+        self.metadata_calls = 0
+        self.downloads = 0
+        self.active_downloads = 0
+        self.max_active_downloads = 0
+        self.lock = threading.Lock()
+        self.signed_urls = 0
+        self.signing_arguments = []
+        self.upload_sessions = {}
+
+    def bucket(self, bucket_name):
+        return self.buckets.setdefault(
+            bucket_name, FakeBucket(self, bucket_name, self.keep_uploads)
+        )
+
+    def get_bucket(self, bucket_name):
+        self.metadata_calls += 1
+        return self.bucket(bucket_name)
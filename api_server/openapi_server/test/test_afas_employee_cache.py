@@ -0,0 +1,93 @@
+import unittest
+
+from flask import g
+from openapi_server.controllers.afas_employee_cache import (
+    AfasEmployeeCache, afas_employee_cache)
+from openapi_server.controllers.expense_controllers import ManagerExpenses
+from openapi_server.test import BaseTestCase
+from openapi_server.test.test_client_registry import create_fake_registry
+
+MANAGER = {
+    "upn": "manager@example.com",
+    "email_address": "manager@example.com",
+    "Personeelsnummer": 1001,
+}
+
+
+class TestAfasEmployeeCache(BaseTestCase):
+    """ Test the cached AFAS employee lookups """
+
+    def setUp(self):
+        afas_employee_cache.invalidate()
+        self.registry = create_fake_registry()
+        self.ds_client = self.registry.get_datastore()
+        self.ds_client.add("AFAS_HRM", MANAGER, 1001)
+
+    def _create_manager_instance(self, unique_name="manager@example.com"):
+        g.token = {"unique_name": unique_name}
+        return ManagerExpenses(self.registry)
+
+    def test_request_looks_up_employee_once(self):
+        with self.app.app_context():
+            instance = self._create_manager_instance()
+            rpc_count = self.ds_client.rpc_count
+
+            self.assertEqual(instance.manager_number, 1001)
+            self.assertEqual(instance.get_manager_identifying_value(), 1001)
+            self.assertEqual(instance.get_manager_identifying_value(), 1001)
+            self.assertEqual(self.ds_client.rpc_count, rpc_count)
+
+    def test_unknown_employee_is_looked_up_once_per_request(self):
+        with self.app.app_context():
+            rpc_count = self.ds_client.rpc_count
+            instance = self._create_manager_instance("unknown@example.com")
+
+            self.assertIsNone(instance.get_manager_identifying_value())
+            # The upn and email_address index lookups and their fallback queries
+            self.assertEqual(self.ds_client.rpc_count, rpc_count + 4)
+
+        with self.app.app_context():
+            instance = self._create_manager_instance("unknown@example.com")
+
+            self.assertEqual(self.ds_client.rpc_count, rpc_count + 8)
+
+    def test_employee_is_shared_between_requests(self):
+        with self.app.app_context():
+            self._create_manager_instance()
+            rpc_count = self.ds_client.rpc_count
+
+        with self.app.app_context():
+            instance = self._create_manager_instance()
+
+            self.assertEqual(instance.manager_number, 1001)
+            self.assertEqual(self.ds_client.rpc_count, rpc_count)
+
+    def test_process_cache_can_be_disabled(self):
+        cache = AfasEmployeeCache(ttl=0)
+        loads = []
+
+        def load():
+            loads.append(1)
+            return dict(MANAGER)
+
+        for _ in range(2):
+            with self.app.app_context():
+                cache.get("manager@example.com", load)
+                cache.get("manager@example.com", load)
+
+        self.assertEqual(len(loads), 2)
+        self.assertEqual(cache.stats()["request_hits"], 2)
+
+    def test_copies_are_returned(self):
+        cache = AfasEmployeeCache()
+
+        with self.app.app_context():
+            cache.get("manager@example.com", lambda: dict(MANAGER))["IBAN"] = "NL00"
+
+            self.assertNotIn(
+                "IBAN", cache.get("manager@example.com", lambda: dict(MANAGER))
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
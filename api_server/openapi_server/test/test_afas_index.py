@@ -0,0 +1,66 @@
+import unittest
+
+from openapi_server.controllers.afas_index import (
+    INDEX_KIND, backfill_afas_index, get_afas_employee, index_key)
+from openapi_server.test import BaseTestCase
+from openapi_server.test.fake_datastore import FakeDatastoreClient
+
+EMPLOYEE = {
+    "upn": "Pietje.Puk@example.com",
+    "email_address": "pietje.puk@example.com",
+    "Personeelsnummer": 1001,
+}
+
+
+class TestAfasIndex(BaseTestCase):
+    """ Test the AFAS_HRM key index """
+
+    def setUp(self):
+        self.ds_client = FakeDatastoreClient()
+        self.employee = self.ds_client.add("AFAS_HRM", dict(EMPLOYEE), 1001)
+
+    def _indexed_key(self, field, value):
+        return self.ds_client.get(index_key(self.ds_client, field, value))["afas_key"]
+
+    def test_miss_is_queried_and_indexed(self):
+        employee = get_afas_employee(self.ds_client, "upn", "Pietje.Puk@example.com")
+
+        self.assertEqual(employee.key, self.employee.key)
+        self.assertEqual(len(self.ds_client.kinds[INDEX_KIND]), 3)
+        self.assertEqual(self._indexed_key("Personeelsnummer", 1001), self.employee.key)
+
+    def test_hit_uses_key_lookups(self):
+        get_afas_employee(self.ds_client, "upn", "Pietje.Puk@example.com")
+        rpc_count = self.ds_client.rpc_count
+
+        employee = get_afas_employee(self.ds_client, "Personeelsnummer", 1001)
+
+        self.assertEqual(employee.key, self.employee.key)
+        # The index entry and the employee, no query
+        self.assertEqual(self.ds_client.rpc_count, rpc_count + 2)
+
+    def test_stale_entry_is_repaired(self):
+        get_afas_employee(self.ds_client, "upn", "Pietje.Puk@example.com")
+        self.ds_client.delete(self.employee.key)
+        moved = self.ds_client.add("AFAS_HRM", dict(EMPLOYEE), 2002)
+
+        employee = get_afas_employee(self.ds_client, "upn", "Pietje.Puk@example.com")
+
+        self.assertEqual(employee.key, moved.key)
+        self.assertEqual(self._indexed_key("upn", "pietje.puk@example.com"), moved.key)
+
+    def test_unknown_employee(self):
+        self.assertIsNone(
+            get_afas_employee(self.ds_client, "upn", "unknown@example.com")
+        )
+        self.assertNotIn(INDEX_KIND, self.ds_client.kinds)
+
+    def test_backfill(self):
+        self.ds_client.add("AFAS_HRM", {"upn": "manager@example.com"}, 1002)
+
+        self.assertEqual(backfill_afas_index(self.ds_client, batch_size=1), 4)
+        self.assertEqual(len(self.ds_client.kinds[INDEX_KIND]), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
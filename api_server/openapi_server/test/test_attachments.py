@@ -0,0 +1,632 @@
+import base64
+import contextlib
+import datetime
+import io
+import json
+import os
+import unittest
+from unittest import mock
+
+import pikepdf
+from openapi_server.controllers import attachment_uploads, expense_controllers
+from openapi_server.controllers.attachment_processing import (
+    AttachmentProcessor, attachment_processor)
+from openapi_server.controllers.attachment_uploads import UploadCleanup
+from openapi_server.controllers.expense_controllers import (ControllerExpenses,
+                                                            EmployeeExpenses)
+from openapi_server.controllers.signing_credentials import SigningCredentials
+from openapi_server.models.attachment_data import AttachmentData
+from openapi_server.test import BaseTestCase
+from openapi_server.test.fake_datastore import FakeDatastoreClient
+from openapi_server.test.fake_storage import (FakeBlob,
+                                              FakeSigningCredentials,
+                                              FakeStorageClient,
+                                              FakeTokenCredentials,
+                                              FakeUploadSession)
+
+EXPENSE_ID = 42
+ATTACHMENT_PREFIX = f"exports/attachments/pietje.puk/{EXPENSE_ID}"
+PENDING_ATTACHMENT_PREFIX = f"exports/pending_attachments/pietje.puk/{EXPENSE_ID}"
+
+
+def create_pdf(pages):
+    """PDF with a link on every page and a script that runs when it is opened"""
+    pdf = pikepdf.new()
+    for page in range(pages):
+        pdf.add_blank_page()
+        pdf.pages[page].Annots = pdf.make_indirect(
+            pikepdf.Array(
+                [
+                    pikepdf.Dictionary(
+                        Type=pikepdf.Name.Annot,
+                        Subtype=pikepdf.Name.Link,
+                        Rect=[0, 0, 100, 100],
+                    )
+                ]
+            )
+        )
+    pdf.Root.OpenAction = pikepdf.Dictionary(
+        S=pikepdf.Name.JavaScript, JS=pikepdf.String("app.alert(1)")
+    )
+
+    output = io.BytesIO()
+    pdf.save(output)
+    return output.getvalue()
+
+
+def create_attachment_data(content, content_type="application/pdf", name="receipt.pdf"):
+    return AttachmentData(
+        name=name,
+        content=f"data:{content_type};base64,{base64.b64encode(content).decode()}",
+    )
+
+
+def create_attachment_instance(expense_class, number_of_attachments, size=1024):
+    ds_client = FakeDatastoreClient()
+    ds_client.add(
+        "Expenses",
+        {"employee": {"email": "pietje.puk@example.com"}, "cost_type": "400000"},
+        EXPENSE_ID,
+    )
+
+    cs_client = FakeStorageClient()
+    bucket = cs_client.get_bucket("attachments")
+    for number in range(number_of_attachments):
+        content_type = "application/pdf" if number % 2 else "image/jpeg"
+        bucket.blob(f"{ATTACHMENT_PREFIX}/receipt_{number}").upload_from_string(
+            os.urandom(size + number), content_type=content_type
+        )
+
+    instance = expense_class.__new__(expense_class)
+    instance.ds_client = ds_client
+    instance.cs_client = cs_client
+    instance.bucket_name = "attachments"
+    instance.employee_info = {"unique_name": "someone.else@example.com"}
+    return instance
+
+
+def expected_attachments(instance):
+    """Attachments as they were returned before streaming"""
+    bucket = instance.cs_client.get_bucket(instance.bucket_name)
+    return [
+        {
+            "content_type": blob.content_type,
+            "content": base64.b64encode(blob.download_as_bytes()).decode("utf-8"),
+            "name": blob.name.split("/")[-1],
+            "status": "processed",
+        }
+        for blob in bucket.list_blobs(prefix=ATTACHMENT_PREFIX)
+    ]
+
+
+class TestGetAttachment(BaseTestCase):
+    """ Test the streamed attachments """
+
+    def test_streamed_attachments_match(self):
+        instance = create_attachment_instance(ControllerExpenses, 9, size=300 * 1024)
+
+        response = instance.get_attachment(EXPENSE_ID)
+
+        self.assertEqual(response.mimetype, "application/json")
+        chunks = list(response.response)
+        self.assertGreater(len(chunks), 9)
+        self.assertEqual(json.loads("".join(chunks)), expected_attachments(instance))
+
+    def _fail_download(self, name):
+        download_as_bytes = FakeBlob.download_as_bytes
+
+        def fail_download(blob):
+            if blob.name.endswith(name):
+                raise ConnectionError("Storage unavailable")
+            return download_as_bytes(blob)
+
+        return mock.patch.object(
+            FakeBlob, "download_as_bytes", autospec=True, side_effect=fail_download
+        )
+
+    def test_failed_first_download_fails_the_request(self):
+        instance = create_attachment_instance(ControllerExpenses, 3)
+
+        with self._fail_download("receipt_0"), self.assertRaises(ConnectionError):
+            instance.get_attachment(EXPENSE_ID)
+
+    def test_failed_download_aborts_the_stream(self):
+        instance = create_attachment_instance(ControllerExpenses, 3)
+
+        with self._fail_download("receipt_2"):
+            response = instance.get_attachment(EXPENSE_ID)
+
+            chunks = []
+            with self.assertRaises(ConnectionError):
+                for chunk in response.response:
+                    chunks.append(chunk)
+
+        self.assertNotEqual(chunks[-1], "]")
+
+    def test_no_attachments(self):
+        instance = create_attachment_instance(ControllerExpenses, 0)
+
+        response = instance.get_attachment(EXPENSE_ID)
+
+        self.assertEqual(json.loads("".join(response.response)), [])
+
+    def test_permission_is_checked(self):
+        instance = create_attachment_instance(EmployeeExpenses, 2)
+
+        response = instance.get_attachment(EXPENSE_ID)
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(instance.cs_client.downloads, 0)
+
+
+class TestGetAttachmentSignedUrls(BaseTestCase):
+    """ Test the signed url attachment mode """
+
+    def _get_signed_urls(self, instance, credentials_factory):
+        with mock.patch.object(
+            expense_controllers,
+            "signing_credentials",
+            SigningCredentials(credentials_factory),
+        ):
+            return instance.get_attachment(EXPENSE_ID, mode="signed_url")
+
+    def test_signed_urls(self):
+        instance = create_attachment_instance(ControllerExpenses, 3)
+
+        response = self._get_signed_urls(instance, FakeSigningCredentials)
+
+        attachments = response.json
+        self.assertEqual(
+            [
+                (item["name"], item["content_type"], item["size"])
+                for item in attachments
+            ],
+            [
+                ("receipt_0", "image/jpeg", 1024),
+                ("receipt_1", "application/pdf", 1025),
+                ("receipt_2", "image/jpeg", 1026),
+            ],
+        )
+        self.assertTrue(
+            attachments[0]["url"].startswith(
+                f"https://storage.googleapis.com/attachments/{ATTACHMENT_PREFIX}/receipt_0?"
+            )
+        )
+        self.assertIn("X-Goog-Expires=300", attachments[0]["url"])
+        self.assertEqual(instance.cs_client.downloads, 0)
+        self.assertEqual(instance.cs_client.signing_arguments, [{}] * 3)
+
+    def test_urls_are_signed_through_iam(self):
+        instance = create_attachment_instance(ControllerExpenses, 3)
+        token_credentials = FakeTokenCredentials()
+
+        response = self._get_signed_urls(instance, lambda: token_credentials)
+
+        self.assertEqual(len(response.json), 3)
+        self.assertEqual(token_credentials.refreshes, 1)
+        self.assertEqual(
+            instance.cs_client.signing_arguments,
+            [
+                {
+                    "service_account_email": "api@example.iam.gserviceaccount.com",
+                    "access_token": "token-1",
+                }
+            ]
+            * 3,
+        )
+
+    def test_permission_is_checked(self):
+        instance = create_attachment_instance(EmployeeExpenses, 2)
+
+        response = instance.get_attachment(EXPENSE_ID, mode="signed_url")
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(instance.cs_client.signed_urls, 0)
+
+
+class TestCreateAttachment(BaseTestCase):
+    """ Test the PDFs that are processed off the request """
+
+    def setUp(self):
+        self.instance = create_attachment_instance(EmployeeExpenses, 0)
+        self.instance.employee_info = {"unique_name": "pietje.puk@example.com"}
+        self.bucket = self.instance.cs_client.get_bucket("attachments")
+
+    def test_pdf_is_flattened(self):
+        self.assertTrue(
+            self.instance.create_attachment(
+                create_attachment_data(create_pdf(3)),
+                EXPENSE_ID,
+                "pietje.puk@example.com",
+            )
+        )
+        self.assertTrue(attachment_processor.flush(timeout=30))
+
+        (name,) = self.bucket.blobs
+        self.assertTrue(name.startswith(ATTACHMENT_PREFIX))
+        self.assertEqual(self.bucket.metadata[name], {"status": "processed"})
+        with pikepdf.open(io.BytesIO(self.bucket.blobs[name])) as pdf:
+            self.assertEqual(len(pdf.pages), 3)
+            self.assertNotIn("/OpenAction", pdf.Root)
+
+    def test_image_is_stored_directly(self):
+        self.instance.create_attachment(
+            create_attachment_data(b"jpeg", "image/jpeg"),
+            EXPENSE_ID,
+            "pietje.puk@example.com",
+        )
+
+        (name,) = self.bucket.blobs
+        self.assertTrue(name.startswith(ATTACHMENT_PREFIX))
+
+    def test_invalid_pdf_is_listed_as_failed(self):
+        self.instance.create_attachment(
+            create_attachment_data(b"not a pdf"), EXPENSE_ID, "pietje.puk@example.com"
+        )
+        self.assertTrue(attachment_processor.flush(timeout=30))
+
+        (name,) = self.bucket.blobs
+        self.assertTrue(name.startswith(PENDING_ATTACHMENT_PREFIX))
+
+        response = self.instance.get_attachment(EXPENSE_ID)
+
+        self.assertEqual(
+            json.loads("".join(response.response)),
+            [
+                {
+                    "content_type": "application/pdf",
+                    "name": name.split("/")[-1],
+                    "status": "failed",
+                }
+            ],
+        )
+
+        response = self.instance.delete_attachment(EXPENSE_ID, name.split("/")[-1])
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.bucket.blobs, {})
+
+
+class TestAttachmentIndex(BaseTestCase):
+    """ Test the attachments kept on the expense """
+
+    def setUp(self):
+        self.instance = create_attachment_instance(EmployeeExpenses, 2)
+        self.instance.employee_info = {"unique_name": "pietje.puk@example.com"}
+        self.expense = self.instance.ds_client.get(
+            self.instance.ds_client.key("Expenses", EXPENSE_ID)
+        )
+        self.expense["status"] = {"text": "draft"}
+
+    def test_attachments_are_kept_on_expense(self):
+        self.instance.create_attachment(
+            create_attachment_data(b"png", "image/png"),
+            EXPENSE_ID,
+            "pietje.puk@example.com",
+        )
+
+        self.assertEqual(
+            [attachment["name"] for attachment in self.expense["attachments"]][:2],
+            ["receipt_0", "receipt_1"],
+        )
+        self.assertEqual(self.expense["attachments"][2]["content_type"], "image/png")
+        self.assertIn("attachments", self.expense.exclude_from_indexes)
+
+        self.instance.delete_attachment(EXPENSE_ID, "receipt_0")
+        self.instance.delete_attachment(EXPENSE_ID, "receipt_1")
+
+        self.assertEqual(len(self.expense["attachments"]), 1)
+
+    def test_pdf_status_is_kept_on_expense(self):
+        self.expense["attachments"] = []
+        for name, content in [("valid.pdf", create_pdf(1)), ("invalid.pdf", b"pdf")]:
+            self.instance.create_attachment(
+                create_attachment_data(content, name=name),
+                EXPENSE_ID,
+                "pietje.puk@example.com",
+            )
+        self.assertTrue(attachment_processor.flush(timeout=30))
+
+        self.assertEqual(
+            [attachment["status"] for attachment in self.expense["attachments"]],
+            ["processed", "failed"],
+        )
+
+    def test_attachments_are_listed_outside_the_transaction(self):
+        in_transaction = []
+
+        @contextlib.contextmanager
+        def transaction():
+            in_transaction.append(True)
+            yield
+            in_transaction.pop()
+
+        def list_attachments(expense):
+            self.assertEqual(in_transaction, [])
+            return []
+
+        with mock.patch.object(
+            self.instance.ds_client, "transaction", transaction
+        ), mock.patch.object(self.instance, "_list_attachments", list_attachments):
+            self.instance.delete_attachment(EXPENSE_ID, "receipt_0")
+
+        self.assertEqual(self.expense["attachments"], [])
+
+    def test_blob_is_deleted_when_expense_update_fails(self):
+        bucket = self.instance.cs_client.get_bucket("attachments")
+        blobs = dict(bucket.blobs)
+
+        with mock.patch.object(
+            self.instance, "_update_attachments", side_effect=RuntimeError
+        ):
+            self.assertFalse(
+                self.instance.create_attachment(
+                    create_attachment_data(create_pdf(1)),
+                    EXPENSE_ID,
+                    "pietje.puk@example.com",
+                )
+            )
+
+        self.assertEqual(bucket.blobs, blobs)
+
+    def test_submit_reads_attachments_from_expense(self):
+        self.expense["attachments"] = []
+        list_calls = self.instance.cs_client.list_calls
+
+        self.assertFalse(
+            self.instance._has_attachments(
+                self.expense, {"status": "ready_for_manager"}
+            )
+        )
+        self.assertEqual(self.instance.cs_client.list_calls, list_calls)
+
+    def test_submit_lists_attachments_of_older_expenses(self):
+        self.assertTrue(
+            self.instance._has_attachments(
+                self.expense, {"status": "ready_for_manager"}
+            )
+        )
+
+    def test_submit_needs_a_processed_attachment(self):
+        self.expense["attachments"] = [
+            {"name": "receipt_0", "status": "pending"},
+            {"name": "receipt_1", "status": "failed"},
+        ]
+
+        self.assertFalse(
+            self.instance._has_attachments(
+                self.expense, {"status": "ready_for_manager"}
+            )
+        )
+
+    def test_submit_lists_pending_attachments_of_older_expenses(self):
+        bucket = self.instance.cs_client.get_bucket("attachments")
+        bucket.blobs.clear()
+        blob = bucket.blob(f"{PENDING_ATTACHMENT_PREFIX}/receipt")
+        blob.metadata = {"status": "pending"}
+        blob.upload_from_string(b"pdf", content_type="application/pdf")
+
+        self.assertFalse(
+            self.instance._has_attachments(
+                self.expense, {"status": "ready_for_manager"}
+            )
+        )
+
+
+class TestSweepAttachments(BaseTestCase):
+    """ Test resubmitting the PDFs that were left pending """
+
+    def setUp(self):
+        self.bucket = FakeStorageClient().get_bucket("attachments")
+        self.processor = AttachmentProcessor(max_workers=0, stale_after=0)
+
+    def _add_pending(self, content, metadata):
+        blob = self.bucket.blob(f"{PENDING_ATTACHMENT_PREFIX}/receipt")
+        blob.metadata = metadata
+        blob.upload_from_string(content, content_type="application/pdf")
+
+    def test_stale_pdf_is_processed(self):
+        self._add_pending(create_pdf(1), {"status": "pending"})
+
+        self.assertEqual(self.processor.sweep(self.bucket), 1)
+
+        self.assertEqual(list(self.bucket.blobs), [f"{ATTACHMENT_PREFIX}/receipt"])
+        stats = self.processor.stats()
+        self.assertEqual(stats["queued"], 1)
+        self.assertEqual(stats["processed"], 1)
+        self.assertEqual(stats["pages"], 1)
+
+    def test_recent_pdf_is_left_pending(self):
+        self._add_pending(create_pdf(1), {"status": "pending"})
+        self.processor.stale_after = 60
+
+        self.assertEqual(self.processor.sweep(self.bucket), 0)
+
+    def test_failed_pdf_is_retried_until_max_attempts(self):
+        self._add_pending(b"not a pdf", {"status": "failed", "attempts": "1"})
+
+        self.assertEqual(self.processor.sweep(self.bucket), 1)
+        self.assertEqual(self.processor.sweep(self.bucket), 1)
+        self.assertEqual(self.processor.sweep(self.bucket), 0)
+
+        self.assertEqual(
+            self.bucket.metadata[f"{PENDING_ATTACHMENT_PREFIX}/receipt"],
+            {"status": "failed", "attempts": "3"},
+        )
+        self.assertEqual(self.processor.stats()["failed"], 2)
+
+    def test_submit_sweeps_once_per_interval(self):
+        self._add_pending(b"not a pdf", {"status": "failed", "attempts": "1"})
+
+        self.processor.submit(self.bucket, "other", create_pdf(1), "application/pdf")
+        self.processor.submit(self.bucket, "other", create_pdf(1), "application/pdf")
+
+        self.assertEqual(
+            self.bucket.metadata[f"{PENDING_ATTACHMENT_PREFIX}/receipt"],
+            {"status": "failed", "attempts": "2"},
+        )
+
+
+class TestResumableUpload(BaseTestCase):
+    """ Test the chunked attachment uploads """
+
+    CHUNK_SIZE = 256 * 1024
+
+    def setUp(self):
+        self.instance = create_attachment_instance(EmployeeExpenses, 0)
+        self.instance.employee_info = {"unique_name": "pietje.puk@example.com"}
+        self.bucket = self.instance.cs_client.get_bucket("attachments")
+
+        upload_session = FakeUploadSession(self.instance.cs_client)
+        patcher = mock.patch.object(
+            attachment_uploads, "upload_session", upload_session
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _initiate(self, content, content_type="image/jpeg"):
+        response = self.instance.initiate_attachment_upload(
+            EXPENSE_ID,
+            {"name": "receipt", "content_type": content_type, "size": len(content)},
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.json["upload_id"]
+
+    def _upload_chunk(self, upload_id, content, first, last):
+        return self.instance.upload_attachment_chunk(
+            EXPENSE_ID,
+            upload_id,
+            f"bytes {first}-{last}/{len(content)}",
+            content[first : last + 1],
+        )
+
+    def test_chunked_upload_is_resumed(self):
+        content = os.urandom(2 * self.CHUNK_SIZE + 1000)
+        upload_id = self._initiate(content)
+
+        response = self._upload_chunk(upload_id, content, 0, self.CHUNK_SIZE - 1)
+        self.assertEqual(response.json["offset"], self.CHUNK_SIZE)
+
+        response = self.instance.finalize_attachment_upload(EXPENSE_ID, upload_id)
+        self.assertEqual(response.status_code, 409)
+
+        response = self.instance.get_attachment_upload_status(EXPENSE_ID, upload_id)
+        self.assertEqual(response.json["offset"], self.CHUNK_SIZE)
+
+        for first in range(response.json["offset"], len(content), self.CHUNK_SIZE):
+            last = min(first + self.CHUNK_SIZE, len(content)) - 1
+            response = self._upload_chunk(upload_id, content, first, last)
+        self.assertEqual(response.json["offset"], len(content))
+        self.assertEqual(response.json["attachment"]["status"], "processed")
+
+        (name,) = self.bucket.blobs
+        self.assertTrue(name.startswith(ATTACHMENT_PREFIX))
+        self.assertEqual(self.bucket.blobs[name], content)
+        expense = self.instance.ds_client.get(
+            self.instance.ds_client.key("Expenses", EXPENSE_ID)
+        )
+        self.assertEqual(len(expense["attachments"]), 1)
+
+        # Finalizing is optional, it returns the attachment that was added
+        response = self.instance.finalize_attachment_upload(EXPENSE_ID, upload_id)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json["name"], name.split("/")[-1])
+        self.assertEqual(len(expense["attachments"]), 1)
+
+    def test_uploaded_pdf_is_flattened(self):
+        content = create_pdf(2)
+        upload_id = self._initiate(content, "application/pdf")
+        response = self._upload_chunk(upload_id, content, 0, len(content) - 1)
+
+        self.assertEqual(response.json["attachment"]["status"], "pending")
+        self.assertTrue(attachment_processor.flush(timeout=30))
+
+        (name,) = self.bucket.blobs
+        self.assertTrue(name.startswith(ATTACHMENT_PREFIX))
+        self.assertEqual(self.bucket.metadata[name], {"status": "processed"})
+
+    def test_upload_is_deleted_when_expense_update_fails(self):
+        content = os.urandom(1000)
+        upload_id = self._initiate(content)
+
+        with mock.patch.object(
+            self.instance, "_update_attachments", side_effect=RuntimeError
+        ):
+            response = self._upload_chunk(upload_id, content, 0, len(content) - 1)
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.bucket.blobs, {})
+        self.assertEqual(self.instance.ds_client.kinds["AttachmentUploads"], {})
+
+    def _expire(self, upload_id):
+        upload = self.instance.ds_client.get(
+            self.instance.ds_client.key("AttachmentUploads", upload_id)
+        )
+        upload["created"] -= datetime.timedelta(days=2)
+
+    def test_expired_upload_is_not_found(self):
+        content = os.urandom(1000)
+        upload_id = self._initiate(content)
+        self._expire(upload_id)
+
+        response = self._upload_chunk(upload_id, content, 0, len(content) - 1)
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_expired_uploads_are_cleaned_up(self):
+        content = os.urandom(1000)
+        abandoned_id = self._initiate(content)
+        # Completed by Cloud Storage, but the response never got back
+        upload = self.instance.ds_client.get(
+            self.instance.ds_client.key("AttachmentUploads", abandoned_id)
+        )
+        attachment_uploads.upload_session.put(
+            upload["session_url"],
+            content,
+            {"Content-Range": f"bytes 0-{len(content) - 1}/{len(content)}"},
+        )
+        unfinished = os.urandom(2 * self.CHUNK_SIZE)
+        unfinished_id = self._initiate(unfinished)
+        self._upload_chunk(unfinished_id, unfinished, 0, self.CHUNK_SIZE - 1)
+        self._expire(abandoned_id)
+        self._expire(unfinished_id)
+        recent_id = self._initiate(content)
+
+        cleaned_up = UploadCleanup().run(self.instance.ds_client, self.bucket)
+
+        self.assertEqual(cleaned_up, 2)
+        self.assertEqual(self.bucket.blobs, {})
+        self.assertEqual(
+            list(self.instance.ds_client.kinds["AttachmentUploads"]),
+            [self.instance.ds_client.key("AttachmentUploads", recent_id)],
+        )
+
+    def test_unaligned_chunk_is_rejected(self):
+        content = os.urandom(2 * self.CHUNK_SIZE)
+        upload_id = self._initiate(content)
+
+        response = self._upload_chunk(upload_id, content, 0, 1000)
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_upload_of_other_employee_is_not_found(self):
+        content = os.urandom(1000)
+        upload_id = self._initiate(content)
+        self.instance.employee_info = {"unique_name": "someone.else@example.com"}
+
+        response = self._upload_chunk(upload_id, content, 0, len(content) - 1)
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_too_large_upload_is_rejected(self):
+        response = self.instance.initiate_attachment_upload(
+            EXPENSE_ID,
+            {"name": "receipt", "content_type": "image/png", "size": 1 << 40},
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
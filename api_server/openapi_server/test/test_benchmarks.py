@@ -0,0 +1,483 @@
+import datetime
+import io
+import logging
+import threading
+import time
+import tracemalloc
+import unittest
+from unittest import mock
+
+from flask import g
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import datastore, storage
+from openapi_server.controllers import attachment_processing
+from openapi_server.controllers.attachment_processing import (
+    attachment_processor, flatten_pdf)
+from openapi_server.controllers.client_registry import ClientRegistry
+from openapi_server.controllers.cost_types_cache import cost_types_cache
+from openapi_server.controllers.expense_controllers import (
+    ATTACHMENT_DOWNLOAD_WORKERS, EXPORTABLE_STATUSES, ClaimExpenses,
+    ControllerExpenses, CreditorExpenses, EmployeeExpenses)
+from openapi_server.controllers.mail_template import MailTemplate
+from openapi_server.test import BaseTestCase
+from openapi_server.test.fake_datastore import FakeDatastoreClient
+from openapi_server.test.fake_storage import FakeStorageClient
+from openapi_server.test.test_attachments import (EXPENSE_ID,
+                                                  create_attachment_data,
+                                                  create_attachment_instance,
+                                                  create_pdf,
+                                                  expected_attachments)
+from openapi_server.test.test_booking_file import (create_booking_file_rows,
+                                                   create_export_expenses)
+from openapi_server.test.test_mail_template import (MAIL_VALUES, TEMPLATE,
+                                                    render_with_replace)
+from openapi_server.test.test_payment_file import (create_payment_expenses,
+                                                   create_payment_file_tree,
+                                                   create_payment_instance,
+                                                   power2pay_enabled)
+
+
+def create_expense_instance(expense_class, ds_client):
+    """
+    Create a controller instance without connecting to Google Cloud
+    """
+    instance = expense_class.__new__(expense_class)
+    instance.ds_client = ds_client
+    instance.cs_client = None
+    instance.employee_info = {"unique_name": "benchmark@example.com"}
+    instance.bucket_name = "benchmark"
+    return instance
+
+
+def fill_datastore(
+    ds_client,
+    number_of_expenses,
+    number_of_cost_types,
+    status="ready_for_creditor",
+    first_id=1,
+):
+    for number in range(number_of_cost_types):
+        ds_client.add(
+            "CostTypes",
+            {"Active": number % 10 != 0, "Omschrijving": f"Cost type {number}"},
+            str(400000 + number),
+        )
+
+    for number in range(number_of_expenses):
+        cost_type_id = 400000 + (number * 7) % number_of_cost_types
+        ds_client.add(
+            "Expenses",
+            {
+                "amount": 10.0 + number % 100,
+                "note": f"Expense {number}",
+                "cost_type": f"Cost type:{cost_type_id}"
+                if number % 2
+                else str(cost_type_id),
+                "claim_date": f"2020-01-{1 + number % 28:02d}T12:00:00Z",
+                "transaction_date": "2020-01-01T12:00:00Z",
+                "employee": {
+                    "full_name": "Puk, Pietje",
+                    "afas_data": {
+                        "Bedrijf": "VWT",
+                        "Afdeling Code": "1234",
+                        "Afdelingsomschrijving": "Finance",
+                        "Manager_personeelsnummer": 1,
+                    },
+                },
+                "status": {"text": status, "export_date": "never"},
+            },
+            first_id + number,
+        )
+
+
+def measure(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def measure_peak_memory(func, *args, **kwargs):
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class TestCostTypeIndexBenchmark(BaseTestCase):
+    """
+    Benchmark of listing expenses against the cost type index
+    """
+
+    NUMBER_OF_COST_TYPES = 500
+    SIZES = [1000, 5000, 10000]
+
+    def setUp(self):
+        cost_types_cache.invalidate()
+
+    def tearDown(self):
+        cost_types_cache.invalidate()
+
+    @staticmethod
+    def _linear_scan(ds_client):
+        # Cost type resolution as it was done before the index: one scan per row
+        cost_type_list = list(ds_client.query(kind="CostTypes").fetch())
+        for expense in ds_client.query(kind="Expenses").fetch():
+            cost_type_id = expense["cost_type"].split(":")[-1]
+            for cost_type in cost_type_list:
+                if cost_type.key.name == cost_type_id:
+                    break
+
+    @staticmethod
+    def _index_lookup(ds_client):
+        instance = create_expense_instance(ControllerExpenses, ds_client)
+        cost_type_index = cost_types_cache.get_index(ds_client)
+        for expense in ds_client.query(kind="Expenses").fetch():
+            instance._process_cost_type(expense["cost_type"], cost_type_index)
+
+    def test_listing_scales_with_expenses(self):
+        results = []
+        for size in self.SIZES:
+            ds_client = FakeDatastoreClient()
+            fill_datastore(ds_client, size, self.NUMBER_OF_COST_TYPES)
+
+            cost_types_cache.invalidate()
+            controller = create_expense_instance(ControllerExpenses, ds_client)
+            rpc_count = ds_client.rpc_count
+            controller_time = measure(controller.get_all_expenses)
+            controller_rpcs = ds_client.rpc_count - rpc_count
+
+            cost_types_cache.invalidate()
+            creditor = create_expense_instance(CreditorExpenses, ds_client)
+            creditor_time = measure(
+                creditor.get_all_expenses, "expenses_all", "1970-01-01", "1970-01-01"
+            )
+
+            cost_types_cache.invalidate()
+            index_time = measure(self._index_lookup, ds_client)
+            linear_time = measure(self._linear_scan, ds_client)
+
+            results.append(
+                (
+                    size,
+                    controller_time,
+                    controller_rpcs,
+                    creditor_time,
+                    index_time,
+                    linear_time,
+                )
+            )
+
+        for size, controller_time, _, creditor_time, index_time, linear_time in results:
+            logging.warning(
+                f"{size} expenses x {self.NUMBER_OF_COST_TYPES} cost types: "
+                f"controller {controller_time:.3f}s, creditor {creditor_time:.3f}s, "
+                f"cost type index {index_time:.3f}s, linear scan {linear_time:.3f}s"
+            )
+
+        # The expenses query and a single CostTypes query, whatever the size
+        self.assertEqual({result[2] for result in results}, {2})
+
+
+class TestExportSelectionBenchmark(BaseTestCase):
+    """
+    Benchmark of selecting the expenses to export while the exported history grows
+    """
+
+    NUMBER_OF_APPROVED = 200
+    SIZES = [1000, 10000, 30000]
+
+    @staticmethod
+    def _full_scan(ds_client):
+        # Selection as it was done before the status query: read the whole kind
+        return [
+            expense
+            for expense in ds_client.query(kind="Expenses").fetch()
+            if expense["status"]["text"] in EXPORTABLE_STATUSES
+        ]
+
+    def test_selection_stays_flat(self):
+        results = []
+        for size in self.SIZES:
+            ds_client = FakeDatastoreClient()
+            fill_datastore(ds_client, size, 10, status="exported")
+            fill_datastore(
+                ds_client, self.NUMBER_OF_APPROVED, 10, "approved", first_id=size + 1
+            )
+            instance = create_expense_instance(ClaimExpenses, ds_client)
+
+            entities_read = ds_client.entities_read
+            start = time.perf_counter()
+            selected = instance.filter_expenses_to_export()
+            selection_time = time.perf_counter() - start
+            entities_read = ds_client.entities_read - entities_read
+
+            scan_time = measure(self._full_scan, ds_client)
+
+            self.assertEqual(len(selected), self.NUMBER_OF_APPROVED)
+            results.append((size, selection_time, entities_read, scan_time))
+
+        for size, selection_time, entities_read, scan_time in results:
+            logging.warning(
+                f"{size} exported + {self.NUMBER_OF_APPROVED} approved expenses: "
+                f"status query {selection_time:.4f}s ({entities_read} entities read), "
+                f"full scan {scan_time:.4f}s"
+            )
+
+        self.assertEqual(
+            {entities_read for _, _, entities_read, _ in results},
+            {self.NUMBER_OF_APPROVED},
+        )
+
+
+class TestBookingFileBenchmark(BaseTestCase):
+    """
+    Benchmark of the columnar booking file against the row by row builder
+    """
+
+    NUMBER_OF_EXPENSES = 10000
+
+    def test_booking_file_10k(self):
+        ds_client = FakeDatastoreClient()
+        expenses = create_export_expenses(ds_client, self.NUMBER_OF_EXPENSES)
+        document_date = datetime.datetime(2020, 3, 9, 14, 30)
+
+        instance = create_expense_instance(CreditorExpenses, ds_client)
+        instance.cs_client = FakeStorageClient()
+
+        rpc_count = ds_client.rpc_count
+        columnar_time = measure(
+            instance.create_booking_file, expenses, "benchmark", document_date
+        )
+        columnar_rpcs = ds_client.rpc_count - rpc_count
+
+        rpc_count = ds_client.rpc_count
+        rows_time = measure(
+            create_booking_file_rows, ds_client, expenses, document_date
+        )
+        rows_rpcs = ds_client.rpc_count - rpc_count
+
+        logging.warning(
+            f"Booking file of {self.NUMBER_OF_EXPENSES} expenses: "
+            f"columnar {columnar_time:.3f}s ({columnar_rpcs} lookups), "
+            f"row by row {rows_time:.3f}s ({rows_rpcs} lookups)"
+        )
+
+        self.assertEqual(columnar_rpcs, 1)
+
+
+class TestPaymentFileBenchmark(BaseTestCase):
+    """
+    Benchmark of the peak memory of the streamed payment file against the
+    xml.etree tree
+    """
+
+    SIZES = [2000, 5000, 10000]
+
+    def test_payment_file_memory(self):
+        document_time = datetime.datetime(2020, 3, 9, 14, 30, 5)
+
+        results = []
+        for size in self.SIZES:
+            expenses = create_payment_expenses(size)
+            instance = create_payment_instance(FakeStorageClient(keep_uploads=False))
+
+            sent = []
+            with power2pay_enabled(sent, keep_files=False):
+                streamed_peak = measure_peak_memory(
+                    instance.create_payment_file, expenses, "benchmark", document_time
+                )
+            self.assertEqual(len(sent), 1)
+            tree_peak = measure_peak_memory(
+                create_payment_file_tree, instance, expenses, document_time
+            )
+            results.append((size, streamed_peak, tree_peak))
+
+        for size, streamed_peak, tree_peak in results:
+            logging.warning(
+                f"Payment file of {size} expenses: peak memory streamed "
+                f"{streamed_peak / 2 ** 20:.1f} MiB, tree {tree_peak / 2 ** 20:.1f} MiB"
+            )
+
+        smallest, largest = results[0], results[-1]
+        self.assertLess(largest[1], 2 * smallest[1])
+        self.assertLess(largest[1], largest[2])
+
+
+class TestMailTemplateBenchmark(BaseTestCase):
+    """
+    Benchmark of rendering mails with the compiled template
+    """
+
+    NUMBER_OF_MAILS = 10000
+
+    def _render_compiled(self, compiled):
+        footer = {"$MAIL_FOOTER": MAIL_VALUES["$MAIL_FOOTER"]}
+        for number in range(self.NUMBER_OF_MAILS):
+            compiled.partial(footer).render(
+                dict(MAIL_VALUES, **{"$MAIL_SALUTATION": f"Beste {number},"})
+            )
+
+    def _render_replace(self):
+        for number in range(self.NUMBER_OF_MAILS):
+            render_with_replace(
+                TEMPLATE, dict(MAIL_VALUES, **{"$MAIL_SALUTATION": f"Beste {number},"})
+            )
+
+    def test_render_10k_mails(self):
+        compiled = MailTemplate.compile(TEMPLATE)
+
+        compiled_time = measure(self._render_compiled, compiled)
+        replace_time = measure(self._render_replace)
+        mails_per_second = self.NUMBER_OF_MAILS / compiled_time
+
+        logging.warning(
+            f"Rendering {self.NUMBER_OF_MAILS} mails: compiled template "
+            f"{compiled_time:.3f}s ({mails_per_second:.0f} mails/s), "
+            f"chained replace {replace_time:.3f}s"
+        )
+
+
+class TestAttachmentDownloadBenchmark(BaseTestCase):
+    """
+    Benchmark of streaming attachments that are downloaded concurrently
+    """
+
+    DOWNLOAD_LATENCY = 0.05
+    SIZES = [1, 4, 8, 16]
+
+    def test_latency_by_attachment_count(self):
+        results = []
+        for size in self.SIZES:
+            instance = create_attachment_instance(
+                ControllerExpenses, size, size=512 * 1024
+            )
+            instance.cs_client.download_latency = self.DOWNLOAD_LATENCY
+
+            streamed_time = measure(
+                lambda: "".join(instance.get_attachment(EXPENSE_ID).response)
+            )
+            overlapping = instance.cs_client.max_active_downloads
+            sequential_time = measure(expected_attachments, instance)
+            results.append((size, streamed_time, sequential_time, overlapping))
+
+        for size, streamed_time, sequential_time, _ in results:
+            logging.warning(
+                f"{size} attachments of 512 KiB with {self.DOWNLOAD_LATENCY}s latency: "
+                f"streamed {streamed_time:.3f}s, sequential {sequential_time:.3f}s"
+            )
+
+        # Downloads overlap, bounded by the pool
+        self.assertEqual(
+            [result[3] for result in results],
+            [min(size, ATTACHMENT_DOWNLOAD_WORKERS) for size in self.SIZES],
+        )
+
+
+class TestPdfFlattenBenchmark(BaseTestCase):
+    """
+    Benchmark of flattening PDFs by page count, and of the upload request that
+    leaves the flattening to the background workers
+    """
+
+    PAGES = [1, 10, 50, 200]
+
+    def test_flatten_throughput_by_page_count(self):
+        results = []
+        for pages in self.PAGES:
+            content = create_pdf(pages)
+            flatten_time = measure(flatten_pdf, content, io.BytesIO())
+
+            instance = create_attachment_instance(EmployeeExpenses, 0)
+            flattened_on = []
+
+            def record_thread(*args):
+                flattened_on.append(threading.current_thread())
+                return flatten_pdf(*args)
+
+            with mock.patch.object(attachment_processing, "flatten_pdf", record_thread):
+                request_time = measure(
+                    instance.create_attachment,
+                    create_attachment_data(content),
+                    EXPENSE_ID,
+                    "pietje.puk@example.com",
+                )
+                self.assertTrue(attachment_processor.flush(timeout=60))
+
+            # The request leaves the flattening to a worker
+            self.assertEqual(len(flattened_on), 1)
+            self.assertIsNot(flattened_on[0], threading.current_thread())
+            results.append((pages, flatten_time, request_time))
+
+        for pages, flatten_time, request_time in results:
+            logging.warning(
+                f"{pages} pages: flattened in {flatten_time:.3f}s "
+                f"({pages / flatten_time:.0f} pages/s), "
+                f"upload request {request_time:.3f}s"
+            )
+
+
+def create_datastore_client():
+    ds_client = datastore.Client(
+        project="benchmark", credentials=AnonymousCredentials()
+    )
+    ds_client._datastore_api  # The gRPC channel is opened by the first call
+    return ds_client
+
+
+def create_storage_client():
+    cs_client = storage.Client(project="benchmark", credentials=AnonymousCredentials())
+    cs_client._http  # The HTTP session is created by the first call
+    return cs_client
+
+
+class TestClientRegistryBenchmark(BaseTestCase):
+    """
+    Benchmark of building the clients for every request against sharing them.
+    Credentials are anonymous, so the credential discovery that is saved as
+    well is not part of the numbers.
+    """
+
+    REQUESTS = 200
+
+    def setUp(self):
+        self.clients_built = 0
+
+    def _create_client(self, factory):
+        self.clients_built += 1
+        return factory()
+
+    def _create_registry(self):
+        return ClientRegistry(
+            datastore_factory=lambda: self._create_client(create_datastore_client),
+            storage_factory=lambda: self._create_client(create_storage_client),
+            firebase_factory=object,
+        )
+
+    def _requests(self, get_registry):
+        for _ in range(self.REQUESTS):
+            ControllerExpenses(get_registry())
+
+    def test_request_latency(self):
+        shared_registry = self._create_registry()
+
+        with self.app.test_request_context():
+            g.token = {"unique_name": "pietje.puk@example.com"}
+
+            startup_time = measure(shared_registry.initialize)
+            per_request_time = measure(self._requests, self._create_registry)
+            self.clients_built = 0
+            shared_time = measure(self._requests, lambda: shared_registry)
+
+        logging.warning(
+            f"Startup {startup_time * 1000:.2f}ms, per request "
+            f"{per_request_time / self.REQUESTS * 1000:.3f}ms with new clients, "
+            f"{shared_time / self.REQUESTS * 1000:.3f}ms with shared clients"
+        )
+
+        self.assertEqual(self.clients_built, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
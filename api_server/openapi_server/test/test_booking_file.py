@@ -0,0 +1,232 @@
+import datetime
+import unittest
+from unittest import mock
+
+import config
+import dateutil
+import pandas as pd
+
+from google.api_core import exceptions as gcp_exceptions
+from openapi_server.controllers import expense_controllers
+from openapi_server.controllers.expense_controllers import (
+    EXPORT_COMMIT_ATTEMPTS,
+    CreditorExpenses,
+)
+from openapi_server.test import BaseTestCase
+from openapi_server.test.fake_datastore import FakeDatastoreClient
+from openapi_server.test.fake_storage import FakeStorageClient
+
+
+def create_booking_file_rows(ds_client, expense_claims_to_export, document_date):
+    """
+    Booking file as it was built row by row before the columnar pipeline
+    """
+    booking_file_data = []
+    for expense_detail in expense_claims_to_export:
+        trans_date = dateutil.parser.parse(expense_detail["transaction_date"]).strftime(
+            "%d-%m-%Y"
+        )
+        boekingsomschrijving_bron = (
+            f"{expense_detail['employee']['afas_data']['Personeelsnummer']} {trans_date}"
+        )
+
+        grootboek_number = expense_detail["cost_type"]
+        cost_type_split = (
+            grootboek_number.split(":")[1]
+            if ":" in grootboek_number
+            else grootboek_number
+        )
+
+        try:
+            cost_entity = ds_client.get(key=ds_client.key("CostTypes", cost_type_split))
+            grootboek_number = cost_entity["Grootboek"]
+        except Exception:
+            grootboek_number = cost_type_split
+
+        booking_file_data.append(
+            {
+                "BoekingsomschrijvingBron": boekingsomschrijving_bron,
+                "Document-datum": document_date.strftime("%d%m%Y"),
+                "Boekings-jaar": document_date.strftime("%Y"),
+                "Periode": document_date.strftime("%m"),
+                "Bron-bedrijfs-nummer": config.BOOKING_FILE_STATICS[
+                    "Bron-bedrijfs-nummer"
+                ],
+                "Bron gr boekrek": config.BOOKING_FILE_STATICS[
+                    "Bron-grootboek-rekening"
+                ],
+                "Bron Org Code": config.BOOKING_FILE_STATICS["Bron-org-code"],
+                "Bron Process": "000",
+                "Bron Produkt": "000",
+                "Bron EC": "000",
+                "Bron VP": "00",
+                "Doel-bedrijfs-nummer": config.BOOKING_FILE_STATICS[
+                    "Doel-bedrijfs-nummer"
+                ],
+                "Doel-gr boekrek": grootboek_number,
+                "Doel Org code": config.BOOKING_FILE_STATICS["Doel-org-code"],
+                "Doel Proces": "000",
+                "Doel Produkt": "000",
+                "Doel EC": "000",
+                "Doel VP": "00",
+                "D/C": "C",
+                "Bedrag excl. BTW": expense_detail["amount"],
+                "BTW-Bedrag": "0,00",
+            }
+        )
+
+    return pd.DataFrame(booking_file_data).to_csv(sep=";", index=False, decimal=",")
+
+
+def create_export_expenses(ds_client, number_of_expenses):
+    transaction_dates = [
+        "2020-03-01T12:00:00.000Z",
+        "2020-03-02T23:30:00+02:00",
+        "2020-03-03",
+        "2020-03-04T08:15:00",
+        "4 March 2020",
+        "03/05/2020 10:00",
+    ]
+    cost_types = ["401000", "Reiskosten:402000", "403000", "Oud:499999"]
+    amounts = [12.5, 7, 100.0, 0.99, 1234.56]
+
+    ds_client.add("CostTypes", {"Grootboek": 440100}, "401000")
+    ds_client.add("CostTypes", {"Grootboek": "440200"}, "402000")
+    ds_client.add("CostTypes", {"Omschrijving": "Zonder grootboek"}, "403000")
+
+    return [
+        ds_client.add(
+            "Expenses",
+            {
+                "amount": amounts[number % len(amounts)],
+                "cost_type": cost_types[number % len(cost_types)],
+                "transaction_date": transaction_dates[number % len(transaction_dates)],
+                "employee": {"afas_data": {"Personeelsnummer": 10000 + number}},
+            },
+            number + 1,
+        )
+        for number in range(number_of_expenses)
+    ]
+
+
+class TestBookingFile(BaseTestCase):
+    """ Test the booking file against the row by row implementation """
+
+    def test_booking_file_is_byte_identical(self):
+        ds_client = FakeDatastoreClient()
+        expenses = create_export_expenses(ds_client, 60)
+        document_date = datetime.datetime(2020, 3, 9, 14, 30)
+
+        instance = CreditorExpenses.__new__(CreditorExpenses)
+        instance.ds_client = ds_client
+        instance.cs_client = FakeStorageClient()
+        instance.bucket_name = "booking"
+
+        expected = create_booking_file_rows(ds_client, expenses, document_date)
+        rpc_count = ds_client.rpc_count
+        result = instance.create_booking_file(expenses, "20200309143000", document_date)
+
+        self.assertEqual(result[2].encode("utf-8"), expected.encode("utf-8"))
+        self.assertEqual(ds_client.rpc_count - rpc_count, 1)
+        self.assertEqual(expenses[1]["boekingsomschrijving_bron"], "10001 02-03-2020")
+        self.assertEqual(
+            instance.cs_client.get_bucket("booking").blobs[
+                "exports/booking_file/2020/3/9/20200309143000"
+            ],
+            expected,
+        )
+
+
+class TestUpdateExportedExpenses(BaseTestCase):
+    """ Test setting the exported expenses to exported """
+
+    def setUp(self):
+        self.ds_client = FakeDatastoreClient()
+        self.expenses = create_export_expenses(self.ds_client, 4)
+        for expense in self.expenses:
+            expense["status"] = {"text": "approved", "export_date": "never"}
+
+        self.instance = CreditorExpenses.__new__(CreditorExpenses)
+        self.instance.ds_client = self.ds_client
+        self.instance.cs_client = FakeStorageClient()
+        self.instance.bucket_name = "booking"
+        self.instance.employee_info = {"unique_name": "creditor@example.com"}
+
+    def _export(self):
+        with self.app.test_request_context(), mock.patch.multiple(
+            self.instance,
+            filter_expenses_to_export=mock.Mock(return_value=self.expenses),
+            create_booking_file=mock.Mock(return_value=(True, "booking", None)),
+            create_payment_file=mock.Mock(return_value=(True, "payment", None)),
+        ):
+            return self.instance.create_booking_and_payment_file()
+
+    def _status(self, number):
+        expense = self.ds_client.entities[self.ds_client.key("Expenses", number)]
+        return expense["status"]["text"]
+
+    def test_expenses_are_exported(self):
+        self.assertEqual(self._export().status_code, 200)
+
+        self.assertEqual(
+            [self._status(number) for number in range(1, 5)], ["exported"] * 4
+        )
+        self.assertEqual(len(self.ds_client.kinds["Expenses_Journal"]), 4)
+
+    def test_changed_status_is_skipped(self):
+        changed = self.ds_client.get(self.ds_client.key("Expenses", 2))
+        changed["status"] = {"text": "ready_for_manager", "export_date": "never"}
+        self.ds_client.put(changed)
+
+        outcomes = self.instance.update_exported_expenses(
+            self.expenses, datetime.datetime(2020, 3, 9, 14, 30)
+        )
+
+        self.assertEqual(outcomes[0]["exported"], 3)
+        self.assertEqual(outcomes[0]["skipped"], [2])
+        self.assertEqual(self._status(2), "ready_for_manager")
+        self.assertEqual(self._status(3), "exported")
+
+    def test_failing_chunk_fails_the_export(self):
+        with mock.patch.object(
+            self.ds_client,
+            "get_multi",
+            side_effect=gcp_exceptions.Conflict("Too much contention"),
+        ) as get_multi:
+            response = self._export()
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(get_multi.call_count, EXPORT_COMMIT_ATTEMPTS)
+        self.assertEqual(self._status(1), "approved")
+
+
+class TestFilterExpensesToExport(BaseTestCase):
+    """ Test selecting the expenses to export page by page """
+
+    def setUp(self):
+        self.ds_client = FakeDatastoreClient()
+        self.expenses = create_export_expenses(self.ds_client, 5)
+        for expense in self.expenses:
+            expense["status"] = {"text": "approved", "export_date": "never"}
+            self.ds_client.put(expense)
+
+        self.instance = CreditorExpenses.__new__(CreditorExpenses)
+        self.instance.ds_client = self.ds_client
+
+    def test_all_pages_are_read(self):
+        with mock.patch.object(expense_controllers, "EXPORT_QUERY_PAGE_SIZE", 2):
+            selected = self.instance.filter_expenses_to_export()
+
+        self.assertEqual(sorted(expense.id for expense in selected), [1, 2, 3, 4, 5])
+
+    def test_query_error_is_raised_as_is(self):
+        with mock.patch.object(
+            self.ds_client,
+            "query",
+            side_effect=gcp_exceptions.BadRequest("Missing index"),
+        ), self.assertRaises(gcp_exceptions.BadRequest):
+            self.instance.filter_expenses_to_export()
+
+
+if __name__ == "__main__":
+    unittest.main()
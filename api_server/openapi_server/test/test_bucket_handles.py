@@ -0,0 +1,49 @@
+import json
+import unittest
+
+from flask import g
+from openapi_server.controllers.bucket_handles import BucketHandles
+from openapi_server.controllers.expense_controllers import ControllerExpenses
+from openapi_server.test import BaseTestCase
+from openapi_server.test.fake_storage import FakeStorageClient
+from openapi_server.test.test_attachments import (EXPENSE_ID,
+                                                  create_attachment_instance)
+
+
+class TestBucketHandles(BaseTestCase):
+    """ Test the shared bucket handles """
+
+    def test_handle_is_shared(self):
+        handles = BucketHandles()
+        cs_client = FakeStorageClient()
+
+        bucket = handles.get(cs_client, "attachments")
+
+        self.assertIs(handles.get(cs_client, "attachments"), bucket)
+        self.assertEqual(cs_client.metadata_calls, 0)
+        self.assertEqual(
+            handles.stats(), {"hits": 1, "misses": 1, "metadata_calls_saved": 2}
+        )
+
+    def test_handle_follows_client(self):
+        handles = BucketHandles()
+        handles.get(FakeStorageClient(), "attachments")
+        cs_client = FakeStorageClient()
+
+        self.assertIs(handles.get(cs_client, "attachments").client, cs_client)
+
+    def test_saved_calls_are_counted_per_request(self):
+        instance = create_attachment_instance(ControllerExpenses, 2)
+        metadata_calls = instance.cs_client.metadata_calls
+
+        with self.app.test_request_context():
+            response = instance.get_attachment(EXPENSE_ID)
+
+            self.assertEqual(len(json.loads("".join(response.response))), 2)
+            self.assertEqual(g.storage_metadata_calls_saved, 1)
+
+        self.assertEqual(instance.cs_client.metadata_calls, metadata_calls)
+
+
+if __name__ == "__main__":
+    unittest.main()
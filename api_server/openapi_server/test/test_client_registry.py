@@ -0,0 +1,66 @@
+import concurrent.futures
+import threading
+import unittest
+
+from flask import g
+from openapi_server.controllers.businessrules_controller import \
+    BusinessRulesEngine
+from openapi_server.controllers.client_registry import ClientRegistry
+from openapi_server.controllers.expense_controllers import ControllerExpenses
+from openapi_server.test import BaseTestCase
+from openapi_server.test.fake_datastore import FakeDatastoreClient
+from openapi_server.test.fake_storage import FakeStorageClient
+
+
+def create_fake_registry():
+    return ClientRegistry(
+        datastore_factory=FakeDatastoreClient,
+        storage_factory=FakeStorageClient,
+        firebase_factory=object,
+    )
+
+
+class TestClientRegistry(BaseTestCase):
+    """ Test the process-wide clients """
+
+    def test_clients_are_built_once(self):
+        registry = create_fake_registry()
+        barrier = threading.Barrier(8)
+
+        def get_clients():
+            barrier.wait()
+            return registry.get_datastore(), registry.get_storage()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            clients = set(executor.map(lambda _: get_clients(), range(8)))
+
+        self.assertEqual(len(clients), 1)
+        self.assertEqual(registry.stats()["created"], 2)
+
+    def test_initialize_builds_all_clients(self):
+        registry = create_fake_registry()
+
+        registry.initialize()
+
+        self.assertEqual(
+            registry.stats(),
+            {"created": 3, "clients": ["datastore", "firebase", "storage"]},
+        )
+
+    def test_clients_are_injected(self):
+        registry = create_fake_registry()
+
+        with self.app.test_request_context():
+            g.token = {"unique_name": "pietje.puk@example.com"}
+            first = ControllerExpenses(registry)
+            second = ControllerExpenses(registry)
+
+        self.assertIs(first.ds_client, registry.get_datastore())
+        self.assertIs(first.cs_client, second.cs_client)
+        self.assertIs(
+            BusinessRulesEngine(first.ds_client).ds_client, registry.get_datastore()
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import threading
+import unittest
+
+from openapi_server.controllers.cost_types_cache import CostTypesCache
+from openapi_server.test import BaseTestCase
+from openapi_server.test.fake_datastore import FakeDatastoreClient
+
+
+class TestCostTypesCache(BaseTestCase):
+    """ Test the process-wide CostTypes cache """
+
+    def setUp(self):
+        self.ds_client = FakeDatastoreClient()
+        self.ds_client.add("CostTypes", {"Active": True, "Grootboek": "1"}, "400000")
+        self.ds_client.add("CostTypes", {"Grootboek": "2"}, "400001")
+
+    def test_cost_types_are_queried_once(self):
+        cache = CostTypesCache(ttl=300)
+
+        self.assertEqual(sorted(cache.get_all(self.ds_client)), ["400000", "400001"])
+        self.assertEqual(cache.get(self.ds_client, "400001")["Grootboek"], "2")
+        self.assertIsNone(cache.get(self.ds_client, "400002"))
+        self.assertEqual(self.ds_client.rpc_count, 3)  # The two adds and one query
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 1, "size": 2})
+
+    def test_index_holds_active_flag(self):
+        index = CostTypesCache().get_index(self.ds_client)
+
+        self.assertTrue(index["400000"][1])
+        self.assertFalse(index["400001"][1])
+
+    def test_ttl_bounds_staleness(self):
+        cache = CostTypesCache(ttl=0)
+        cache.get_all(self.ds_client)
+        self.ds_client.add("CostTypes", {"Active": True}, "400002")
+
+        self.assertIn("400002", cache.get_all(self.ds_client))
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_invalidate(self):
+        cache = CostTypesCache(ttl=300)
+        cache.get_all(self.ds_client)
+        self.ds_client.add("CostTypes", {"Active": True}, "400002")
+
+        self.assertNotIn("400002", cache.get_all(self.ds_client))
+        with self.assertLogs(level="INFO") as logs:
+            cache.invalidate()
+        self.assertIn("'hits': 1, 'misses': 1", logs.output[0])
+        self.assertIn("400002", cache.get_all(self.ds_client))
+        self.assertEqual(cache.stats()["size"], 3)
+
+    def test_load_during_invalidate_is_not_stored(self):
+        cache = CostTypesCache(ttl=300)
+        fetching = threading.Event()
+        invalidated = threading.Event()
+        query = self.ds_client.query
+
+        def slow_query(kind, order=None):
+            fetching.set()
+            invalidated.wait(5)
+            return query(kind, order)
+
+        self.ds_client.query = slow_query
+        thread = threading.Thread(target=cache.get_all, args=(self.ds_client,))
+        thread.start()
+        fetching.wait(5)
+        cache.invalidate()
+        invalidated.set()
+        thread.join()
+        self.ds_client.query = query
+        rpc_count = self.ds_client.rpc_count
+
+        cache.get_all(self.ds_client)
+
+        self.assertEqual(self.ds_client.rpc_count, rpc_count + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
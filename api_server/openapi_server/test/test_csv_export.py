@@ -0,0 +1,122 @@
+import copy
+import csv
+import json
+import tempfile
+import unittest
+
+from flask import g
+from openapi_server.controllers.expense_controllers import (
+    CSV_STREAM_CHUNK_SIZE, CreditorExpenses, get_expenses_format)
+from openapi_server.test import BaseTestCase
+from openapi_server.test.test_client_registry import create_fake_registry
+
+NUMBER_OF_CHANGES = 1000
+
+
+def write_csv_with_tempfile(expenses_data):
+    """Writing the CSV as it was done, to a temporary file in one go"""
+    with tempfile.NamedTemporaryFile("w+", newline="") as csv_file:
+        csv_writer = csv.DictWriter(
+            csv_file,
+            fieldnames=list(expenses_data[0].keys()),
+            delimiter=",",
+            quotechar='"',
+            quoting=csv.QUOTE_MINIMAL,
+        )
+        csv_writer.writeheader()
+
+        for expense in expenses_data:
+            if "status" in expense:
+                expense["status"] = expense["status"]["text"]
+
+            for field in expense:
+                if isinstance(expense[field], str):
+                    expense[field] = expense[field].replace("\n", " ")
+
+            csv_writer.writerow(expense)
+
+        csv_file.seek(0)
+        return csv_file.read()
+
+
+class TestCsvExport(BaseTestCase):
+    """ Test the streamed CSV export """
+
+    def setUp(self):
+        self.registry = create_fake_registry()
+        self.ds_client = self.registry.get_datastore()
+
+        for number in range(NUMBER_OF_CHANGES):
+            self.ds_client.add(
+                "Expenses_Journal",
+                {
+                    "Expenses_Id": number + 1,
+                    "Time": f"2020-01-{number % 28 + 1:02d}T12:00:00Z",
+                    "User": "pietje.puk@example.com",
+                    "Attributes_Changed": json.dumps(
+                        [
+                            {"note": {"old": "Lunch", "new": f"Lunch\nmet {number}"}},
+                            {
+                                "status": {
+                                    "old": {"text": "draft"},
+                                    "new": {"text": "ready_for_manager"},
+                                }
+                            },
+                        ]
+                    ),
+                },
+            )
+        self.ds_client.add(
+            "Expenses_Journal",
+            {
+                "Expenses_Id": 1,
+                "Time": "2020-01-01T12:00:00Z",
+                "Attributes_Changed": "[]",
+            },
+        )
+
+    def _stream_csv(self, expenses_data):
+        with self.app.test_request_context():
+            response = get_expenses_format(expenses_data, "text/csv")
+
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_streamed)
+            chunks = list(response.response)
+
+        return chunks
+
+    def test_journal_matches_tempfile(self):
+        with self.app.app_context():
+            g.token = {"unique_name": "pietje.puk@example.com"}
+            instance = CreditorExpenses(self.registry)
+            changes = list(
+                instance.get_all_expenses_journal("2020-01-01", "2020-01-31")
+            )
+
+        chunks = self._stream_csv(iter(copy.deepcopy(changes)))
+
+        self.assertEqual(len(changes), 2 * NUMBER_OF_CHANGES)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(
+            all(len(chunk) >= CSV_STREAM_CHUNK_SIZE for chunk in chunks[:-1])
+        )
+        self.assertEqual("".join(chunks), write_csv_with_tempfile(changes))
+
+    def test_status_and_newlines_match_tempfile(self):
+        expenses_data = [
+            {"id": 1, "note": "Lunch\nmet klant", "status": {"text": "approved"}},
+            {"id": 2, "note": 'Taxi "Centrum"', "status": {"text": "exported"}},
+        ]
+
+        chunks = self._stream_csv(copy.deepcopy(expenses_data))
+
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0], write_csv_with_tempfile(expenses_data))
+
+    def test_empty_export(self):
+        with self.app.test_request_context():
+            self.assertEqual(get_expenses_format(iter([]), "text/csv").status_code, 204)
+
+
+if __name__ == "__main__":
+    unittest.main()
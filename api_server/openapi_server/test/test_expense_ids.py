@@ -0,0 +1,94 @@
+import copy
+import unittest
+
+from flask import g
+from google.cloud import datastore
+from openapi_server.controllers.expense_controllers import ControllerExpenses
+from openapi_server.controllers.expense_ids import ExpenseIdPool
+from openapi_server.controllers.expense_summaries import SUMMARY_KIND
+from openapi_server.test import BaseTestCase
+from openapi_server.test.fake_datastore import FakeDatastoreClient
+from openapi_server.test.test_client_registry import create_fake_registry
+from openapi_server.test.test_expense_summaries import EXPENSE
+
+
+class TestExpenseIdPool(BaseTestCase):
+    """ Test reserving expense ids in blocks """
+
+    def test_one_allocation_per_block(self):
+        pool = ExpenseIdPool(block_size=3)
+        ds_client = FakeDatastoreClient()
+
+        keys = [
+            pool.complete_key(ds_client, ds_client.key("Expenses")) for _ in range(7)
+        ]
+
+        self.assertEqual(len(set(keys)), 7)
+        self.assertTrue(all(key.kind == "Expenses" for key in keys))
+        self.assertEqual(ds_client.rpc_count, 3)
+
+    def test_pool_per_client_and_kind(self):
+        pool = ExpenseIdPool(block_size=3)
+        ds_client = FakeDatastoreClient()
+        other_client = FakeDatastoreClient()
+
+        pool.complete_key(ds_client, ds_client.key("Expenses"))
+        journal_key = pool.complete_key(ds_client, ds_client.key("Expenses_Journal"))
+        pool.complete_key(other_client, other_client.key("Expenses"))
+
+        self.assertEqual(journal_key.kind, "Expenses_Journal")
+        self.assertEqual(ds_client.rpc_count, 2)
+        self.assertEqual(other_client.rpc_count, 1)
+
+
+class TestPutExpense(BaseTestCase):
+    """ Test storing an expense with its summary and journal entry """
+
+    def setUp(self):
+        self.registry = create_fake_registry()
+        self.ds_client = self.registry.get_datastore()
+
+    def _put_expense(self, expense, old_expense):
+        with self.app.app_context():
+            g.token = {"unique_name": "pietje.puk@example.com"}
+            rpc_count = self.ds_client.rpc_count
+            ControllerExpenses(self.registry)._put_expense(expense, old_expense)
+            return self.ds_client.rpc_count - rpc_count
+
+    def _new_expense(self):
+        expense = datastore.Entity(key=self.ds_client.key("Expenses"))
+        expense.update(copy.deepcopy(EXPENSE))
+        expense["status"]["text"] = "draft"
+        return expense
+
+    def test_add_is_a_single_put_multi(self):
+        # The first add reserves a block of ids
+        self.assertEqual(self._put_expense(self._new_expense(), {}), 2)
+
+        expense = self._new_expense()
+        self.assertEqual(self._put_expense(expense, {}), 1)
+
+        self.assertFalse(expense.key.is_partial)
+        self.assertIn(expense.key, self.ds_client.entities)
+        self.assertIn(
+            self.ds_client.key(SUMMARY_KIND, expense.key.id), self.ds_client.entities
+        )
+        journal = [
+            entry
+            for entry in self.ds_client.kinds["Expenses_Journal"]
+            if self.ds_client.entities[entry]["Expenses_Id"] == expense.key.id
+        ]
+        self.assertEqual(len(journal), 1)
+
+    def test_update_is_a_single_put_multi(self):
+        expense = self._new_expense()
+        self._put_expense(expense, {})
+        old_expense = copy.deepcopy(expense)
+        expense["note"] = "Diner"
+
+        self.assertEqual(self._put_expense(expense, old_expense), 1)
+        self.assertEqual(len(self.ds_client.kinds["Expenses_Journal"]), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+import copy
+import importlib.util
+import pathlib
+import unittest
+from unittest import mock
+
+import config
+from flask import g
+from openapi_server.controllers.cost_types_cache import cost_types_cache
+from openapi_server.controllers.expense_controllers import ControllerExpenses
+from openapi_server.controllers.expense_summaries import (
+    SUMMARY_AFAS_FIELDS,
+    SUMMARY_FIELDS,
+    SUMMARY_KIND,
+    backfill_expense_summaries,
+    build_expense_summary,
+)
+from openapi_server.test import BaseTestCase
+from openapi_server.test.test_client_registry import create_fake_registry
+
+AUTO_APPROVE_UTILS = (
+    pathlib.Path(__file__).resolve().parents[3]
+    / "functions"
+    / "auto_approve"
+    / "utils"
+    / "__init__.py"
+)
+
+EXPENSE = {
+    "amount": 10.0,
+    "note": "Lunch",
+    "cost_type": "400000",
+    "claim_date": "2020-01-01T12:00:00Z",
+    "transaction_date": "2020-01-01T12:00:00Z",
+    "manager_type": "linemanager",
+    "employee": {
+        "email": "pietje.puk@example.com",
+        "full_name": "Puk, Pietje",
+        "afas_data": {
+            "Personeelsnummer": 1002,
+            "Manager_personeelsnummer": 1001,
+            "Bedrijf": "VWT",
+            "Afdeling Code": "1234",
+            "Afdelingsomschrijving": "Finance",
+            "IBAN": "NL00BANK0123456789",
+        },
+    },
+    "status": {"text": "ready_for_manager", "export_date": "never"},
+    "attachments": [],
+}
+
+
+def load_auto_approve_utils():
+    spec = importlib.util.spec_from_file_location(
+        "auto_approve_utils", AUTO_APPROVE_UTILS
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestExpenseSummaries(BaseTestCase):
+    """ Test the Expenses_Summary entities the list endpoints read """
+
+    def setUp(self):
+        cost_types_cache.invalidate()
+        self.registry = create_fake_registry()
+        self.ds_client = self.registry.get_datastore()
+        self.ds_client.add("CostTypes", {"Active": True}, "400000")
+
+    def _add_expenses(self):
+        self.ds_client.add("Expenses", copy.deepcopy(EXPENSE), 1)
+
+        flagged = copy.deepcopy(EXPENSE)
+        flagged.update(flags={"duplicates": [1]}, auto_approved="Yes")
+        del flagged["employee"]["afas_data"]["Manager_personeelsnummer"]
+        self.ds_client.add("Expenses", flagged, 2)
+
+        return [
+            self.ds_client.entities[self.ds_client.key("Expenses", id_)]
+            for id_ in (1, 2)
+        ]
+
+    def test_summary_leaves_out_afas_data(self):
+        expense = self._add_expenses()[0]
+
+        summary = build_expense_summary(self.ds_client, expense)
+
+        self.assertEqual(summary.key, self.ds_client.key(SUMMARY_KIND, 1))
+        self.assertNotIn("attachments", summary)
+        self.assertEqual(
+            summary["employee"]["afas_data"],
+            {
+                field: EXPENSE["employee"]["afas_data"][field]
+                for field in SUMMARY_AFAS_FIELDS
+            },
+        )
+
+    @unittest.skipUnless(AUTO_APPROVE_UTILS.exists(), "auto_approve is not checked out")
+    def test_auto_approve_summary_matches(self):
+        utils = load_auto_approve_utils()
+        without_afas_data = copy.deepcopy(EXPENSE)
+        without_afas_data["employee"]["afas_data"] = None
+        expenses = self._add_expenses()
+        expenses.append(self.ds_client.add("Expenses", without_afas_data, 3))
+
+        self.assertEqual(utils.SUMMARY_KIND, SUMMARY_KIND)
+        self.assertEqual(utils.SUMMARY_FIELDS, SUMMARY_FIELDS)
+        self.assertEqual(utils.SUMMARY_AFAS_FIELDS, SUMMARY_AFAS_FIELDS)
+        for expense in expenses:
+            summary = utils.expense_summary(self.ds_client, expense)
+            expected = build_expense_summary(self.ds_client, expense)
+
+            self.assertEqual(summary.key, expected.key)
+            self.assertEqual(dict(summary), dict(expected))
+
+    def test_put_expense_writes_summary(self):
+        expense = self._add_expenses()[0]
+        old_expense = copy.deepcopy(expense)
+        expense["note"] = "Diner"
+
+        with self.app.app_context():
+            g.token = {"unique_name": "pietje.puk@example.com"}
+            ControllerExpenses(self.registry)._put_expense(expense, old_expense)
+
+        summary = self.ds_client.get(self.ds_client.key(SUMMARY_KIND, 1))
+        self.assertEqual(summary["note"], "Diner")
+
+    def test_list_from_summaries_matches_expenses(self):
+        self._add_expenses()
+        self.assertEqual(backfill_expense_summaries(self.ds_client, batch_size=1), 2)
+
+        lists = []
+        for from_summaries in (False, True):
+            with self.app.app_context(), mock.patch.object(
+                config, "EXPENSES_LIST_FROM_SUMMARIES", from_summaries, create=True
+            ):
+                g.token = {"unique_name": "pietje.puk@example.com"}
+                response = ControllerExpenses(self.registry).get_all_expenses()
+                lists.append(response.get_json())
+
+        self.assertEqual(len(lists[0]), 2)
+        self.assertEqual(lists[1], lists[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import datetime
+import threading
+import unittest
+from unittest import mock
+
+from google.oauth2.credentials import Credentials
+from openapi_server.controllers import gmail_service as gmail_module
+from openapi_server.controllers.gmail_service import GmailServiceFactory
+from openapi_server.test import BaseTestCase
+
+SCOPES = ["https://www.googleapis.com/auth/gmail.send"]
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.service.batches.append(len(self.requests))
+        for request_id, body in self.requests:
+            if body["raw"] == "fail":
+                self.callback(request_id, None, ValueError("Invalid message"))
+            else:
+                self.callback(request_id, {"id": f"id-{body['raw']}"}, None)
+
+
+class FakeGmailService:
+    def __init__(self):
+        self.batches = []
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    @staticmethod
+    def send(userId, body):
+        return body
+
+
+class TestGmailServiceFactory(BaseTestCase):
+    """ Test the cached Gmail services """
+
+    def setUp(self):
+        self.delegated = []
+
+        def get_delegated_credentials(credentials, subject, scopes):
+            credentials = Credentials(token=f"token-{len(self.delegated)}")
+            self.delegated.append(credentials)
+            return credentials
+
+        self.patches = [
+            mock.patch.object(
+                gmail_module.google.auth, "default", return_value=(None, "project")
+            ),
+            mock.patch.object(
+                gmail_module, "get_delegated_credentials", get_delegated_credentials
+            ),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def test_service_is_reused(self):
+        factory = GmailServiceFactory(expiry_margin=300)
+
+        service = factory.get("sender@example.com", SCOPES)
+        self.assertIs(factory.get("sender@example.com", SCOPES), service)
+        self.assertEqual(len(self.delegated), 1)
+        self.assertEqual(factory.stats(), {"hits": 1, "misses": 1})
+
+        other_thread = []
+        thread = threading.Thread(
+            target=lambda: other_thread.append(
+                factory.get("sender@example.com", SCOPES)
+            )
+        )
+        thread.start()
+        thread.join()
+        self.assertIsNot(other_thread[0], service)
+        self.assertEqual(len(self.delegated), 1)
+
+    def test_credentials_are_renewed_before_expiry(self):
+        factory = GmailServiceFactory(expiry_margin=300)
+
+        service = factory.get("sender@example.com", SCOPES)
+        self.delegated[0].expiry = datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=200
+        )
+
+        self.assertIsNot(factory.get("sender@example.com", SCOPES), service)
+        self.assertEqual(len(self.delegated), 2)
+
+    def test_send_batch(self):
+        service = FakeGmailService()
+        messages = [{"raw": str(number)} for number in range(250)]
+        messages[120] = {"raw": "fail"}
+
+        results = GmailServiceFactory.send_batch(service, messages)
+
+        self.assertEqual(service.batches, [100, 100, 50])
+        self.assertEqual(results[0], ("id-0", None))
+        self.assertEqual(results[249], ("id-249", None))
+        self.assertIsNone(results[120][0])
+        self.assertIsInstance(results[120][1], ValueError)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+
+from openapi_server.controllers.mail_template import (MAIL_PLACEHOLDERS,
+                                                      MailTemplate)
+from openapi_server.test import BaseTestCase
+
+TEMPLATE = (
+    "<!DOCTYPE html><html><head><title>$MAIL_TITLE</title>"
+    "<style>" + "td { padding: 0; } " * 200 + "</style></head><body>"
+    "<h1>$MAIL_TITLE</h1><p>$MAIL_SALUTATION</p><p>$MAIL_BODY</p>"
+    "<table>" + "<tr><td>&nbsp;</td></tr>" * 100 + "</table>"
+    "<p>$MAIL_FOOTER</p></body></html>"
+)
+MAIL_VALUES = {
+    "$MAIL_TITLE": "Nieuwe declaratie",
+    "$MAIL_SALUTATION": "Beste Pietje,",
+    "$MAIL_BODY": "Er staat een nieuwe declaratie klaar om beoordeeld te worden",
+    "$MAIL_FOOTER": "Met vriendelijke groeten,<br />FSSC",
+}
+
+
+def render_with_replace(template, values):
+    """Rendering as it was done with chained str.replace"""
+    for placeholder in MAIL_PLACEHOLDERS:
+        template = template.replace(placeholder, values[placeholder])
+    return template
+
+
+class TestMailTemplate(BaseTestCase):
+    """ Test the compiled mail template """
+
+    def test_render_matches_replace(self):
+        compiled = MailTemplate.compile(TEMPLATE)
+
+        self.assertEqual(
+            compiled.render(MAIL_VALUES), render_with_replace(TEMPLATE, MAIL_VALUES)
+        )
+
+    def test_partial_matches_render(self):
+        compiled = MailTemplate.compile(TEMPLATE)
+        footer = {"$MAIL_FOOTER": MAIL_VALUES["$MAIL_FOOTER"]}
+
+        partial = compiled.partial(footer)
+
+        self.assertIs(compiled.partial(dict(footer)), partial)
+        self.assertEqual(partial.render(MAIL_VALUES), compiled.render(MAIL_VALUES))
+
+    def test_values_are_not_substituted_again(self):
+        compiled = MailTemplate.compile(TEMPLATE)
+        values = dict(MAIL_VALUES, **{"$MAIL_TITLE": "Over $MAIL_BODY en $MAIL_FOOTER"})
+
+        rendered = compiled.partial({"$MAIL_FOOTER": "$MAIL_SALUTATION"}).render(values)
+
+        self.assertIn("<h1>Over $MAIL_BODY en $MAIL_FOOTER</h1>", rendered)
+        self.assertIn("<p>$MAIL_SALUTATION</p></body>", rendered)
+
+
+if __name__ == "__main__":
+    unittest.main()
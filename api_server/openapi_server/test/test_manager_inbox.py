@@ -0,0 +1,244 @@
+import contextlib
+import copy
+import unittest
+from unittest import mock
+
+import config
+from flask import g
+from google.api_core import exceptions as gcp_exceptions
+from openapi_server.controllers.afas_employee_cache import afas_employee_cache
+from openapi_server.controllers.cost_types_cache import cost_types_cache
+from openapi_server.controllers.expense_controllers import ManagerExpenses
+from openapi_server.controllers.manager_inbox import (
+    INBOX_KIND,
+    LEASE_COORDINATOR_INBOX_SHARDS,
+    inbox_key,
+    inbox_name,
+    rebuild_manager_inboxes,
+)
+from openapi_server.test import BaseTestCase
+from openapi_server.test.test_client_registry import create_fake_registry
+
+MANAGER = {
+    "upn": "manager@example.com",
+    "email_address": "manager@example.com",
+    "Personeelsnummer": 1001,
+}
+
+
+class ManagerInboxTestCase(BaseTestCase):
+
+    def setUp(self):
+        afas_employee_cache.invalidate()
+        cost_types_cache.invalidate()
+        self.registry = create_fake_registry()
+        self.ds_client = self.registry.get_datastore()
+        self.ds_client.add("AFAS_HRM", MANAGER, 1001)
+        self.ds_client.add("CostTypes", {"Active": True}, "400000")
+
+    def _add_expense(
+        self, day, personeelsnummer, manager_number, manager_type=None, status=None
+    ):
+        return self.ds_client.add(
+            "Expenses",
+            {
+                "amount": 10.0,
+                "note": f"Expense {day}",
+                "cost_type": "Cost type:400000",
+                "claim_date": f"2020-01-{day:02d}T12:00:00Z",
+                "transaction_date": "2020-01-01T12:00:00Z",
+                "employee": {
+                    "full_name": "Puk, Pietje",
+                    "afas_data": {
+                        "Personeelsnummer": personeelsnummer,
+                        "Manager_personeelsnummer": manager_number,
+                    },
+                },
+                "status": {"text": status or "ready_for_manager"},
+                "manager_type": manager_type,
+            },
+        )
+
+    def _create_manager_instance(self, scopes=()):
+        g.token = {"unique_name": "manager@example.com", "scopes": list(scopes)}
+        return ManagerExpenses(self.registry)
+
+    def _get_inbox(self, scopes=()):
+        with self.app.app_context():
+            response = self._create_manager_instance(scopes).get_all_expenses()
+
+            if response.status_code == 204:
+                return []
+            return [expense["note"] for expense in response.get_json()]
+
+
+class TestManagerInbox(ManagerInboxTestCase):
+    """ Test the expenses that are ready for a manager """
+
+    def test_configured_employees_are_merged(self):
+        self._add_expense(1, 2001, 3000)
+        self._add_expense(2, 1002, 1001)
+        self._add_expense(3, 2002, 3000)
+        self._add_expense(4, 2003, 3000)
+
+        emend = {"managers": {"1001": {"employees": ["2001", "2002"]}}}
+        with mock.patch.object(config, "AFAS_DATA_EMEND", emend, create=True):
+            self.assertEqual(self._get_inbox(), ["Expense 3", "Expense 2", "Expense 1"])
+
+    def test_lease_coordinator_expenses(self):
+        self._add_expense(1, 1002, 1001)
+        self._add_expense(2, 1002, 1001, "leasecoordinator")
+        self._add_expense(3, 2001, 3000, "leasecoordinator")
+
+        with mock.patch.object(config, "AFAS_DATA_EMEND", {}, create=True):
+            self.assertEqual(self._get_inbox(), ["Expense 1"])
+            self.assertEqual(
+                self._get_inbox(["leasecoordinator.write"]),
+                ["Expense 3", "Expense 2", "Expense 1"],
+            )
+
+    def test_empty_inbox(self):
+        with mock.patch.object(config, "AFAS_DATA_EMEND", {}, create=True):
+            self.assertEqual(self._get_inbox(), [])
+
+
+class TestManagerInboxProjection(ManagerInboxTestCase):
+    """ Test the ManagerInbox entities kept for every manager """
+
+    def _set_status(self, expense, status):
+        old_expense = copy.deepcopy(expense)
+        expense["status"]["text"] = status
+
+        with self.app.app_context():
+            self._create_manager_instance()._put_expense(expense, old_expense)
+
+    def _get_projected_inbox(self, scopes=(), limit=None):
+        with self.app.app_context():
+            instance = self._create_manager_instance(scopes)
+            rpc_count = self.ds_client.rpc_count
+
+            with mock.patch.multiple(
+                config, AFAS_DATA_EMEND={}, MANAGER_INBOX_ENABLED=True, create=True
+            ):
+                response = instance.get_inbox(limit=limit).get_json()
+
+            self.rpc_count = self.ds_client.rpc_count - rpc_count
+            return response["count"], [
+                expense["note"] for expense in response["expenses"]
+            ]
+
+    def test_status_transitions_update_the_inbox(self):
+        first = self._add_expense(1, 1002, 1001, status="draft")
+        second = self._add_expense(2, 1002, 1001, status="draft")
+
+        self._set_status(first, "ready_for_manager")
+        self._set_status(second, "ready_for_manager")
+        self.assertEqual(self._get_projected_inbox(), (2, ["Expense 2", "Expense 1"]))
+        # A single lookup of the inboxes and the query that fills the cost types cache
+        self.assertEqual(self.rpc_count, 2)
+
+        self._set_status(second, "ready_for_creditor")
+        self.assertEqual(self._get_projected_inbox(), (1, ["Expense 1"]))
+
+        self._set_status(first, "rejected_by_manager")
+        self.assertEqual(self._get_projected_inbox(), (0, []))
+
+    def test_lease_coordinator_inbox(self):
+        lease = [
+            self._add_expense(day, 2001, 3000, "leasecoordinator", "draft")
+            for day in (1, 3)
+        ]
+        own = self._add_expense(2, 1002, 1001, status="draft")
+
+        for expense in [*lease, own]:
+            self._set_status(expense, "ready_for_manager")
+
+        self.assertEqual(self._get_projected_inbox(), (1, ["Expense 2"]))
+        self.assertEqual(
+            self._get_projected_inbox(["leasecoordinator.write"], limit=2),
+            (3, ["Expense 3", "Expense 2"]),
+        )
+        # The shards are read with the manager's inbox in a single lookup
+        self.assertEqual(self.rpc_count, 1)
+
+    def test_lease_coordinator_inbox_is_sharded(self):
+        names = {
+            inbox_name(self._add_expense(1, 2001, 3000, "leasecoordinator"))
+            for _ in range(LEASE_COORDINATOR_INBOX_SHARDS)
+        }
+
+        self.assertEqual(len(names), LEASE_COORDINATOR_INBOX_SHARDS)
+
+    def test_rebuild_matches_the_query(self):
+        for day in range(1, 5):
+            self._add_expense(day, 1002, 1001)
+        self._add_expense(5, 1002, 1001, status="approved")
+        self._add_expense(6, 2001, 3000)
+        self.ds_client.add(
+            INBOX_KIND, {"count": 1, "expense_ids": [1], "expenses": []}, "4000"
+        )
+
+        self.assertEqual(rebuild_manager_inboxes(self.ds_client), 3)
+        self.assertEqual(
+            self.ds_client.get(inbox_key(self.ds_client, "4000"))["count"], 0
+        )
+        self.assertEqual(
+            self._get_projected_inbox(),
+            (4, ["Expense 4", "Expense 3", "Expense 2", "Expense 1"]),
+        )
+
+    def test_incomplete_inbox_is_queried(self):
+        self._add_expense(1, 1002, 1001)
+        self.ds_client.add(
+            INBOX_KIND, {"count": 2, "expense_ids": [1, 2], "expenses": []}, "1001"
+        )
+
+        self.assertEqual(self._get_projected_inbox(), (2, ["Expense 1"]))
+
+
+class TestUpdateConflicts(ManagerInboxTestCase):
+    """ Test retrying updates that conflict on a shared inbox """
+
+    def _update_with_conflicts(self, conflicts):
+        expense = self._add_expense(1, 2001, 3000, "leasecoordinator")
+        updates = []
+
+        @contextlib.contextmanager
+        def transaction():
+            yield
+            if len(updates) <= conflicts:
+                raise gcp_exceptions.Conflict("too much contention")
+
+        def apply_expense_update(expense, old_expense, data):
+            updates.append(copy.deepcopy(data))
+            data["manager_type"] = "leasecoordinator"
+
+        with self.app.app_context():
+            instance = self._create_manager_instance()
+            with mock.patch.object(
+                self.ds_client, "transaction", transaction
+            ), mock.patch.object(
+                instance, "_apply_expense_update", apply_expense_update
+            ):
+                response = instance.update_expenses(
+                    expense.key.id, {"status": "approved"}
+                )
+
+        return response, updates
+
+    def test_conflicting_update_is_retried(self):
+        response, updates = self._update_with_conflicts(2)
+
+        self.assertEqual(response.status_code, 200)
+        # Every attempt starts from the update as it was requested
+        self.assertEqual(updates, 3 * [{"status": "approved"}])
+
+    def test_update_fails_after_the_last_attempt(self):
+        response, updates = self._update_with_conflicts(3)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(len(updates), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
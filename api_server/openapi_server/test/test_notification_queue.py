@@ -0,0 +1,118 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from openapi_server.controllers import expense_controllers
+from openapi_server.controllers.expense_controllers import EmployeeExpenses
+from openapi_server.controllers.notification_queue import NotificationQueue
+from openapi_server.test import BaseTestCase
+from openapi_server.test.fake_datastore import FakeDatastoreClient
+
+
+class FlakyNotification:
+    def __init__(self, failures, duration=0.0):
+        self.failures = failures
+        self.duration = duration
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.duration)
+        if self.calls <= self.failures:
+            raise ConnectionError("FCM unavailable")
+
+
+class TestNotificationQueue(BaseTestCase):
+    """ Test the background notification queue """
+
+    def test_enqueue_does_not_wait_for_delivery(self):
+        queue = NotificationQueue(max_workers=2, retry_delay=0)
+        release = threading.Event()
+
+        start = time.perf_counter()
+        future = queue.enqueue("slow", release.wait)
+        enqueue_time = time.perf_counter() - start
+
+        self.assertLess(enqueue_time, 0.1)
+        self.assertFalse(future.done())
+
+        release.set()
+        self.assertTrue(queue.flush(timeout=5))
+        self.assertTrue(future.result())
+        self.assertEqual(queue.stats()["delivered"], 1)
+        queue.shutdown()
+
+    def test_failed_delivery_is_retried(self):
+        queue = NotificationQueue(max_workers=2, attempts=3, retry_delay=0)
+        recovers = FlakyNotification(failures=2)
+        keeps_failing = FlakyNotification(failures=5)
+
+        self.assertTrue(queue.enqueue("recovers", recovers).result(timeout=5))
+        self.assertFalse(queue.enqueue("fails", keeps_failing).result(timeout=5))
+
+        self.assertEqual(recovers.calls, 3)
+        self.assertEqual(keeps_failing.calls, 3)
+        stats = queue.stats()
+        self.assertEqual(
+            {key: stats[key] for key in ["queued", "delivered", "retried", "failed"]},
+            {"queued": 2, "delivered": 1, "retried": 4, "failed": 1},
+        )
+        queue.shutdown()
+
+    def test_inline_delivery_without_workers(self):
+        queue = NotificationQueue(max_workers=0, retry_delay=0)
+        notification = FlakyNotification(failures=1)
+
+        future = queue.enqueue("inline", notification)
+
+        self.assertTrue(future.done())
+        self.assertEqual(notification.calls, 2)
+
+    def test_shutdown_logs_undelivered_notifications(self):
+        queue = NotificationQueue(max_workers=1, retry_delay=0, shutdown_timeout=0.1)
+        release = threading.Event()
+
+        delivered = queue.enqueue("delivered", release.wait)
+        undelivered = queue.enqueue("undelivered", FlakyNotification(failures=0))
+        with self.assertLogs(level="ERROR") as logs:
+            queue.shutdown()
+
+        self.assertIn("2 notifications", logs.output[0])
+        self.assertIn("undelivered", logs.output[0])
+
+        release.set()
+        self.assertTrue(delivered.result(timeout=5))
+        self.assertTrue(undelivered.result(timeout=5))
+
+
+class TestSendNotification(BaseTestCase):
+    """ Test the steps of sending a notification """
+
+    def test_failed_mail_does_not_resend_push(self):
+        instance = EmployeeExpenses.__new__(EmployeeExpenses)
+        instance.ds_client = FakeDatastoreClient()
+        recipient = {
+            "upn": "pietje.puk@example.com",
+            "email_address": "pietje.puk@example.com",
+        }
+
+        with mock.patch.object(
+            expense_controllers,
+            "notification_queue",
+            NotificationQueue(max_workers=0, retry_delay=0),
+        ), mock.patch.multiple(
+            instance,
+            send_push_notification=mock.Mock(return_value=False),
+            send_mail_notification=mock.Mock(
+                side_effect=[ConnectionError("Gmail unavailable"), None]
+            ),
+        ):
+            instance.send_notification("rejected_expense", recipient, 1)
+
+            self.assertEqual(instance.send_push_notification.call_count, 1)
+            self.assertEqual(instance.send_mail_notification.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+
+from flask import g
+from openapi_server.controllers.cost_types_cache import cost_types_cache
+from openapi_server.controllers.expense_controllers import (ControllerExpenses,
+                                                            CreditorExpenses)
+from openapi_server.test import BaseTestCase
+from openapi_server.test.test_client_registry import create_fake_registry
+
+NUMBER_OF_EXPENSES = 5
+
+
+class TestPagination(BaseTestCase):
+    """ Test paging through the expenses with a limit and cursor """
+
+    def setUp(self):
+        cost_types_cache.invalidate()
+        self.registry = create_fake_registry()
+        ds_client = self.registry.get_datastore()
+        ds_client.add("CostTypes", {"Active": True}, "400000")
+
+        for number in range(NUMBER_OF_EXPENSES):
+            ds_client.add(
+                "Expenses",
+                {
+                    "amount": 10.0,
+                    "note": f"Expense {number}",
+                    "cost_type": "400000",
+                    "claim_date": f"2020-01-{number + 1:02d}T12:00:00Z",
+                    "transaction_date": "2020-01-01T12:00:00Z",
+                    "employee": {
+                        "full_name": "Puk, Pietje",
+                        "afas_data": {
+                            "Bedrijf": "VWT",
+                            "Afdeling Code": "1234",
+                            "Afdelingsomschrijving": "Finance",
+                            "Manager_personeelsnummer": 1001,
+                        },
+                    },
+                    "status": {"text": "approved", "export_date": "never"},
+                },
+                number + 1,
+            )
+
+    def _create_instance(self, expense_class):
+        g.token = {"unique_name": "pietje.puk@example.com"}
+        return expense_class(self.registry)
+
+    def _get_controller_page(self, limit, cursor=None):
+        with self.app.app_context():
+            response = self._create_instance(ControllerExpenses).get_all_expenses(
+                limit=limit, cursor=cursor
+            )
+
+            self.assertEqual(response.status_code, 200)
+            return response.get_json()
+
+    def test_cursor_round_trip(self):
+        pages = [self._get_controller_page(2)]
+        while pages[-1]["next_cursor"]:
+            pages.append(self._get_controller_page(2, pages[-1]["next_cursor"]))
+
+        self.assertEqual([len(page["expenses"]) for page in pages], [2, 2, 1])
+        self.assertEqual(
+            sorted(expense["id"] for page in pages for expense in page["expenses"]),
+            list(range(1, NUMBER_OF_EXPENSES + 1)),
+        )
+
+    def test_empty_page_has_envelope(self):
+        self.assertEqual(
+            self._get_controller_page(2, str(NUMBER_OF_EXPENSES)),
+            {"expenses": [], "next_cursor": None},
+        )
+
+    def test_creditor_pages(self):
+        with self.app.app_context():
+            instance = self._create_instance(CreditorExpenses)
+
+            rows, cursor = instance.get_all_expenses(
+                "expenses_all", "1970-01-01", "1970-01-01", limit=3
+            )
+            last_rows, last_cursor = instance.get_all_expenses(
+                "expenses_all", "1970-01-01", "1970-01-01", limit=3, cursor=cursor
+            )
+            empty_rows, _ = instance.get_all_expenses(
+                "expenses_all", "1970-01-01", "1970-01-01", limit=3, cursor="5"
+            )
+
+        self.assertEqual((len(rows), len(last_rows)), (3, 2))
+        self.assertIsNone(last_cursor)
+        self.assertEqual(empty_rows, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,193 @@
+import contextlib
+import datetime
+import unittest
+import xml.etree.ElementTree as ET  # nosec
+from decimal import Decimal
+from unittest import mock
+
+import config
+
+from openapi_server.controllers.expense_controllers import CreditorExpenses
+from openapi_server.test import BaseTestCase
+from openapi_server.test.fake_datastore import FakeDatastoreClient
+from openapi_server.test.fake_storage import FakeStorageClient
+
+
+def create_payment_file_tree(instance, expense_claims_to_export, document_time):
+    """
+    Payment file as it was built with xml.etree before the streaming writer
+    """
+    booking_timestamp_id = document_time.strftime("%Y%m%d%H%M%S")
+    message_id = f"200/DEC/{booking_timestamp_id}"
+    payment_info_id = f"200/DEC/{booking_timestamp_id}"
+
+    ET.register_namespace("", "urn:iso:std:iso:20022:tech:xsd:pain.001.001.03")
+    root = ET.Element("{urn:iso:std:iso:20022:tech:xsd:pain.001.001.03}Document")
+    root.set("xmlns:xsi", "http://www.w3.org/2001/XMLSchema-instance")
+    customer_header = ET.SubElement(root, "CstmrCdtTrfInitn")
+
+    ctrl_sum = Decimal(0)
+    for expense in expense_claims_to_export:
+        ctrl_sum += Decimal(str(expense["amount"]))
+
+    header = ET.SubElement(customer_header, "GrpHdr")
+    ET.SubElement(header, "MsgId").text = message_id
+    ET.SubElement(header, "CreDtTm").text = document_time.isoformat(timespec="seconds")
+    ET.SubElement(header, "NbOfTxs").text = str(len(expense_claims_to_export))
+    ET.SubElement(header, "CtrlSum").text = str(ctrl_sum)
+    initiating_party = ET.SubElement(header, "InitgPty")
+    ET.SubElement(initiating_party, "Nm").text = config.OWN_ACCOUNT["bedrijf"]
+
+    payment_info = ET.SubElement(customer_header, "PmtInf")
+    ET.SubElement(payment_info, "PmtInfId").text = message_id
+    ET.SubElement(payment_info, "PmtMtd").text = "TRF"
+    ET.SubElement(payment_info, "NbOfTxs").text = str(len(expense_claims_to_export))
+    ET.SubElement(payment_info, "CtrlSum").text = str(ctrl_sum)
+    payment_typ_info = ET.SubElement(payment_info, "PmtTpInf")
+    ET.SubElement(payment_typ_info, "InstrPrty").text = "NORM"
+    payment_tp_service_level = ET.SubElement(payment_typ_info, "SvcLvl")
+    ET.SubElement(payment_tp_service_level, "Cd").text = "SEPA"
+    ET.SubElement(payment_info, "ReqdExctnDt").text = document_time.date().isoformat()
+    payment_debitor_info = ET.SubElement(payment_info, "Dbtr")
+    ET.SubElement(payment_debitor_info, "Nm").text = "VWT BV"
+    payment_debitor_account = ET.SubElement(payment_info, "DbtrAcct")
+    payment_debitor_account_id = ET.SubElement(payment_debitor_account, "Id")
+    ET.SubElement(payment_debitor_account_id, "IBAN").text = config.OWN_ACCOUNT["iban"]
+    payment_debitor_agent = ET.SubElement(payment_info, "DbtrAgt")
+    payment_debitor_agent_id = ET.SubElement(payment_debitor_agent, "FinInstnId")
+    ET.SubElement(payment_debitor_agent_id, "BIC").text = config.OWN_ACCOUNT["bic"]
+
+    for expense in expense_claims_to_export:
+        transfer = ET.SubElement(payment_info, "CdtTrfTxInf")
+        transfer_payment_id = ET.SubElement(transfer, "PmtId")
+        ET.SubElement(transfer_payment_id, "InstrId").text = payment_info_id
+        ET.SubElement(transfer_payment_id, "EndToEndId").text = expense[
+            "boekingsomschrijving_bron"
+        ]
+        amount = ET.SubElement(transfer, "Amt")
+        ET.SubElement(amount, "InstdAmt", Ccy="EUR").text = str(expense["amount"])
+        ET.SubElement(transfer, "ChrgBr").text = "SLEV"
+
+        iban = expense["employee"]["afas_data"].get("IBAN")
+        if not iban:
+            iban = ""
+
+        amount_agent = ET.SubElement(transfer, "CdtrAgt")
+        payment_creditor_agent_id = ET.SubElement(amount_agent, "FinInstnId")
+        ET.SubElement(
+            payment_creditor_agent_id, "BIC"
+        ).text = instance.get_iban_details(iban)
+        creditor_name = ET.SubElement(transfer, "Cdtr")
+        ET.SubElement(creditor_name, "Nm").text = instance._gather_creditor_name(
+            expense
+        )
+        creditor_account = ET.SubElement(transfer, "CdtrAcct")
+        creditor_account_id = ET.SubElement(creditor_account, "Id")
+        ET.SubElement(creditor_account_id, "IBAN").text = iban.replace(" ", "")
+        remittance_info = ET.SubElement(transfer, "RmtInf")
+        ET.SubElement(remittance_info, "Ustrd").text = expense[
+            "boekingsomschrijving_bron"
+        ]
+
+    return ET.tostring(root, encoding="utf8", method="xml")
+
+
+def create_payment_expenses(number_of_expenses):
+    names = ["Puk, Pietje", "Jansen & Zonen", 'Kees "de Kapper"', "Zoë <Smit>"]
+    ibans = ["NL00 BANK 0123 4567 89", "NL00OTHR0123456789", None, "DE00"]
+    amounts = [12.5, 7, 100.0, 0.99, 1234.56]
+
+    return [
+        {
+            "amount": amounts[number % len(amounts)],
+            "boekingsomschrijving_bron": f"{10000 + number} 01-03-2020",
+            "employee": {
+                "afas_data": {
+                    "Naam": names[number % len(names)],
+                    "IBAN": ibans[number % len(ibans)],
+                }
+            },
+        }
+        for number in range(number_of_expenses)
+    ]
+
+
+@contextlib.contextmanager
+def power2pay_enabled(sent, keep_files=True):
+    """
+    Enables sending to Power2Pay, every payment file that is sent is appended
+    to sent, or only its size when keep_files is False
+    """
+
+    def send_to_power2pay(instance, payment_xml):
+        if keep_files:
+            sent.append(payment_xml.read())
+        else:
+            blocks = iter(lambda: payment_xml.read(64 * 1024), b"")
+            sent.append(sum(len(block) for block in blocks))
+        return True
+
+    with mock.patch.multiple(
+        config,
+        POWER2PAY_URL="https://power2pay.example.com",
+        POWER2PAY_AUTH_USER="user",
+        POWER2PAY_AUTH_PASSWORD="password",
+        create=True,
+    ), mock.patch.object(
+        CreditorExpenses,
+        "send_to_power2pay",
+        autospec=True,
+        side_effect=send_to_power2pay,
+    ):
+        yield
+
+
+def create_payment_instance(cs_client):
+    instance = CreditorExpenses.__new__(CreditorExpenses)
+    instance.ds_client = FakeDatastoreClient()
+    instance.cs_client = cs_client
+    instance.bucket_name = "payment"
+    return instance
+
+
+class TestPaymentFile(BaseTestCase):
+    """ Test the payment file against the xml.etree implementation """
+
+    def test_payment_file_is_byte_identical(self):
+        expenses = create_payment_expenses(40)
+        document_time = datetime.datetime(2020, 3, 9, 14, 30, 5)
+        instance = create_payment_instance(FakeStorageClient())
+
+        expected = create_payment_file_tree(instance, expenses, document_time)
+        sent = []
+        with power2pay_enabled(sent):
+            result = instance.create_payment_file(
+                expenses, "20200309143005", document_time
+            )
+
+        self.assertTrue(result[0])
+        self.assertEqual(
+            instance.cs_client.get_bucket("payment").blobs[
+                "exports/payment_file/2020/3/9/20200309143005"
+            ],
+            expected,
+        )
+        self.assertEqual(sent, [expected])
+
+    def test_failed_send_fails_the_payment_file(self):
+        instance = create_payment_instance(FakeStorageClient())
+
+        with power2pay_enabled([]), mock.patch.object(
+            CreditorExpenses, "send_to_power2pay", return_value=False
+        ), self.app.app_context():
+            result = instance.create_payment_file(
+                create_payment_expenses(2),
+                "20200309143005",
+                datetime.datetime(2020, 3, 9, 14, 30, 5),
+            )
+
+        self.assertFalse(result[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
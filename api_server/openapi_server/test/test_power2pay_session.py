@@ -0,0 +1,139 @@
+import os
+import time
+import unittest
+from unittest import mock
+
+import config
+from OpenSSL import crypto
+
+from openapi_server.controllers import power2pay_session as power2pay_module
+from openapi_server.controllers.power2pay_session import Power2PaySession
+from openapi_server.test import BaseTestCase
+
+PASSPHRASE = "benchmark-passphrase"
+
+
+def create_client_certificate():
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+
+    certificate = crypto.X509()
+    certificate.get_subject().CN = "power2pay.example.com"
+    certificate.set_serial_number(1)
+    certificate.gmtime_adj_notBefore(0)
+    certificate.gmtime_adj_notAfter(3600)
+    certificate.set_issuer(certificate.get_subject())
+    certificate.set_pubkey(key)
+    certificate.sign(key, "sha256")
+
+    return (
+        crypto.dump_certificate(crypto.FILETYPE_PEM, certificate).decode(),
+        crypto.dump_privatekey(
+            crypto.FILETYPE_PEM, key, "aes256", PASSPHRASE.encode()
+        ).decode(),
+    )
+
+
+class FakeSecretManagerClient:
+    def __init__(self, secrets):
+        self.secrets = secrets
+        self.calls = 0
+
+    @staticmethod
+    def secret_version_path(project_id, secret_id, version):
+        return secret_id
+
+    def access_secret_version(self, request):
+        self.calls += 1
+        payload = mock.Mock()
+        payload.payload.data = self.secrets[request["name"]].encode("UTF-8")
+        return payload
+
+
+class TestPower2PaySession(BaseTestCase):
+    """ Test the cached Power2Pay credentials """
+
+    def setUp(self):
+        certificate, key = create_client_certificate()
+        self.secret_client = FakeSecretManagerClient(
+            {
+                "certificate": certificate,
+                "key": key,
+                "passphrase": PASSPHRASE,
+                "auth-password": "secret",
+            }
+        )
+
+        self.patches = [
+            mock.patch.dict(os.environ, {"GOOGLE_CLOUD_PROJECT": "project"}),
+            mock.patch.multiple(
+                config,
+                create=True,
+                CERTIFICATE="certificate",
+                KEY="key",
+                PASSPHRASE="passphrase",
+                POWER2PAY_AUTH_USER="user",
+                POWER2PAY_AUTH_PASSWORD="auth-password",
+            ),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def create_session(self, ttl=3600):
+        session = Power2PaySession(ttl=ttl)
+        session._secret_client = self.secret_client
+        return session
+
+    def test_session_is_reused(self):
+        power2pay_session = self.create_session()
+
+        start = time.perf_counter()
+        session = power2pay_session.get()
+        setup_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(10):
+            self.assertIs(power2pay_session.get(), session)
+        reuse_time = (time.perf_counter() - start) / 10
+
+        self.assertEqual(self.secret_client.calls, 4)
+        self.assertEqual(session.auth, ("user", "secret"))
+        self.assertEqual(power2pay_session.stats(), {"hits": 10, "misses": 1})
+        self.assertLess(reuse_time, setup_time)
+
+    def test_session_expires_and_invalidates(self):
+        power2pay_session = self.create_session(ttl=0)
+        first = power2pay_session.get()
+        second = power2pay_session.get()
+        self.assertIsNot(first, second)
+
+        power2pay_session.ttl = 3600
+        with self.assertLogs(level="INFO") as logs:
+            power2pay_session.invalidate()
+        self.assertIn("{'hits': 0, 'misses': 2}", logs.output[0])
+        self.assertIsNot(power2pay_session.get(), second)
+        self.assertEqual(self.secret_client.calls, 12)
+        self.assertEqual(power2pay_session.stats(), {"hits": 0, "misses": 3})
+
+    def test_secret_files_are_removed(self):
+        created = []
+        mkstemp = power2pay_module.tempfile.mkstemp
+
+        def tracking_mkstemp(*args, **kwargs):
+            file_descriptor, file_name = mkstemp(*args, **kwargs)
+            created.append(file_name)
+            return file_descriptor, file_name
+
+        with mock.patch.object(power2pay_module.tempfile, "mkstemp", tracking_mkstemp):
+            self.create_session().get()
+
+        self.assertEqual(len(created), 2)
+        self.assertFalse([name for name in created if os.path.exists(name)])
+
+
+if __name__ == "__main__":
+    unittest.main()
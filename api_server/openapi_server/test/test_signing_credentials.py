@@ -0,0 +1,43 @@
+import datetime
+import unittest
+
+from openapi_server.controllers.signing_credentials import SigningCredentials
+from openapi_server.test import BaseTestCase
+from openapi_server.test.fake_storage import (FakeSigningCredentials,
+                                              FakeTokenCredentials)
+
+
+class TestSigningCredentials(BaseTestCase):
+    """ Test the credentials used to sign Cloud Storage urls """
+
+    def test_private_key_signs_locally(self):
+        factory_calls = []
+        signing_credentials = SigningCredentials(
+            lambda: factory_calls.append(1) or FakeSigningCredentials()
+        )
+
+        self.assertEqual(signing_credentials.get_signing_arguments(), {})
+        self.assertEqual(signing_credentials.get_signing_arguments(), {})
+        self.assertEqual(len(factory_calls), 1)
+
+    def test_token_is_refreshed_when_expired(self):
+        credentials = FakeTokenCredentials()
+        signing_credentials = SigningCredentials(lambda: credentials)
+
+        self.assertEqual(
+            signing_credentials.get_signing_arguments(),
+            {
+                "service_account_email": "api@example.iam.gserviceaccount.com",
+                "access_token": "token-1",
+            },
+        )
+        signing_credentials.get_signing_arguments()
+        self.assertEqual(credentials.refreshes, 1)
+
+        credentials.expiry = datetime.datetime.utcnow()
+        arguments = signing_credentials.get_signing_arguments()
+        self.assertEqual(arguments["access_token"], "token-2")
+
+
+if __name__ == "__main__":
+    unittest.main()
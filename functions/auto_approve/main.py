@@ -2,13 +2,128 @@ import re
 import logging
 import json
 import datetime
+from collections import defaultdict
 from decimal import Decimal, DecimalException
 
+from google.api_core import exceptions
 from google.cloud import datastore
-from utils import shift_to_business_days
+from utils import (INBOX_KIND, expense_summary, inbox_name, remove_from_inbox,
+                   shift_to_business_days)
 
 logging.basicConfig(level=logging.INFO)
 
+# Datastore commits at most 500 entities: 3 per expense and the inbox
+EXPENSES_PER_COMMIT = 166
+COMMIT_ATTEMPTS = 3
+
+
+def commit_approved(client, name, chunk):
+    """
+    Stores a chunk of approved expenses and removes them from their inbox in
+    one transaction. The commit conflicts when the inbox was changed after it
+    was read, e.g. by an employee submitting an expense, so it is retried.
+
+    :type client: datastore.Client
+    :type name: str or None
+    :type chunk: list
+    """
+    expense_ids = {expense.key.id for expense, _, _ in chunk}
+
+    for attempt in range(1, COMMIT_ATTEMPTS + 1):
+        entities = [entity for update in chunk for entity in update]
+
+        try:
+            with client.transaction():
+                inbox = None
+                if name:
+                    inbox = client.get(client.key(INBOX_KIND, name))
+                if inbox:
+                    remove_from_inbox(inbox, expense_ids)
+                    entities.append(inbox)
+
+                client.put_multi(entities)
+        except exceptions.Conflict:
+            if attempt == COMMIT_ATTEMPTS:
+                raise
+            logging.warning(
+                f'Approving expenses of inbox {name} conflicted, retrying')
+        else:
+            return
+
+
+def is_auto_approvable(expense, cost_type_list):
+    """
+    Returns whether the amount of an expense reaches the minimum amount of its
+    auto approved cost type
+
+    :type expense: datastore.Entity
+    :type cost_type_list: dict
+    :rtype: bool
+    """
+    # Only approve those expenses with concurrent cost-types
+    cost_type_split = re.search(r"([0-9]{6})", expense['cost_type'])
+
+    if not cost_type_split:
+        logging.warning(
+            f"No correct cost_type found for expense {expense.key.id}")
+        return False
+    else:
+        cost_type_id = int(cost_type_split.group(0))
+
+    if cost_type_id not in cost_type_list:
+        return False
+
+    try:
+        amount_expense = round(Decimal(expense['amount']), 2)
+        amount_cost_type = Decimal(cost_type_list[cost_type_id])
+    except (ValueError, DecimalException):
+        logging.debug(f"Incorrect amounts for expense {expense.key.id}")
+        return False
+
+    return amount_expense >= amount_cost_type
+
+
+def approve_expense(client, expense):
+    """
+    Sets an expense to ready_for_creditor and journals the change
+
+    :type client: datastore.Client
+    :type expense: datastore.Entity
+    :return: the expense, its summary and its journal entry
+    """
+    logging.info(f'Auto approving expense {expense.key.id}')
+
+    old_auto_value = expense['auto_approved'] if \
+        'auto_approved' in expense else 'null'
+    new_auto_value = 'Yes'
+
+    expense['auto_approved'] = new_auto_value
+
+    # Update Expenses_Journal: auto_approved and status
+    changed = []
+    changed.append({'auto_approved': {"old": old_auto_value,
+                                      "new": new_auto_value}})
+    changed.append({'status': {
+        "old": {'text': expense['status']['text']},
+        "new": {'text': 'ready_for_creditor'}}
+    })
+
+    expense['status']['text'] = 'ready_for_creditor'
+
+    key = client.key("Expenses_Journal")
+    expense_journal = datastore.Entity(key=key)
+    expense_journal.update(
+        {
+            "Expenses_Id": expense.key.id,
+            "Time": datetime.datetime.utcnow().isoformat(
+                timespec="seconds") + 'Z',
+            "Attributes_Changed": json.dumps(changed),
+            "User": "auto_approved"
+        }
+    )
+
+    return [expense, expense_summary(client, expense), expense_journal]
+
 
 def process_approve(request):
     if request.args and 'pending' in request.args:
@@ -32,66 +147,18 @@ def process_approve(request):
         query.add_filter('claim_date', '<=', boundary)
         query.add_filter('status.text', '=', 'ready_for_manager')
 
-        expenses_to_update = []
+        expenses_to_update = defaultdict(list)
 
         for expense in query.fetch():
-            changed = []
-
-            # Only approve those expenses with concurrent cost-types
-            cost_type_split = re.search(r"([0-9]{6})", expense['cost_type'])
-
-            if not cost_type_split:
-                logging.warning(
-                    f"No correct cost_type found for expense {expense.key.id}")
-                continue
-            else:
-                cost_type_id = int(cost_type_split.group(0))
-
-            if cost_type_id not in cost_type_list:
-                continue
-
-            try:
-                amount_expense = round(Decimal(expense['amount']), 2)
-                amount_cost_type = Decimal(cost_type_list[cost_type_id])
-            except (ValueError, DecimalException):
-                pass
-                logging.debug(f"Incorrect amounts for expense {expense.key.id}")
-                continue
-            else:
-                if amount_expense >= amount_cost_type:
-                    logging.info(f'Auto approving expense {expense.key.id}')
-
-                    old_auto_value = expense['auto_approved'] if \
-                        'auto_approved' in expense else 'null'
-                    new_auto_value = 'Yes'
-
-                    expense['auto_approved'] = new_auto_value
-
-                    # Update Expenses_Journal: auto_approved and status
-                    changed.append({'auto_approved': {"old": old_auto_value,
-                                                      "new": new_auto_value}})
-                    changed.append({'status': {
-                        "old": {'text': expense['status']['text']},
-                        "new": {'text': 'ready_for_creditor'}}
-                    })
-
-                    expense['status']['text'] = 'ready_for_creditor'
-
-                    key = client.key("Expenses_Journal")
-                    expense_journal = datastore.Entity(key=key)
-                    expense_journal.update(
-                        {
-                            "Expenses_Id": expense.key.id,
-                            "Time": datetime.datetime.utcnow().isoformat(
-                                timespec="seconds") + 'Z',
-                            "Attributes_Changed": json.dumps(changed),
-                            "User": "auto_approved"
-                        }
-                    )
-                    expenses_to_update.append(expense)
-                    expenses_to_update.append(expense_journal)
-
-        client.put_multi(expenses_to_update)
+            if is_auto_approvable(expense, cost_type_list):
+                expenses_to_update[inbox_name(expense)].append(
+                    approve_expense(client, expense))
+
+        # The approved expenses leave the manager's inbox in the same commit
+        for name, updates in expenses_to_update.items():
+            for index in range(0, len(updates), EXPENSES_PER_COMMIT):
+                commit_approved(
+                    client, name, updates[index:index + EXPENSES_PER_COMMIT])
         return "OK", 204
     else:
         return "Expected time interval for pending approvals not found", 400
@@ -1,5 +1,16 @@
 import datetime
 
+from google.cloud import datastore
+
+SUMMARY_KIND = "Expenses_Summary"
+SUMMARY_AFAS_FIELDS = ["Personeelsnummer", "Manager_personeelsnummer",
+                       "Bedrijf", "Afdeling Code", "Afdelingsomschrijving"]
+SUMMARY_FIELDS = ["amount", "note", "cost_type", "claim_date",
+                  "transaction_date", "manager_type", "auto_approved", "flags"]
+INBOX_KIND = "ManagerInbox"
+LEASE_COORDINATOR_INBOX = "leasecoordinator"
+LEASE_COORDINATOR_INBOX_SHARDS = 8
+
 
 def shift_to_business_days(pending: int):
     """
@@ -16,3 +27,66 @@ def shift_to_business_days(pending: int):
         if (boundary_day.weekday()) <= 5:
             business_day_delta = business_day_delta + 1
     return business_shift
+
+
+def expense_summary(client, expense):
+    """
+    Creates the Expenses_Summary entity the API list endpoints read,
+    mirrors build_expense_summary in the API
+
+    :type client: datastore.Client
+    :type expense: datastore.Entity
+
+    :returns datastore.Entity
+    """
+    employee = expense.get('employee', {})
+    afas_data = employee.get('afas_data') or {}
+
+    summary = datastore.Entity(key=client.key(SUMMARY_KIND, expense.key.id))
+    summary.update({field: expense[field] for field in SUMMARY_FIELDS
+                    if field in expense})
+    summary['status'] = dict(expense['status'])
+    summary['employee'] = {
+        'email': employee.get('email'),
+        'full_name': employee.get('full_name'),
+        'afas_data': {field: afas_data[field] for field in SUMMARY_AFAS_FIELDS
+                      if field in afas_data}
+    }
+    return summary
+
+
+def inbox_name(expense):
+    """
+    Returns the name of the ManagerInbox an expense that is ready for a manager
+    is waiting in, mirrors inbox_name in the API
+
+    :type expense: datastore.Entity
+
+    :returns str or None
+    """
+    if expense.get('manager_type') == 'leasecoordinator':
+        shard = expense.key.id % LEASE_COORDINATOR_INBOX_SHARDS
+        return f'{LEASE_COORDINATOR_INBOX}-{shard}'
+
+    afas_data = expense.get('employee', {}).get('afas_data') or {}
+    if afas_data.get('Manager_personeelsnummer') is None:
+        return None
+
+    return str(afas_data['Manager_personeelsnummer'])
+
+
+def remove_from_inbox(inbox, expense_ids):
+    """
+    Removes expenses that are no longer waiting for the manager from the inbox,
+    like remove_from_inbox in the API does for a single expense
+
+    :type inbox: datastore.Entity
+    :type expense_ids: set
+    """
+    inbox['expense_ids'] = [expense_id for expense_id in inbox['expense_ids']
+                            if expense_id not in expense_ids]
+    inbox['expenses'] = [entry for entry in inbox['expenses']
+                         if entry['id'] not in expense_ids]
+    inbox['count'] = len(inbox['expense_ids'])
+    inbox['updated'] = datetime.datetime.utcnow().isoformat(
+        timespec="seconds") + 'Z'